@@ -1,16 +1,119 @@
 import logging as lg
-from telegram.ext import MessageFilter
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from telegram import Update
+from telegram.ext import CallbackContext, DispatcherHandlerStop, MessageFilter
+
+from Metrics import get_registry
 
 logger = lg.getLogger(__name__)
 
 
 class AllowListFilter(MessageFilter):
-    def __init__(self, allow_list):
-        self.allow_list = allow_list
+    """ Lets through only updates from users on the allow list.
+
+    The ids are held in a frozenset, so a check costs the same however long
+    the list is. Ids may also be read from a file, one per line (anything
+    after a '#' is ignored), which is reloaded within `reload_sec` of being
+    changed, without a restart.
+
+    Rejections are logged at most once per `log_interval_sec` for each user,
+    along with how many were left out since, so a flood of updates from
+    strangers can't flood the log too.
+
+    Use it as the filter of message handlers, and register `check_callback`
+    ahead of the callback and inline query handlers, see add_handlers.
+    """
+
+    def __init__(self, allow_list=(), path=None, reload_sec=5, log_interval_sec=60, max_logged_users=10000):
+        """
+        Parameters
+        ----------
+        allow_list : iterable
+            User ids allowed to play.
+        path : str
+            File of more user ids allowed to play, if any.
+        reload_sec : float
+            Seconds between two checks of whether the file has changed.
+        log_interval_sec : float
+            Minimum seconds between two logged rejections of the same user.
+        max_logged_users : int
+            Users whose last logged rejection is remembered, least recently
+            rejected ones are forgotten first.
+        """
+        self.static = frozenset(allow_list)
+        self.path = path
+        self.reload_sec = reload_sec
+        self.log_interval_sec = log_interval_sec
+        self.max_logged_users = max_logged_users
+        self.allowed = self.static
+        self.mtime = None
+        self.next_reload = 0.0
+        self.lock = threading.Lock()
+        # user id -> [time of last logged rejection, rejections not logged since]
+        self.rejections = OrderedDict()
+        if path is not None:
+            self.reload()
 
     def filter(self, message):
-        user = message.from_user
-        if user.id in self.allow_list:
+        return self.allows(message.from_user)
+
+    def check_callback(self,
+                       update: Update,
+                       context: CallbackContext):
+        """ Handler stopping callback and inline queries of users not on the
+        list from reaching any later handler group.
+        """
+        if not self.allows(update.effective_user):
+            raise DispatcherHandlerStop()
+
+    def allows(self, user) -> bool:
+        if self.path is not None and time.monotonic() >= self.next_reload:
+            self.reload()
+        if user is not None and user.id in self.allowed:
             return True
-        logger.warning('%s %s (%d) sent message but is not in the allow list', user.first_name, user.last_name, user.id)
+        self._rejected(user)
         return False
+
+    def reload(self):
+        """ Rereads the file of user ids if it changed since it was last read. """
+        with self.lock:
+            self.next_reload = time.monotonic() + self.reload_sec
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+                if mtime == self.mtime:
+                    return
+                with open(self.path) as f:
+                    ids = {int(line.split('#', 1)[0]) for line in f if line.split('#', 1)[0].strip()}
+            except (OSError, ValueError):
+                # Keep the last good list
+                logger.exception('Could not read allow list %s', self.path)
+                return
+            self.mtime = mtime
+            self.allowed = self.static | ids
+        logger.info('Loaded %d allowed users from %s', len(ids), self.path)
+
+    # Helpers
+
+    def _rejected(self, user):
+        get_registry().counter('connect4_rejected_updates_total', help='Updates from users not on the allow list').inc()
+        user_id = None if user is None else user.id
+        now = time.monotonic()
+        with self.lock:
+            entry = self.rejections.get(user_id)
+            if entry is not None and now - entry[0] < self.log_interval_sec:
+                entry[1] += 1
+                return
+            suppressed = 0 if entry is None else entry[1]
+            self.rejections[user_id] = [now, 0]
+            self.rejections.move_to_end(user_id)
+            if len(self.rejections) > self.max_logged_users:
+                self.rejections.popitem(last=False)
+        if user is None:
+            logger.warning('Update without a user was rejected by the allow list')
+        else:
+            logger.warning('%s %s (%d) sent an update but is not in the allow list (%d more since last logged)',
+                           user.first_name, user.last_name, user.id, suppressed)
@@ -0,0 +1,266 @@
+import asyncio
+from typing import Union
+
+from telegram import Update, Bot, CallbackQuery
+from telegram.ext import CallbackContext
+
+from Connect4Bot import ANSWER, EDIT_BOARD, HANDLER_SECONDS, P1, P2, SEND, SEND_BOARD, Connect4Bot, Reply
+from GameManager import GameManager, TOO_MANY_GAMES_TEXT
+from Metrics import timed
+from Reminder import AsyncReminder
+
+
+class AsyncConnect4Bot(Connect4Bot):
+    """ Connect4Bot with coroutine handlers for asyncio Telegram frontends.
+
+    The game is changed by the same methods as Connect4Bot's, before anything
+    is awaited, so a slow Telegram round trip never leaves the game
+    half-updated for the next update of the same chat. Only sending the
+    replies is done differently.
+    """
+    __slots__ = ('send_lock',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Held while sending, so the game's messages go out in the order of its changes
+        self.send_lock = asyncio.Lock()
+
+    # /start_game
+    @timed(HANDLER_SECONDS, handler='start_game')
+    async def start_game(self,
+                         update: Update,
+                         context: CallbackContext):
+        await self._send(context.bot, update.message.chat_id, [Reply(SEND, self._start_game_text(context.args))])
+
+    # /p1
+    @timed(HANDLER_SECONDS, handler='p1')
+    async def p1(self,
+                 update: Update,
+                 context: CallbackContext):
+        chat_id = update.message.chat_id
+        await self._send(context.bot, chat_id, self._set_player(context.bot, chat_id, update.message.from_user, P1))
+
+    # /p2
+    @timed(HANDLER_SECONDS, handler='p2')
+    async def p2(self,
+                 update: Update,
+                 context: CallbackContext):
+        chat_id = update.message.chat_id
+        await self._send(context.bot, chat_id, self._set_player(context.bot, chat_id, update.message.from_user, P2))
+
+    # /vs_bot
+    @timed(HANDLER_SECONDS, handler='vs_bot')
+    async def vs_bot(self,
+                     update: Update,
+                     context: CallbackContext):
+        chat_id = update.message.chat_id
+        await self._send(context.bot, chat_id,
+                         self._vs_bot(context.bot, chat_id, update.message.from_user, context.args))
+
+    # /quit
+    @timed(HANDLER_SECONDS, handler='quit')
+    async def quit(self,
+                   update: Update,
+                   context: CallbackContext):
+        await self._send(context.bot, update.message.chat_id, self._quit(update.message.from_user.id))
+
+    # /hint
+    @timed(HANDLER_SECONDS, handler='hint')
+    async def hint(self,
+                   update: Update,
+                   context: CallbackContext):
+        await self._send(context.bot, update.message.chat_id, [Reply(SEND, self._hint())])
+
+    # /undo
+    @timed(HANDLER_SECONDS, handler='undo')
+    async def undo(self,
+                   update: Update,
+                   context: CallbackContext):
+        await self._send(context.bot, update.message.chat_id, self._undo(context.bot, update.message.from_user))
+
+    # /replay [moves]
+    @timed(HANDLER_SECONDS, handler='replay')
+    async def replay(self,
+                     update: Update,
+                     context: CallbackContext):
+        await self._send(context.bot, update.message.chat_id,
+                         self._replay(context.bot, update.message.from_user, context.args))
+
+    # Player Actions
+
+    @timed(HANDLER_SECONDS, handler='place_chip')
+    async def place_chip(self,
+                         update: Update,
+                         context: CallbackContext):
+        query = update.callback_query
+        await self._send(context.bot, query.message.chat_id, self._click(context.bot, query.from_user, query.data),
+                         query)
+
+    # Sending
+
+    async def _send(self,
+                    bot: Bot,
+                    chat_id: Union[int, str],
+                    replies: list,
+                    query: CallbackQuery = None):
+        """ Answers the query right away, and sends the other replies in order
+        after those of earlier changes of the game.
+        """
+        answers = [query.answer(text=reply.text) for reply in replies if reply.kind == ANSWER]
+        replies = [reply for reply in replies if reply.kind != ANSWER]
+        if replies:
+            await asyncio.gather(self._send_in_order(bot, chat_id, replies, self.started_at), *answers)
+        elif answers:
+            await asyncio.gather(*answers)
+
+    async def _send_in_order(self,
+                             bot: Bot,
+                             chat_id: Union[int, str],
+                             replies: list,
+                             started_at: int):
+        async with self.send_lock:
+            for reply in replies:
+                if reply.kind == SEND_BOARD:
+                    message = await bot.send_message(chat_id=chat_id, text=reply.text,
+                                                     reply_markup=reply.reply_markup)
+                    # Unless the game was quit, or another one started, while the board was sent
+                    if self.gameHasStarted and self.started_at == started_at and self.game_message is None:
+                        self.game_message = message
+                elif reply.kind == EDIT_BOARD and reply.message is not None:
+                    await bot.edit_message_text(chat_id=reply.message.chat_id, message_id=reply.message.message_id,
+                                                text=reply.text, reply_markup=reply.reply_markup)
+                else:
+                    # Edits of a board that was still being sent become messages of their own
+                    await bot.send_message(chat_id=chat_id, text=reply.text, reply_markup=reply.reply_markup)
+
+    def _new_reminder(self,
+                      bot: Bot,
+                      chat_id: Union[int, str]) -> AsyncReminder:
+        return AsyncReminder(bot, chat_id, self.p_name[P1], self.p_name[P2])
+
+    def _ai_callback(self,
+                     bot: Bot,
+                     generation: int):
+        """ Returns the function the search pool calls, from one of its
+        threads, with the AI's move, which plays it on this event loop.
+        """
+        loop = asyncio.get_running_loop()
+        return lambda col: asyncio.run_coroutine_threadsafe(self._play_ai_move(bot, generation, col), loop)
+
+    async def _play_ai_move(self,
+                            bot: Bot,
+                            generation: int,
+                            col: int):
+        """ Plays the AI's move once the search pool found it. """
+        message = self.game_message
+        replies = self._ai_move(bot, generation, col)
+        if replies:
+            await self._send(bot, message.chat_id, replies)
+        if self.on_change is not None:
+            self.on_change(self)
+
+
+class AsyncGameManager(GameManager):
+    """ GameManager routing updates to AsyncConnect4Bot games. Updates of
+    different chats can be handled concurrently on one event loop.
+    """
+    session_class = AsyncConnect4Bot
+
+    # /start_game
+    async def start_game(self,
+                         update: Update,
+                         context: CallbackContext):
+        await self._command(update, context, AsyncConnect4Bot.start_game, create=True)
+
+    # /p1
+    async def p1(self,
+                 update: Update,
+                 context: CallbackContext):
+        await self._command(update, context, AsyncConnect4Bot.p1, create=True)
+
+    # /p2
+    async def p2(self,
+                 update: Update,
+                 context: CallbackContext):
+        await self._command(update, context, AsyncConnect4Bot.p2, create=True)
+
+    # /vs_bot
+    async def vs_bot(self,
+                     update: Update,
+                     context: CallbackContext):
+        await self._command(update, context, AsyncConnect4Bot.vs_bot, create=True)
+
+    # /quit
+    async def quit(self,
+                   update: Update,
+                   context: CallbackContext):
+        await self._command(update, context, AsyncConnect4Bot.quit, create=False)
+
+    # /hint
+    async def hint(self,
+                   update: Update,
+                   context: CallbackContext):
+        await self._command(update, context, AsyncConnect4Bot.hint, create=False)
+
+    # /undo
+    async def undo(self,
+                   update: Update,
+                   context: CallbackContext):
+        await self._command(update, context, AsyncConnect4Bot.undo, create=False)
+
+    # /replay
+    async def replay(self,
+                     update: Update,
+                     context: CallbackContext):
+        await self._command(update, context, AsyncConnect4Bot.replay, create=False)
+
+    # /stats
+    async def stats_command(self,
+                            update: Update,
+                            context: CallbackContext):
+        message = update.message
+        await context.bot.send_message(chat_id=message.chat_id, text=self._stats_text(message))
+
+    # /leaderboard
+    async def leaderboard(self,
+                          update: Update,
+                          context: CallbackContext):
+        chat_id = update.message.chat_id
+        await context.bot.send_message(chat_id=chat_id, text=self._leaderboard_text(chat_id))
+
+    # Player Actions
+
+    async def place_chip(self,
+                         update: Update,
+                         context: CallbackContext):
+        query = update.callback_query
+        chat_id = query.message.chat_id
+        session = self._lookup_board(chat_id, query.message.message_id)
+
+        if session is None:
+            # Board of a finished or evicted game
+            await query.answer()
+            return
+
+        await session.place_chip(update, context)
+        self._update_registry(chat_id, session)
+
+    # Helpers
+
+    async def _command(self,
+                       update: Update,
+                       context: CallbackContext,
+                       handler,
+                       create: bool):
+        chat_id = update.message.chat_id
+        session = self._lookup(chat_id, create)
+
+        if session is None:
+            if create:
+                await context.bot.send_message(chat_id=chat_id, text=TOO_MANY_GAMES_TEXT)
+                return
+            # Nothing to act on, let a fresh game give its usual answer
+            session = self._new_session()
+
+        await handler(session, update, context)
+        self._update_registry(chat_id, session)
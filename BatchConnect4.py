@@ -0,0 +1,136 @@
+import numpy as np
+
+from Connect4 import Connect4
+
+
+class BatchConnect4(object):
+    """ Many Connect4 games advanced in lockstep, for analytics and self-play
+    at scale. Needs NumPy, which the bot itself doesn't.
+
+    Boards use the BitboardConnect4 layout, one uint64 per player and board:
+    each column occupies (rows + 1) bits, bottom row first, the extra bit
+    being an always-empty sentinel. Boards are therefore limited to
+    (rows + 1) * cols <= 64 bits, e.g. 6x7 or 8x7, but not 8x9, and to
+    runs whose shifts stay under 64 bits, e.g. not 4 in a row on 31x2.
+
+    A board that is won or tied is done, and refuses moves until it is reset.
+    """
+    BAD_MOVE, GOOD_MOVE, WIN_MOVE, TIE_MOVE = (Connect4.BAD_MOVE, Connect4.GOOD_MOVE,
+                                               Connect4.WIN_MOVE, Connect4.TIE_MOVE)
+
+    def __init__(self, count, rows_=6, cols_=7, in_a_row_=4):
+        """
+        Parameters
+        ----------
+        count : int
+            Number of boards.
+        rows_ : int
+            Number of rows of every board.
+        cols_ : int
+            Number of columns of every board.
+        in_a_row_ : int
+            Number of chips a player needs in-a-row to win.
+        """
+        if (rows_ + 1) * cols_ > 64:
+            raise ValueError('A {}x{} board does not fit in 64 bits'.format(rows_, cols_))
+        # Shifts of each direction's doubling runs, in the same order of
+        # directions as BitboardConnect4.shifts and built the same way
+        height = rows_ + 1
+        steps = []
+        for shift in (height + 1, height, height - 1, 1):
+            k = 1
+            direction_steps = []
+            while 2 * k <= in_a_row_:
+                direction_steps.append(shift * k)
+                k *= 2
+            if k < in_a_row_:
+                direction_steps.append(shift * (in_a_row_ - k))
+            steps.append(direction_steps)
+        # NumPy leaves shifts of a uint64 by 64 or more bits undefined
+        if max(max(direction_steps, default=0) for direction_steps in steps) >= 64:
+            raise ValueError('Runs of {} on a {}x{} board do not fit in 64 bits'.format(in_a_row_, rows_, cols_))
+        self.count = count
+        self.rows = rows_
+        self.cols = cols_
+        self.spaces = self.rows * self.cols
+        self.in_a_row = in_a_row_
+        self.height = height
+        self.steps = [[np.uint64(step) for step in direction_steps] for direction_steps in steps]
+        self.bits = np.zeros((2, count), dtype=np.uint64)
+        self.heights = np.zeros((count, self.cols), dtype=np.uint8)
+        self.move_count = np.zeros(count, dtype=np.int16)
+        self.done = np.zeros(count, dtype=bool)
+        self._index = np.arange(count)
+
+    def place_chips(self,
+                    players,
+                    cols
+                    ) -> np.ndarray:
+        """ Places one chip on every board.
+
+        Parameters
+        ----------
+        players : int or array_like
+            Player making the move on each board, or on every board.
+                1 = Player 1
+                2 = Player 2
+        cols : array_like
+            1-Indexed column of each board's chip.
+
+        Returns
+        -------
+        numpy.ndarray
+            Result of each board's move, coded as by Connect4.place_chip:
+           -1 - Invalid placement (or the board is done)
+            0 - Valid placement
+            1 - Valid placement, player won
+            2 - Valid placement, game is tied
+        """
+        side = np.broadcast_to(np.asarray(players, dtype=np.intp) - 1, (self.count,))
+        col = np.asarray(cols, dtype=np.intp) - 1
+        in_range = (col >= 0) & (col < self.cols)
+        col = np.where(in_range, col, 0)
+        h = self.heights[self._index, col]
+        valid = in_range & ~self.done & (h < self.rows)
+
+        index = self._index[valid]
+        side, col, h = side[valid], col[valid], h[valid].astype(np.uint64)
+        chip = np.left_shift(np.uint64(1), col.astype(np.uint64) * np.uint64(self.height) + h)
+        mine = self.bits[side, index] | chip
+        self.bits[side, index] = mine
+        self.heights[index, col] += 1
+        self.move_count[index] += 1
+
+        results = np.full(self.count, self.BAD_MOVE, dtype=np.int8)
+        results[index] = np.where(self._wins(mine), self.WIN_MOVE,
+                                  np.where(self.move_count[index] == self.spaces, self.TIE_MOVE, self.GOOD_MOVE))
+        self.done |= results > self.GOOD_MOVE
+        return results
+
+    def _wins(self, bits):
+        """ Whether each bitboard has a run of `in_a_row` chips, by the same
+        doubling shift-and-mask runs as BitboardConnect4._check_for_win, over
+        whole boards rather than a window, which vectorize across games.
+        """
+        won = np.zeros(bits.shape, dtype=bool)
+        for steps in self.steps:
+            runs = bits
+            for step in steps:
+                runs = runs & (runs >> step)
+            won |= runs != 0
+        return won
+
+    def legal_moves(self) -> np.ndarray:
+        """ Boolean (count, cols) mask of the columns each board accepts. """
+        return (self.heights < self.rows) & ~self.done[:, None]
+
+    def reset(self, boards=None):
+        """ Resets every board, or those selected by `boards` (a boolean mask
+        or indexes), to initial state.
+        """
+        if boards is None:
+            boards = slice(None)
+        self.bits[:, boards] = 0
+        self.heights[boards] = 0
+        self.move_count[boards] = 0
+        self.done[boards] = False
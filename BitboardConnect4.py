@@ -0,0 +1,430 @@
+from Connect4 import Connect4, MoveAnalysis, history_to_moves, moves_to_history
+
+
+class BitboardConnect4:
+    """ Drop-in alternative to Connect4 which stores each player's chips as an
+    integer bitboard instead of a list of row lists.
+
+    Each column occupies (rows + 1) bits, bottom row first, with the extra bit
+    acting as an always-empty sentinel so that shifted runs can never wrap from
+    one column into the next. The cell-state grid exposed through `board` is
+    only built when something (usually a renderer) first asks for it, and is
+    then kept up to date cell by cell as chips are placed and taken back.
+
+    Each player's threats, the cells that would complete a run for them, are
+    built up chip by chip: analyze() only adds the threats of the chips
+    placed since it last ran, then looks at the landing cell of each column.
+    """
+    BLANK, P1, P2, P1_LAST, P2_LAST, P1_WIN, P2_WIN = (Connect4.BLANK, Connect4.P1, Connect4.P2,
+                                                      Connect4.P1_LAST, Connect4.P2_LAST,
+                                                      Connect4.P1_WIN, Connect4.P2_WIN)
+    BAD_MOVE, GOOD_MOVE, WIN_MOVE, TIE_MOVE = (Connect4.BAD_MOVE, Connect4.GOOD_MOVE,
+                                               Connect4.WIN_MOVE, Connect4.TIE_MOVE)
+
+    __slots__ = ('rows', 'cols', 'spaces', 'in_a_row', 'height', 'shifts', '_through', '_windows', '_cells',
+                 '_around', '_bits', '_won', '_threats', '_unseen', 'heights', 'move_count', 'last_move', 'history',
+                 '_grid')
+
+    # Per-shape lookup tables, shared by every instance of the same dimensions
+    _layouts = {}
+
+    def __init__(self, rows_=6, cols_=7, in_a_row_=4):
+        """
+        Parameters
+        ----------
+        rows_ : int
+            Number of rows this Connect4 instance will have.
+        cols_ : int
+            Number of columns this Connect4 instance will have.
+        in_a_row_ : int
+            Number of chips a player needs in-a-row to win.
+        """
+        self.rows = rows_
+        self.cols = cols_
+        self.spaces = self.rows * self.cols
+        self.in_a_row = in_a_row_
+        self.height = self.rows + 1
+        (self.shifts, self._through, self._windows, self._cells,
+         self._around) = self._layout(self.rows, self.cols, self.in_a_row)
+        self._bits = [0, 0]
+        self._threats = [0, 0]
+        self._unseen = [0, 0]
+        self.heights = bytearray(self.cols)
+        # 0-Indexed column of every move, one byte per ply
+        self.history = bytearray()
+        self._grid = None
+        self.reset()
+
+    @classmethod
+    def _layout(cls, rows, cols, in_a_row):
+        """ Returns the shift of each direction; for each direction and each
+        bit index, a mask of every starting bit whose `in_a_row` long run in
+        that direction covers the bit index, and the mask of that run; the
+        mask of every cell of the board; and for each bit index, the window
+        around it that _check_for_win looks at in each direction. Built once
+        per board shape.
+        """
+        key = (rows, cols, in_a_row)
+        layout = cls._layouts.get(key)
+        if layout is None:
+            height = rows + 1
+            size = height * cols
+            # Same order Connect4._check_for_win tries directions: bottom-left
+            # to top-right, left to right, top-left to bottom-right, down
+            shifts = (height + 1, height, height - 1, 1)
+            through = []
+            windows = []
+            for shift in shifts:
+                masks = [0] * size
+                for bit in range(size):
+                    mask = 0
+                    for i in range(in_a_row):
+                        start = bit - i * shift
+                        if start >= 0:
+                            mask |= 1 << start
+                    masks[bit] = mask
+                through.append(masks)
+                windows.append(tuple(sum(1 << (start + i * shift) for i in range(in_a_row))
+                                     for start in range(size)))
+            cells = sum(((1 << rows) - 1) << (col * height) for col in range(cols))
+            # Shifts ANDing a board with itself so that only the starts of runs
+            # of `in_a_row` are left, doubling the run length each time
+            steps = []
+            for shift in shifts:
+                k = 1
+                direction_steps = []
+                while 2 * k <= in_a_row:
+                    direction_steps.append(shift * k)
+                    k *= 2
+                if k < in_a_row:
+                    direction_steps.append(shift * (in_a_row - k))
+                steps.append(tuple(direction_steps))
+            # Per bit: the lowest bit of any run through it, the mask of the bits
+            # from there to the end of the highest run, and per direction, the
+            # mask of its two neighbours and the starts of the runs through it,
+            # both relative to the lowest bit, and the steps
+            reach = (in_a_row - 1) * max(shifts)
+            around = []
+            for bit in range(size):
+                low = max(0, bit - reach)
+                directions = []
+                for direction, shift in enumerate(shifts):
+                    if in_a_row < 2:
+                        # A chip is a run of its own, the chip itself stands in for its neighbours
+                        neighbours = 1 << bit
+                    else:
+                        neighbours = (1 << (bit + shift)) | (1 << (bit - shift) if bit >= shift else 0)
+                    directions.append((neighbours >> low, through[direction][bit] >> low, steps[direction]))
+                around.append((low, (1 << (bit + reach + 1 - low)) - 1, tuple(directions)))
+            layout = cls._layouts[key] = (shifts, tuple(through), tuple(windows), cells, tuple(around))
+        return layout
+
+    def place_chip(self,
+                   player: int,
+                   col: int
+                   ) -> int:
+        """ Attempts to place a chip for the player in the designated column.
+
+        Parameters
+        ----------
+        player : int
+            Which player is making this move.
+                1 = Player 1
+                2 = Player 2
+        col : int
+            1-Indexed column value for chip to be placed
+
+        Returns
+        -------
+        int
+           -1 - Invalid placement
+            0 - Valid placement
+            1 - Valid placement, player won
+            2 - Valid placement, game is tied
+        """
+        col = col - 1
+
+        # Invalid move
+        if col < 0 or col >= self.cols or self.heights[col] == self.rows:
+            return self.BAD_MOVE
+
+        h = self.heights[col]
+        bit = col * self.height + h
+        mask = 1 << bit
+        self._bits[player - 1] |= mask
+        self._unseen[player - 1] |= mask
+        self.heights[col] = h + 1
+        row = self.rows - 1 - h
+        grid = self._grid
+        if grid is not None:
+            # The previous move's chip can't have been marked as won since
+            if self.move_count:
+                last_player, last_row, last_col = self.last_move
+                grid[last_row][last_col] = last_player
+            grid[row][col] = self.P1_LAST if player == self.P1 else self.P2_LAST
+        self.last_move = (player, row, col)
+        self.move_count += 1
+        self.history.append(col)
+
+        if self._check_for_win(player, bit) > 0:
+            return self.WIN_MOVE
+        elif self.move_count == self.spaces:
+            return self.TIE_MOVE
+        else:
+            return self.GOOD_MOVE
+
+    def _check_for_win(self,
+                       player: int,
+                       bit: int
+                       ) -> int:
+        """ Looks for runs through the chip at `bit` in every direction with
+        shift-and-mask, marking the winning chips of the first direction that
+        wins. Only the window of bits the runs through it can cover is taken
+        out of the board, and directions in which the chip has no neighbour of
+        the player are skipped (unless a single chip wins), so the cost of a
+        move doesn't grow with the area of the board.
+
+        Returns
+        -------
+        int
+           0 if the player does not have enough chips in a row to win, otherwise
+           the same direction codes as Connect4._check_for_win.
+        """
+        # Chips already marked as part of a win no longer count, as in Connect4
+        bits = self._bits[player - 1]
+        if self._won:
+            bits &= ~self._won
+        low, span, directions = self._around[bit]
+        # Sentinel bits are always empty, so no run wraps between columns
+        window = (bits >> low) & span
+        direction = 0
+        for neighbours, starts, steps in directions:
+            direction += 1
+            if not window & neighbours:
+                continue
+            runs = window
+            for step in steps:
+                runs &= runs >> step
+            if runs & starts:
+                self._mark_win_dir(bits, bit, self.shifts[direction - 1])
+                return direction
+        return 0
+
+    def _mark_win_dir(self,
+                      bits: int,
+                      bit: int,
+                      shift: int):
+        """ Marks the chips adjoining `bit` in both directions along `shift`.
+        The placed chip itself stays marked as the last move, as in Connect4.
+        """
+        grid = self._grid
+        won = self.P1_WIN if self.last_move[0] == self.P1 else self.P2_WIN
+        for step in (shift, -shift):
+            cur = bit + step
+            while cur >= 0 and (bits >> cur) & 1:
+                self._won |= 1 << cur
+                if grid is not None:
+                    col, h = divmod(cur, self.height)
+                    grid[self.rows - 1 - h][col] = won
+                cur += step
+
+    def _update_threats(self):
+        """ Adds the threats made by chips placed since the last update: the
+        cells missing from runs through them that the player otherwise fills.
+        An opponent's chip can only ever fill a threat, never break one, so
+        threats are never taken away; analyze() masks out the filled ones.
+        """
+        for side in (0, 1):
+            unseen = self._unseen[side]
+            if not unseen:
+                continue
+            mine = self._bits[side]
+            threats = 0
+            while unseen:
+                low = unseen & -unseen
+                unseen ^= low
+                bit = low.bit_length() - 1
+                for direction, windows in enumerate(self._windows):
+                    starts = self._through[direction][bit]
+                    while starts:
+                        start = starts & -starts
+                        starts ^= start
+                        missing = windows[start.bit_length() - 1] & ~mine
+                        # Exactly one cell missing
+                        if missing & (missing - 1) == 0:
+                            threats |= missing
+            # Runs may cross a sentinel or run off the top of the last column
+            self._threats[side] |= threats & self._cells
+            self._unseen[side] = 0
+
+    def analyze(self,
+                player: int
+                ) -> MoveAnalysis:
+        """ Sorts the columns for the player about to move, from the threats
+        kept up to date by place_chip.
+
+        Parameters
+        ----------
+        player : int
+            Which player is about to move.
+                1 = Player 1
+                2 = Player 2
+
+        Returns
+        -------
+        MoveAnalysis
+            Legal columns, immediately winning columns of each player and
+            columns which would hand the opponent a win.
+        """
+        self._update_threats()
+        p1_bits, p2_bits = self._bits
+        empty = self._cells & ~(p1_bits | p2_bits)
+        if self.in_a_row < 2:
+            # Threats are only made by chips, but any chip wins on its own
+            t1 = t2 = empty
+        else:
+            t1, t2 = self._threats[0] & empty, self._threats[1] & empty
+        above = t1 if player == self.P2 else t2
+        legal, unsafe = [], []
+        wins = ([], [])
+        for col, h in enumerate(self.heights):
+            if h == self.rows:
+                continue
+            landing = 1 << (col * self.height + h)
+            legal.append(col + 1)
+            if t1 & landing:
+                wins[0].append(col + 1)
+            if t2 & landing:
+                wins[1].append(col + 1)
+            if above & (landing << 1):
+                unsafe.append(col + 1)
+        return MoveAnalysis(tuple(legal), (tuple(wins[0]), tuple(wins[1])), tuple(unsafe))
+
+    def undo(self) -> bool:
+        """ Takes back the last move, returning False if there is none. A
+        won game is no longer won once its winning move is taken back.
+        """
+        if not self.history:
+            return False
+        col = self.history.pop()
+        h = self.heights[col] - 1
+        bit = col * self.height + h
+        side = self.last_move[0] - 1
+        self._bits[side] &= ~(1 << bit)
+        self.heights[col] = h
+        self.move_count -= 1
+        grid = self._grid
+        if grid is not None:
+            grid[self.rows - 1 - h][col] = self.BLANK
+
+        if self._won:
+            # Unmark the chips the move won with, all in a line through it
+            for shift in self.shifts:
+                for step in (shift, -shift):
+                    cur = bit + step
+                    while cur >= 0 and (self._won >> cur) & 1:
+                        self._won &= ~(1 << cur)
+                        if grid is not None:
+                            won_col, won_h = divmod(cur, self.height)
+                            grid[self.rows - 1 - won_h][won_col] = self.P1 if (self._bits[0] >> cur) & 1 else self.P2
+                        cur += step
+        # Threats can't be taken back one chip at a time, rebuild the player's
+        # from all of their chips on the next analysis
+        self._threats[side] = 0
+        self._unseen[side] = self._bits[side]
+
+        if self.history:
+            col = self.history[-1]
+            h = self.heights[col] - 1
+            player = self.P1 if (self._bits[0] >> (col * self.height + h)) & 1 else self.P2
+            self.last_move = (player, self.rows - 1 - h, col)
+            if grid is not None:
+                grid[self.rows - 1 - h][col] = self.P1_LAST if player == self.P1 else self.P2_LAST
+        else:
+            self.last_move = (0, 0, 0)
+        return True
+
+    @property
+    def moves(self) -> str:
+        """ Move string of the game so far, one character per ply. """
+        return history_to_moves(self.history)
+
+    def replay(self,
+               moves: str) -> int:
+        """ Resets the game and plays the move string, Player 1 first.
+
+        Returns
+        -------
+        int
+            Result of the last move, as returned by place_chip.
+
+        Raises
+        ------
+        ValueError
+            If a move is invalid or comes after the game was decided.
+        """
+        self.reset()
+        res = self.GOOD_MOVE
+        for ply, col in enumerate(moves_to_history(moves)):
+            if res != self.GOOD_MOVE:
+                raise ValueError('Move {} of {!r} comes after the end of the game'.format(ply + 1, moves))
+            res = self.place_chip(self.P1 + ply % 2, col + 1)
+            if res == self.BAD_MOVE:
+                raise ValueError('Move {} of {!r} is invalid'.format(ply + 1, moves))
+        return res
+
+    def reset(self):
+        """ Resets this Connect4 instance to initial state, in place. """
+        if self._grid is not None:
+            # Only rows below the highest chip have chips in them
+            for row in range(self.rows - max(self.heights), self.rows):
+                self._grid[row][:] = [self.BLANK] * self.cols
+        self._bits[0] = self._bits[1] = 0
+        self._won = 0
+        self._threats[0] = self._threats[1] = 0
+        self._unseen[0] = self._unseen[1] = 0
+        self.heights[:] = bytes(self.cols)
+        self.move_count = 0
+        self.last_move = (0, 0, 0)
+        self.history.clear()
+
+    @property
+    def bottom(self):
+        """ Row each column's next chip would land in, matching Connect4.bottom. """
+        return [self.rows - 1 - h for h in self.heights]
+
+    @property
+    def board(self):
+        """ Cell-state grid in the same layout as Connect4.board, built on
+        first use and updated by every move after. Treat it as read-only.
+        """
+        if self._grid is None:
+            self._grid = self._build_grid()
+        return self._grid
+
+    def _build_grid(self):
+        rows = self.rows
+        p1_bits, p2_bits = self._bits
+        grid = [[self.BLANK] * self.cols for _ in range(rows)]
+        for col, h_max in enumerate(self.heights):
+            base = col * self.height
+            for h in range(h_max):
+                bit = 1 << (base + h)
+                if self._won & bit:
+                    state = self.P1_WIN if p1_bits & bit else self.P2_WIN
+                else:
+                    state = self.P1 if p1_bits & bit else self.P2
+                grid[rows - 1 - h][col] = state
+        if self.move_count:
+            player, row, col = self.last_move
+            grid[row][col] = self.P1_LAST if player == self.P1 else self.P2_LAST
+        return grid
+
+    def _print_board(self):
+        """ Debugging method """
+        for row in self.board:
+            print(row)
+
+    def _board_to_string(self):
+        """ Debugging method """
+        return '\n'.join(str(row) for row in self.board)
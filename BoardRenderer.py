@@ -0,0 +1,74 @@
+from Connect4 import Connect4
+
+# Glyph for each Connect4 cell state, spelled out rather than looked up by
+# name with the emoji package at import time
+CHIP_GLYPHS = {Connect4.BLANK: '\u26aa',  # :white_circle:
+               Connect4.P1: '\U0001f534',  # :red_circle:
+               Connect4.P2: '\U0001f535',  # :large_blue_circle:
+               Connect4.P1_LAST: '\U0001f7e5',  # :red_square:
+               Connect4.P2_LAST: '\U0001f7e6',  # :blue_square:
+               Connect4.P1_WIN: '\U0001f525',  # :fire:
+               Connect4.P2_WIN: '\U0001f300'}  # :cyclone:
+
+# :keycap_1: to :keycap_9:, then :keycap_10:
+_KEYCAPS = tuple('{}\ufe0f\u20e3'.format(digit) for digit in range(1, 10)) + ('\U0001f51f',)
+
+
+def _column_header(col: int) -> str:
+    """ Keycap emoji for 1-indexed columns up to 10, circled numbers after. """
+    if col <= 10:
+        return _KEYCAPS[col - 1]
+    elif col <= 20:
+        return chr(0x2460 + col - 1)
+    return str(col)
+
+
+class BoardRenderer(object):
+    """ Renders Connect4 boards of a fixed width as emoji text.
+
+    The header and glyph table are built once, and each rendered row is
+    cached on its contents, so a move only renders the one row it changed.
+    """
+
+    def __init__(self, cols=7, max_cached_rows=4096):
+        """
+        Parameters
+        ----------
+        cols : int
+            Number of columns of the boards this renderer draws.
+        max_cached_rows : int
+            Rendered rows kept before the row cache is cleared.
+        """
+        self.cols = cols
+        self.max_cached_rows = max_cached_rows
+        self.header = ' '.join(_column_header(col) for col in range(1, cols + 1))
+        self.glyphs = tuple(CHIP_GLYPHS[state] for state in range(len(CHIP_GLYPHS)))
+        self.row_cache = {}
+
+    def render_row(self, row) -> str:
+        key = tuple(row)
+        text = self.row_cache.get(key)
+        if text is None:
+            if len(self.row_cache) >= self.max_cached_rows:
+                self.row_cache.clear()
+            glyphs = self.glyphs
+            text = self.row_cache[key] = ' '.join([glyphs[entry] for entry in key])
+        return text
+
+    def render(self, board) -> str:
+        """ Returns the board with a column header line above and below it. """
+        lines = [self.header]
+        lines.extend(map(self.render_row, board))
+        lines.append(self.header)
+        return '\n'.join(lines)
+
+
+_renderers = {}
+
+
+def get_renderer(cols: int) -> BoardRenderer:
+    """ Returns the shared renderer for boards `cols` wide. """
+    renderer = _renderers.get(cols)
+    if renderer is None:
+        renderer = _renderers.setdefault(cols, BoardRenderer(cols))
+    return renderer
@@ -1,6 +1,33 @@
+from collections import namedtuple
+
+# 1-Indexed columns: every playable column, the columns where each player
+# (P1 first) would win right away, and the columns that would let the
+# opponent win right away by playing on top
+MoveAnalysis = namedtuple('MoveAnalysis', ['legal', 'wins', 'unsafe'])
+
+# Character of each 1-indexed column in a move string, e.g. '4453' or 'ab'
+MOVE_CHARS = '123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def moves_to_history(moves: str) -> bytes:
+    """ 0-Indexed columns of a move string, raising ValueError on unknown
+    characters.
+    """
+    try:
+        return bytes(MOVE_CHARS.index(char) for char in moves.lower())
+    except ValueError:
+        raise ValueError('{!r} is not a move string'.format(moves)) from None
+
+
+def history_to_moves(history) -> str:
+    """ Move string of 0-indexed columns. """
+    return ''.join(MOVE_CHARS[col] for col in history)
+
+
 class Connect4:
     BLANK, P1, P2, P1_LAST, P2_LAST, P1_WIN, P2_WIN = range(7)
     BAD_MOVE, GOOD_MOVE, WIN_MOVE, TIE_MOVE = range(-1, 3)
+    __slots__ = ('rows', 'cols', 'spaces', 'in_a_row', 'board', 'bottom', 'move_count', 'last_move', 'history')
 
     def __init__(self, rows_=6, cols_=7, in_a_row_=4):
         """
@@ -21,6 +48,8 @@ class Connect4:
         self.bottom = [(self.rows - 1) for _ in range(self.cols)]
         self.move_count = 0
         self.last_move = (0, 0, 0)
+        # 0-Indexed column of every move, one byte per ply
+        self.history = bytearray()
 
     def place_chip(self,
                    player: int,
@@ -47,10 +76,12 @@ class Connect4:
         """
 
         col = col - 1
-        row = self.bottom[col]  # Gets the row the chip would land
 
         # Invalid move
-        if row == -1 or col < 0 or col >= self.cols or self.board[row][col] != 0:
+        if col < 0 or col >= self.cols:
+            return self.BAD_MOVE
+        row = self.bottom[col]  # Gets the row the chip would land
+        if row == -1 or self.board[row][col] != 0:
             return self.BAD_MOVE
 
         # Reset last move to normal chip
@@ -61,6 +92,7 @@ class Connect4:
         self.last_move = (player, row, col)
         self.bottom[col] -= 1
         self.move_count += 1
+        self.history.append(col)
 
         if self._check_for_win(player, row, col) > 0:
             return self.WIN_MOVE
@@ -224,9 +256,135 @@ class Connect4:
                                row_inc,
                                col_inc)
 
+    def analyze(self,
+                player: int
+                ) -> MoveAnalysis:
+        """ Sorts the columns for the player about to move, in one pass over
+        the landing cell of each column.
+
+        Unlike BitboardConnect4, which keeps its threats up to date chip by
+        chip, this recomputes them on every call: about cols * in_a_row cells
+        are looked at per player. Only /hint asks for it, so every move isn't
+        made to pay for keeping threats up to date.
+
+        Parameters
+        ----------
+        player : int
+            Which player is about to move.
+                1 = Player 1
+                2 = Player 2
+
+        Returns
+        -------
+        MoveAnalysis
+            Legal columns, immediately winning columns of each player and
+            columns which would hand the opponent a win.
+        """
+        opponent = self.P2 if player == self.P1 else self.P1
+        legal, unsafe = [], []
+        wins = ([], [])
+        for col in range(self.cols):
+            row = self.bottom[col]
+            if row < 0:
+                continue
+            legal.append(col + 1)
+            for p in (self.P1, self.P2):
+                if self._would_win(p, row, col):
+                    wins[p - 1].append(col + 1)
+            if row > 0 and self._would_win(opponent, row - 1, col):
+                unsafe.append(col + 1)
+        return MoveAnalysis(tuple(legal), (tuple(wins[0]), tuple(wins[1])), tuple(unsafe))
+
+    def _would_win(self,
+                   player: int,
+                   row: int,
+                   col: int
+                   ) -> bool:
+        """ Whether a chip of the player at the empty cell would make enough
+        chips in a row, without placing it.
+        """
+        chips = (player, self.P1_LAST if player == self.P1 else self.P2_LAST)
+        for row_inc, col_inc in ((1, -1), (0, 1), (1, 1), (1, 0)):
+            count = 1
+            for sign in (1, -1):
+                r, c = row + sign * row_inc, col + sign * col_inc
+                while 0 <= r < self.rows and 0 <= c < self.cols and self.board[r][c] in chips:
+                    count += 1
+                    r, c = r + sign * row_inc, c + sign * col_inc
+            if count >= self.in_a_row:
+                return True
+        return False
+
+    def undo(self) -> bool:
+        """ Takes back the last move, returning False if there is none. A
+        won game is no longer won once its winning move is taken back.
+        """
+        if not self.history:
+            return False
+        col = self.history.pop()
+        self.bottom[col] += 1
+        row = self.bottom[col]
+        player = self.last_move[0]
+        self.board[row][col] = self.BLANK
+        self.move_count -= 1
+
+        # Unmark the chips the move won with, all in a line through it
+        won = self.P1_WIN if player == self.P1 else self.P2_WIN
+        for row_inc, col_inc in ((1, -1), (0, 1), (1, 1), (1, 0)):
+            for sign in (1, -1):
+                r, c = row + sign * row_inc, col + sign * col_inc
+                while 0 <= r < self.rows and 0 <= c < self.cols and self.board[r][c] == won:
+                    self.board[r][c] = player
+                    r, c = r + sign * row_inc, c + sign * col_inc
+
+        if self.history:
+            col = self.history[-1]
+            row = self.bottom[col] + 1
+            player = self.board[row][col]
+            self.board[row][col] = self.P1_LAST if player == self.P1 else self.P2_LAST
+            self.last_move = (player, row, col)
+        else:
+            self.last_move = (0, 0, 0)
+        return True
+
+    @property
+    def moves(self) -> str:
+        """ Move string of the game so far, one character per ply. """
+        return history_to_moves(self.history)
+
+    def replay(self,
+               moves: str) -> int:
+        """ Resets the game and plays the move string, Player 1 first.
+
+        Returns
+        -------
+        int
+            Result of the last move, as returned by place_chip.
+
+        Raises
+        ------
+        ValueError
+            If a move is invalid or comes after the game was decided.
+        """
+        self.reset()
+        res = self.GOOD_MOVE
+        for ply, col in enumerate(moves_to_history(moves)):
+            if res != self.GOOD_MOVE:
+                raise ValueError('Move {} of {!r} comes after the end of the game'.format(ply + 1, moves))
+            res = self.place_chip(self.P1 + ply % 2, col + 1)
+            if res == self.BAD_MOVE:
+                raise ValueError('Move {} of {!r} is invalid'.format(ply + 1, moves))
+        return res
+
     def reset(self):
-        """ Resets this Connect4 instance to initial state. """
-        self.__init__(self.rows, self.cols, self.in_a_row)
+        """ Resets this Connect4 instance to initial state, in place. """
+        # Only rows below the highest chip have chips in them
+        for row in range(min(self.bottom) + 1, self.rows):
+            self.board[row][:] = [self.BLANK] * self.cols
+        self.bottom[:] = [self.rows - 1] * self.cols
+        self.move_count = 0
+        self.last_move = (0, 0, 0)
+        self.history.clear()
 
     def _print_board(self):
         """ Debugging method """
@@ -1,186 +1,566 @@
+from __future__ import annotations
+
+import functools
 import logging as lg
+import re
 import threading
-from typing import Union
-
-from emoji import emojize
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, Bot, CallbackQuery
-from telegram.ext import CallbackContext
+from collections import namedtuple
+from typing import TYPE_CHECKING, Union
 
+import time_util as t
+from BoardRenderer import CHIP_GLYPHS, get_renderer
 from Connect4 import Connect4
-from Reminder import Reminder
+from Connect4Solver import BOOK_DIFFICULTIES, DIFFICULTIES, DEFAULT_DIFFICULTY, pack_position, search_packed
+from Metrics import get_registry, timed
+from OpeningBook import book_move
+from OutboundQueue import OutboundQueue
+from Reminder import Reminder, ReminderScheduler
+from SearchPool import get_default_pool
+from StatsStore import QUIT, TIE, WIN, StatsStore
+
+if TYPE_CHECKING:
+    # Only needed for annotations, importing telegram takes a good part of a second
+    from telegram import InlineKeyboardMarkup, Update, Bot, CallbackQuery
+    from telegram.ext import CallbackContext
 
 P1, P2, P1_LAST, P2_LAST, P1_WIN, P2_WIN, BLANK = range(7)
-emoji_map = {P1: emojize(":red_circle:", use_aliases=True),
-             P2: emojize(":large_blue_circle:", use_aliases=True),
-             P1_LAST: emojize(":red_square:", use_aliases=True),
-             P2_LAST: emojize(":blue_square:", use_aliases=True),
-             P1_WIN: emojize(":fire:", use_aliases=True),
-             P2_WIN: emojize(":cyclone:", use_aliases=True),
-             BLANK: emojize(":white_circle:", use_aliases=True)}
+emoji_map = {P1: CHIP_GLYPHS[Connect4.P1],
+             P2: CHIP_GLYPHS[Connect4.P2],
+             P1_LAST: CHIP_GLYPHS[Connect4.P1_LAST],
+             P2_LAST: CHIP_GLYPHS[Connect4.P2_LAST],
+             P1_WIN: CHIP_GLYPHS[Connect4.P1_WIN],
+             P2_WIN: CHIP_GLYPHS[Connect4.P2_WIN],
+             BLANK: CHIP_GLYPHS[Connect4.BLANK]}
+
+# Player id of the built-in AI opponent, Telegram user ids are positive
+AI_ID = -1
+AI_NAME = 'Connect4Bot'
+
+# Handler durations, and the time spent in each phase of handling an update
+HANDLER_SECONDS = 'connect4_handler_seconds'
+PHASE_SECONDS = 'connect4_phase_seconds'
+
+# What a change of a game asks to be sent: a message to the chat, the message
+# with the board (which becomes the game's message), an edit of the board
+# `message` or the answer to the callback query being handled
+SEND, SEND_BOARD, EDIT_BOARD, ANSWER = range(4)
+Reply = namedtuple('Reply', ['kind', 'text', 'reply_markup', 'message'], defaults=(None, None, None))
+
+# Longest a game's lock is held waiting for the outbound queue to send its board
+BOARD_TIMEOUT_SEC = 20
+BOARD_FAILED_TEXT = 'The board could not be sent, so the game was reset. Use /start_game to try again.'
+
+# Rows, columns and chips in a row to win of a game started without options
+DEFAULT_SHAPE = (6, 7, 4)
+# Smallest and largest number of rows or columns /start_game accepts, the
+# largest boards still fit a phone screen
+MIN_SIDE, MAX_SIDE = 4, 12
+# Telegram shows at most 8 buttons in a row of an inline keyboard
+MAX_BUTTONS_PER_ROW = 8
+
+# Label of the button of a full column
+FULL_COLUMN = '\u2716'
+
+_inline_markups = {}
+
+
+def get_inline_markup(cols: int, full: tuple = ()) -> InlineKeyboardMarkup:
+    """ Returns the column keyboard shared by every game `cols` wide whose
+    `full` (1-indexed) columns are full. Wide boards get their buttons split
+    evenly over as few rows as Telegram allows.
+    """
+    key = (cols, full)
+    markup = _inline_markups.get(key)
+    if markup is None:
+        from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+        buttons = [InlineKeyboardButton(FULL_COLUMN if col in full else str(col), callback_data=str(col))
+                   for col in range(1, cols + 1)]
+        lines = -(-cols // MAX_BUTTONS_PER_ROW)
+        per_line = -(-cols // lines)
+        keyboard = tuple(tuple(buttons[start:start + per_line]) for start in range(0, cols, per_line))
+        markup = _inline_markups.setdefault(key, InlineKeyboardMarkup(keyboard))
+    return markup
+
+
+def parse_shape(args) -> tuple:
+    """ Returns (rows, cols, in_a_row) of the /start_game options, e.g.
+    '8x9', '5' (in a row) or '10x12 5', the standard board for none.
+
+    Raises
+    ------
+    ValueError
+        With a message for the user, if the options aren't a valid board.
+    """
+    rows, cols, in_a_row = DEFAULT_SHAPE
+    for arg in args:
+        size = re.fullmatch(r'(\d+)x(\d+)', arg.lower())
+        length = re.fullmatch(r'(\d+)(-in-a-row)?', arg.lower())
+        if size:
+            rows, cols = int(size.group(1)), int(size.group(2))
+        elif length:
+            in_a_row = int(length.group(1))
+        else:
+            raise ValueError('{} is not a board option. Try /start_game 8x9, /start_game 5 (in a row) or '
+                             '/start_game 10x12 5.'.format(arg))
+    if not (MIN_SIDE <= rows <= MAX_SIDE and MIN_SIDE <= cols <= MAX_SIDE):
+        raise ValueError('Boards have {} to {} rows and columns.'.format(MIN_SIDE, MAX_SIDE))
+    if not 3 <= in_a_row <= max(rows, cols):
+        raise ValueError('A {}x{} board can be won with 3 to {} chips in a row.'.format(rows, cols, max(rows, cols)))
+    return rows, cols, in_a_row
+
+
+def _locked(method):
+    """ Runs the method holding the game's lock, so that updates of one game
+    are handled one at a time while other games proceed in parallel.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
 
 
 class Connect4Bot(object):
+    """ One game of Connect 4 in a chat, driven by the handlers of its commands
+    and board clicks.
+
+    Each handler changes the game through a method which returns the Replies
+    to send, and then sends them. The methods changing the game never talk to
+    Telegram themselves, so AsyncConnect4Bot shares them and only sends the
+    replies differently.
+    """
+    __slots__ = ('game', 'scheduler', 'outbox', 'lock', 'setupHasStarted', 'gameHasStarted', 'p_cur',
+                 'game_message', 'reminder', 'ai_difficulty', 'ai_generation', 'ai_request', 'on_change', 'stats',
+                 'started_at', 'p_set', 'p_id', 'p_name')
 
     def __init__(self,
-                 game: Connect4):
+                 game: Connect4,
+                 scheduler: ReminderScheduler = None,
+                 outbox: OutboundQueue = None,
+                 stats: StatsStore = None):
         # Universal Values
         self.game = game
+        self.scheduler = scheduler
+        self.outbox = outbox
+        # Store finished games are recorded in, if any
+        self.stats = stats
+        # Held by every handler, AI move and reminder of this game. Reentrant,
+        # as GameManager holds it around handlers to update its indexes
+        self.lock = threading.RLock()
         self.setupHasStarted = False
         self.gameHasStarted = False
         self.p_cur = P1  # Player 1 goes first
         self.game_message = None
+        self.reminder = None
+        # When the game started, unknown for restored games
+        self.started_at = None
+        # AI opponent values
+        self.ai_difficulty = None
+        self.ai_generation = 0
+        self.ai_request = None
+        # Called with this game after changes made outside of a handler
+        self.on_change = None
         # Player values
         self.p_set = [False, False]
         self.p_id = [0, 0]
         self.p_name = ['', '']
-        # Keyboard Markup
-        custom_keyboard = [[InlineKeyboardButton('1', callback_data='1'),
-                            InlineKeyboardButton('2', callback_data='2'),
-                            InlineKeyboardButton('3', callback_data='3'),
-                            InlineKeyboardButton('4', callback_data='4'),
-                            InlineKeyboardButton('5', callback_data='5'),
-                            InlineKeyboardButton('6', callback_data='6'),
-                            InlineKeyboardButton('7', callback_data='7')]]
-        self.inline_markup = InlineKeyboardMarkup(custom_keyboard)
+
+    @property
+    def inline_markup(self) -> InlineKeyboardMarkup:
+        """ Column keyboard for this game's board width, with its full columns
+        marked, shared between games.
+        """
+        full = tuple(col for col, row in enumerate(self.game.bottom, 1) if row < 0)
+        return get_inline_markup(self.game.cols, full)
 
     # /start_game
+    @timed(HANDLER_SECONDS, handler='start_game')
+    @_locked
     def start_game(self,
                    update: Update,
                    context: CallbackContext):
-
-        chat_id = update.message.chat_id
-        text = ''
-
-        # Setup has yet to begin
-        if not self.setupHasStarted:
-            self.setupHasStarted = True
-            text = ("~~~~ Welcome to Connect 4! ~~~~\n" +
-                    "Player 1, please select /p1\n" +
-                    "Player 2, please select /p2")
-        # Setup has begun, but a player still needs to be set
-        elif not self.gameHasStarted:
-            if not (self.p_set[P1]):
-                text = r'Player 1 still needs to be set. Use /p1 to do so.'
-            elif not (self.p_set[P2]):
-                text = r'Player 2 still needs to be set. Use /p2 to do so.'
-        # Game has started
-        else:
-            text = 'The game has already started silly goose!'
-
-        context.bot.send_message(chat_id=chat_id, text=text)
+        self._send(context.bot, update.message.chat_id, [Reply(SEND, self._start_game_text(context.args))])
 
     # /p1
+    @timed(HANDLER_SECONDS, handler='p1')
+    @_locked
     def p1(self,
            update: Update,
            context: CallbackContext):
-
-        bot = context.bot
         chat_id = update.message.chat_id
-        user = update.message.from_user
-
-        # Player 1 has yet to be set
-        if not self.setupHasStarted or (self.setupHasStarted and not (self.p_set[P1])):
-            self.setupHasStarted = True
-            self.p_set[P1] = True
-            self.p_id[P1] = user.id
-            self.p_name[P1] = user.first_name
-            text = '{} has been set as Player 1. {}'.format(self.p_name[P1], emoji_map[P1])
-            bot.send_message(chat_id=chat_id, text=text)
-            lg.info(text)
-        # Player 1 is set but game has not started
-        elif self.p_set[P1] and not self.gameHasStarted:
-            text = '{} is already Player 1!'.format(self.p_name[P1])
-            bot.send_message(chat_id=chat_id, text=text)
-
-        # If both players are set, start the game!
-        if self.p_set[P2] and not self.gameHasStarted:
-            self._start_for_real(bot, chat_id)
+        self._send(context.bot, chat_id, self._set_player(context.bot, chat_id, update.message.from_user, P1))
 
     # /p2
+    @timed(HANDLER_SECONDS, handler='p2')
+    @_locked
     def p2(self,
            update: Update,
            context: CallbackContext):
-
-        bot = context.bot
         chat_id = update.message.chat_id
-        user = update.message.from_user
-
-        # Player 2 has yet to be set
-        if not self.setupHasStarted or (self.setupHasStarted and not (self.p_set[P2])):
-            self.setupHasStarted = True
-            self.p_set[P2] = True
-            self.p_id[P2] = user.id
-            self.p_name[P2] = user.first_name
-            text = '{} has been set as Player 2. {}'.format(self.p_name[P2], emoji_map[P2])
-            bot.send_message(chat_id=chat_id, text=text)
-            lg.info(text)
-        # Player 2 is set but game has not started
-        elif self.p_set[P2] and not self.gameHasStarted:
-            text = '{} is already Player 2!'.format(self.p_name[P2])
-            bot.send_message(chat_id=chat_id, text=text)
-
-        # If both players are set, start the game!
-        if self.p_set[P1] and not self.gameHasStarted:
-            self._start_for_real(bot, chat_id)
+        self._send(context.bot, chat_id, self._set_player(context.bot, chat_id, update.message.from_user, P2))
+
+    # /vs_bot
+    @timed(HANDLER_SECONDS, handler='vs_bot')
+    @_locked
+    def vs_bot(self,
+               update: Update,
+               context: CallbackContext):
+        chat_id = update.message.chat_id
+        self._send(context.bot, chat_id, self._vs_bot(context.bot, chat_id, update.message.from_user, context.args))
 
     # /quit
+    @timed(HANDLER_SECONDS, handler='quit')
+    @_locked
     def quit(self,
              update: Update,
              context: CallbackContext):
+        self._send(context.bot, update.message.chat_id, self._quit(update.message.from_user.id))
 
-        bot = context.bot
-        chat_id = update.message.chat_id
-        user_id = update.message.from_user.id
+    # /hint
+    @timed(HANDLER_SECONDS, handler='hint')
+    @_locked
+    def hint(self,
+             update: Update,
+             context: CallbackContext):
+        self._send(context.bot, update.message.chat_id, [Reply(SEND, self._hint())])
+
+    # /undo
+    @timed(HANDLER_SECONDS, handler='undo')
+    @_locked
+    def undo(self,
+             update: Update,
+             context: CallbackContext):
+        self._send(context.bot, update.message.chat_id, self._undo(context.bot, update.message.from_user))
+
+    # /replay [moves]
+    @timed(HANDLER_SECONDS, handler='replay')
+    @_locked
+    def replay(self,
+               update: Update,
+               context: CallbackContext):
+        self._send(context.bot, update.message.chat_id,
+                   self._replay(context.bot, update.message.from_user, context.args))
 
+    # Player Actions
+
+    @timed(HANDLER_SECONDS, handler='place_chip')
+    @_locked
+    def place_chip(self,
+                   update: Update,
+                   context: CallbackContext):
+        query = update.callback_query
+        chat_id = query.message.chat_id if query.message is not None else None
+        self._send(context.bot, chat_id, self._click(context.bot, query.from_user, query.data), query)
+
+    # Game Changes, returning the replies to send
+
+    def _start_game_text(self, args) -> str:
+        """ Moves setup along for /start_game, setting up the board its
+        options ask for, and returns the reply.
+        """
+        if self.gameHasStarted:
+            return 'The game has already started silly goose!'
+
+        # Without options, a game already being set up keeps its board
+        if args or not self.setupHasStarted:
+            try:
+                shape = parse_shape(args)
+            except ValueError as e:
+                return str(e)
+            if shape != (self.game.rows, self.game.cols, self.game.in_a_row):
+                self.game = type(self.game)(*shape)
+        board = '' if self.game.rows == DEFAULT_SHAPE[0] and self.game.cols == DEFAULT_SHAPE[1] else \
+            '{}x{} board, '.format(self.game.rows, self.game.cols)
+        board += '{} in a row to win'.format(self.game.in_a_row)
+
+        # Setup has yet to begin
         if not self.setupHasStarted:
-            text = ("You can't quit a game that hasn't even started yet...\n" +
-                    'Use /start_game to begin setup.')
-            bot.send_message(chat_id=chat_id, text=text)
+            self.setupHasStarted = True
+            return ("~~~~ Welcome to Connect 4! ~~~~\n" +
+                    "({})\n".format(board) +
+                    "Player 1, please select /p1\n" +
+                    "Player 2, please select /p2")
+        # Setup has begun, but a player still needs to be set
+        if not (self.p_set[P1]):
+            return 'Player 1 still needs to be set ({}). Use /p1 to do so.'.format(board)
+        return 'Player 2 still needs to be set ({}). Use /p2 to do so.'.format(board)
+
+    def _set_player(self,
+                    bot: Bot,
+                    chat_id: Union[int, str],
+                    user,
+                    player: int) -> list:
+        """ Sets the user as `player` (P1 or P2) for /p1 and /p2, starting the
+        game once both players are set.
+        """
+        replies = []
+        # Player has yet to be set
+        if not self.setupHasStarted or not self.p_set[player]:
+            self.setupHasStarted = True
+            self.p_set[player] = True
+            self.p_id[player] = user.id
+            self.p_name[player] = user.first_name
+            text = '{} has been set as Player {}. {}'.format(self.p_name[player], player + 1, emoji_map[player])
+            replies.append(Reply(SEND, text))
+            lg.info(text)
+        # Player is set but game has not started
         elif not self.gameHasStarted:
-            text = 'Resetting setup. Please wait for completion.'
-            bot.send_message(chat_id=chat_id, text=text)
-            self._reset_game()
-            text = 'Reset complete.'
-            bot.send_message(chat_id=chat_id, text=text)
-        elif self.p_id[P1] == user_id:
-            text = '{} is a quitter! {} wins!\n{}'.format(
-                self.p_name[P1],
-                self.p_name[P2],
-                _board_to_emojis(self.game.board)
-            )
-            bot.edit_message_text(chat_id=chat_id, text=text, message_id=self.game_message.message_id)
-            self._reset_game()
-        elif self.p_id[P2] == user_id:
-            text = '{} is a quitter! {} wins!\n{}'.format(
-                self.p_name[P2],
-                self.p_name[P1],
-                _board_to_emojis(self.game.board)
-            )
-            bot.edit_message_text(chat_id=chat_id, text=text, message_id=self.game_message.message_id)
-            self._reset_game()
+            replies.append(Reply(SEND, '{} is already Player {}!'.format(self.p_name[player], player + 1)))
 
-    # Command Helpers
+        # If both players are set, start the game!
+        if self.p_set[1 - player] and not self.gameHasStarted:
+            replies.extend(self._start_for_real(bot, chat_id))
+        return replies
+
+    def _vs_bot(self,
+                bot: Bot,
+                chat_id: Union[int, str],
+                user,
+                args) -> list:
+        """ Sets the bot up as Player 2 for /vs_bot, and the user as Player 1
+        if nobody is yet, then starts the game.
+        """
+        difficulty = args[0].lower() if args else DEFAULT_DIFFICULTY
+        if difficulty not in DIFFICULTIES:
+            return [Reply(SEND, 'Difficulty must be one of: {}.'.format(', '.join(DIFFICULTIES)))]
+        if self.gameHasStarted:
+            return [Reply(SEND, 'The game has already started silly goose!')]
+        if self.p_set[P2]:
+            return [Reply(SEND, '{} is already Player 2!'.format(self.p_name[P2]))]
+
+        replies = []
+        self.setupHasStarted = True
+        if not self.p_set[P1]:
+            self.p_set[P1] = True
+            self.p_id[P1] = user.id
+            self.p_name[P1] = user.first_name
+            text = '{} has been set as Player 1. {}'.format(self.p_name[P1], emoji_map[P1])
+            replies.append(Reply(SEND, text))
+            lg.info(text)
+        self.p_set[P2] = True
+        self.p_id[P2] = AI_ID
+        self.p_name[P2] = AI_NAME
+        self.ai_difficulty = difficulty
+        text = '{} ({}) has been set as Player 2. {}'.format(AI_NAME, difficulty, emoji_map[P2])
+        replies.append(Reply(SEND, text))
+        lg.info(text)
+
+        replies.extend(self._start_for_real(bot, chat_id))
+        return replies
+
+    def _quit(self,
+              user_id: int) -> list:
+        """ Resets the game for /quit, the other player winning if it had
+        started and the user was playing.
+        """
+        if not self.setupHasStarted:
+            return [Reply(SEND, "You can't quit a game that hasn't even started yet...\n" +
+                          'Use /start_game to begin setup.')]
+        if not self.gameHasStarted:
+            self._reset_game()
+            return [Reply(SEND, 'Resetting setup. Please wait for completion.'), Reply(SEND, 'Reset complete.')]
+        if user_id not in self.p_id:
+            return []
+        quitter = P1 if self.p_id[P1] == user_id else P2
+        text = '{} is a quitter! {} wins!\n{}'.format(self.p_name[quitter], self.p_name[1 - quitter],
+                                                      _board_to_emojis(self.game.board))
+        replies = [self._board_reply(text)]
+        self._record_result(1 - quitter, QUIT)
+        self._reset_game()
+        return replies
+
+    def _hint(self) -> str:
+        """ Advice for /hint to the player about to move. """
+        if not self.gameHasStarted:
+            return 'There is no game to give hints for. Use /start_game to begin setup.'
+        return _hint_text(self.game.analyze(self.p_cur + 1), self.p_cur, self.p_name[self.p_cur],
+                          self.p_name[1 - self.p_cur])
+
+    def _undo(self,
+              bot: Bot,
+              user) -> list:
+        """ Takes back the last move for /undo, if the user made it, and the
+        bot's answer to it too when playing against the bot.
+        """
+        if not self.gameHasStarted:
+            return [Reply(SEND, 'There is no game to undo moves in. Use /start_game to begin setup.')]
+        if user.id not in self.p_id:
+            return [Reply(SEND, 'Only the players can take back moves!')]
+        if not self.game.history:
+            return [Reply(SEND, 'There are no moves to take back!')]
+        # Against the bot its player may always take back, otherwise only the player who moved last
+        last = 1 - self.p_cur
+        if AI_ID not in self.p_id and user.id != self.p_id[last]:
+            return [Reply(SEND, 'Only {}, who made the last move, can take it back!'.format(self.p_name[last]))]
+
+        self._cancel_ai_move()
+        # Against the bot, its answer goes too, so it's the player's turn again
+        while self.game.undo():
+            self._next_player()
+            if self.p_id[self.p_cur] != AI_ID:
+                break
+        text = '{} took back a move. {}\'s turn!\n{}'.format(user.first_name, self.p_name[self.p_cur],
+                                                             _board_to_emojis(self.game.board))
+        return [self._board_reply(text, self.inline_markup)] + self._next_turn(bot)
+
+    def _replay(self,
+                bot: Bot,
+                user,
+                args) -> list:
+        """ Shows the moves so far for /replay, or sets the game up at the
+        position the moves given lead to.
+        """
+        if not self.gameHasStarted:
+            return [Reply(SEND, 'There is no game to replay moves in. Use /start_game to begin setup.')]
+        if not args:
+            return [Reply(SEND, 'Moves so far: {}\nUse /replay <moves> to set this game up at another '
+                                'position.'.format(self.game.moves or 'none'))]
+        if user.id not in self.p_id:
+            return [Reply(SEND, 'Only the players can set up a position!')]
+
+        moves = args[0]
+        game = type(self.game)(self.game.rows, self.game.cols, self.game.in_a_row)
+        try:
+            res = game.replay(moves)
+        except ValueError:
+            res = Connect4.BAD_MOVE
+        if res == Connect4.BAD_MOVE:
+            return [Reply(SEND, '{} is not a valid list of moves, e.g. /replay 4453'.format(moves))]
+        if res != Connect4.GOOD_MOVE:
+            return [Reply(SEND, 'That game is already over!')]
+
+        self._cancel_ai_move()
+        self.game = game
+        self.p_cur = P1 if len(moves) % 2 == 0 else P2
+        text = '{} set up the game. {}\'s turn!\n{}'.format(user.first_name, self.p_name[self.p_cur],
+                                                            _board_to_emojis(self.game.board))
+        return [self._board_reply(text, self.inline_markup)] + self._next_turn(bot)
+
+    def _click(self,
+               bot: Bot,
+               user,
+               data: str) -> list:
+        """ Plays the column clicked on the board, if it is the user's turn.
+        The first reply is always the answer to the click.
+        """
+        col = int(data) if data.isdigit() and 1 <= int(data) <= self.game.cols else None
+        if col is None or not self.gameHasStarted:
+            return [Reply(ANSWER)]
+        if self.p_id[self.p_cur] != user.id:
+            with get_registry().timer(PHASE_SECONDS, phase='render'):
+                emoji_board = _board_to_emojis(self.game.board)
+            text = '{}, it\'s not your turn!\n{}'.format(user.first_name, emoji_board)
+            return [Reply(ANSWER), self._board_reply(text, self.inline_markup)]
+        if self.game.bottom[col - 1] < 0:
+            # Clicks on a full column only get a notification, the board stays as is
+            get_registry().counter('connect4_full_column_clicks_total', help='Clicks on a full column').inc()
+            return [Reply(ANSWER, 'Column {} is full, pick another one!'.format(col))]
+        return [Reply(ANSWER)] + self._move(bot, col)
 
     def _start_for_real(self,
                         bot: Bot,
-                        chat_id: Union[int, str]):
+                        chat_id: Union[int, str]) -> list:
         lg.info('Starting game! Chat_id=%d', chat_id)
         self.gameHasStarted = True
-
-        text = 'Let the games begin!'
-        bot.send_message(chat_id=chat_id, text=text)
-
-        text = '{}\'s turn!\n{}'.format(self.p_name[P1], _board_to_emojis(self.game.board))
-        self.game_message = bot.send_message(chat_id=chat_id, text=text, reply_markup=self.inline_markup)
+        self.started_at = t.current_milli_time()
 
         # Start Reminder
-        lg.debug('Reminder Thread - Initializing')
-        self.reminder = Reminder(bot, chat_id, self.p_name[P1], self.p_name[P2])
-        self.reminder_thread = threading.Thread(target=self.reminder.reminder_thread, daemon=True)
+        self.reminder = self._new_reminder(bot, chat_id)
         self.reminder.new_turn(P1)
-        self.reminder_thread.start()
-        lg.debug('Reminder Thread - Kick off logic complete')
 
+        text = '{}\'s turn!\n{}'.format(self.p_name[P1], _board_to_emojis(self.game.board))
+        return [Reply(SEND, 'Let the games begin!'), Reply(SEND_BOARD, text, self.inline_markup)]
+
+    def _move(self,
+              bot: Bot,
+              col: int) -> list:
+        """ Plays the current player's chip in the 1-indexed column. """
+        metrics = get_registry()
+        with metrics.timer(PHASE_SECONDS, phase='logic'):
+            res = self.game.place_chip(self.p_cur + 1, col)
+        with metrics.timer(PHASE_SECONDS, phase='render'):
+            emoji_board = _board_to_emojis(self.game.board)
+        if res == -1:
+            metrics.counter('connect4_bad_moves_total', help='Moves into a full or missing column').inc()
+        else:
+            metrics.counter('connect4_moves_total', help='Chips placed').inc()
+
+        if res == -1:
+            text = 'You can\'t place a chip there! Try again.\n{}'.format(emoji_board)
+            return [self._board_reply(text, self.inline_markup)] + self._next_turn(bot)
+        elif res == 0:
+            self._next_player()
+            text = '{}\'s turn!\n{}'.format(self.p_name[self.p_cur], emoji_board)
+            return [self._board_reply(text, self.inline_markup)] + self._next_turn(bot)
+        elif res == 1:
+            metrics.counter('connect4_wins_total', help='Games won').inc()
+            replies = [self._board_reply('{} wins!\n{}'.format(self.p_name[self.p_cur], emoji_board))]
+            self._record_result(self.p_cur, WIN)
+        else:
+            metrics.counter('connect4_ties_total', help='Games tied').inc()
+            replies = [self._board_reply('Well... it\'s a tie... good job... I guess.\n{}'.format(emoji_board))]
+            self._record_result(None, TIE)
+        self._reset_game()
+        return replies
+
+    def _next_turn(self,
+                   bot: Bot) -> list:
+        """ Starts the turn of the current player: the AI's search, or a reminder. """
+        if self.p_id[self.p_cur] == AI_ID:
+            self.reminder.cancel()
+            return self._start_ai_turn(bot)
+        self.reminder.new_turn(self.p_cur)
+        return []
+
+    def _start_ai_turn(self,
+                       bot: Bot) -> list:
+        """ Plays the AI's move from the opening book, or searches for it in
+        the search pool and plays it once found. When the pool is full, the
+        player's move is taken back instead.
+        """
+        max_depth, time_limit = DIFFICULTIES[self.ai_difficulty]
+        position = pack_position(self.game, self.p_cur + 1)
+        generation = self.ai_generation
+
+        if self.ai_difficulty in BOOK_DIFFICULTIES:
+            rows, cols, in_a_row, p1_bits, p2_bits, heights, _ = position
+            col = book_move(rows, cols, in_a_row, p1_bits, p2_bits, heights)
+            if col is not None:
+                get_registry().counter('connect4_book_moves_total', help='AI moves played from the opening book').inc()
+                return self._ai_move(bot, generation, col)
+
+        self.ai_request = get_default_pool().submit(position, max_depth, time_limit,
+                                                    self._ai_callback(bot, generation))
+        if self.ai_request is None:
+            # Pool is saturated. Searching here would hold the game's lock for the whole
+            # search, so the player's move is taken back for them to play again later
+            lg.warning('Search pool full, taking back the move before the AI\'s turn')
+            get_registry().counter('connect4_ai_busy_total', help='AI turns refused as the search pool was full').inc()
+            if self.game.undo():
+                self._next_player()
+            self.reminder.new_turn(self.p_cur)
+            text = '{} is busy, please play your move again in a moment.\n{}'.format(
+                AI_NAME, _board_to_emojis(self.game.board))
+            return [self._board_reply(text, self.inline_markup)]
+        return []
+
+    def _ai_move(self,
+                 bot: Bot,
+                 generation: int,
+                 col: int) -> list:
+        """ Plays the column the AI picked on turn `generation`. """
+        if generation != self.ai_generation or not self.gameHasStarted:
+            # The game was quit or reset while the AI was thinking
+            return []
+        self.ai_request = None
+        if col is None:
+            # Search missed its deadline, fall back to a shallow one
+            max_depth, time_limit = DIFFICULTIES['easy']
+            col = search_packed(pack_position(self.game, self.p_cur + 1), max_depth, time_limit)
+        return self._move(bot, col)
+
+    @_locked
     def _reset_game(self):
         lg.info('Resetting game.')
         self.game.reset()
@@ -188,108 +568,167 @@ class Connect4Bot(object):
         self.gameHasStarted = False
         self.p_cur = P1
         self.game_message = None
+        self.started_at = None
 
         self.p_set = [False, False]
         self.p_id = [0, 0]
         self.p_name = ['', '']
+        self.ai_difficulty = None
+        self._cancel_ai_move()
 
-        lg.debug('Stopping reminder thread')
-        self.reminder.alive = False
-        self.reminder_thread.join(self.reminder.pause_sec)
+        if self.reminder is not None:
+            lg.debug('Cancelling reminder')
+            self.reminder.cancel()
+            self.reminder = None
         lg.info('Reset complete.')
 
-    # Player Actions
-
-    def place_chip(self,
-                   update: Update,
-                   context: CallbackContext):
-
-        query = update.callback_query
-        query.answer()
-
-        inline_text = query.data
-
-        user = query.from_user
-        user_id = user.id
-
-        if inline_text.isdigit() and 1 <= int(inline_text) <= 7:
-            if self.gameHasStarted:
-                if ((self.p_cur == P1 and not (self.p_id[P1] == user_id)) or
-                        (self.p_cur == P2 and not (self.p_id[P2] == user_id))):
-                    new_text = '{}, it\'s not your turn!\n{}'.format(user.first_name, _board_to_emojis(self.game.board))
-                    query.edit_message_text(text=new_text, reply_markup=self.inline_markup)
+    # Sending, the only parts AsyncConnect4Bot replaces
+
+    def _send(self,
+              bot: Bot,
+              chat_id: Union[int, str],
+              replies: list,
+              query: CallbackQuery = None):
+        """ Sends the replies in order, through the outbound queue if there is
+        one. Answers go to `query`, the callback query being handled.
+        """
+        sender = self._sender(bot)
+        for reply in replies:
+            if reply.kind == EDIT_BOARD:
+                self._edit_board(query, bot, reply.message, reply.text, reply.reply_markup)
+                continue
+            with get_registry().timer(PHASE_SECONDS, phase='api'):
+                if reply.kind == ANSWER:
+                    query.answer(text=reply.text)
+                elif reply.kind == SEND_BOARD:
+                    try:
+                        message = sender.send_message(chat_id=chat_id, text=reply.text,
+                                                      reply_markup=reply.reply_markup)
+                        if self.outbox is not None:
+                            # Wait for the board to be sent, callbacks are routed by its message id
+                            message = message.result(timeout=BOARD_TIMEOUT_SEC)
+                    except Exception as e:
+                        # Without a board nobody can play, so the game is called off
+                        lg.error('Sending the board to chat_id=%s failed (%s), resetting the game', chat_id, e)
+                        self._reset_game()
+                        sender.send_message(chat_id=chat_id, text=BOARD_FAILED_TEXT)
+                        return
+                    self.game_message = message
                 else:
-                    self._handle_move(query, int(inline_text))
+                    sender.send_message(chat_id=chat_id, text=reply.text)
+
+    def _edit_board(self,
+                    query: CallbackQuery,
+                    bot: Bot,
+                    message,
+                    text: str,
+                    reply_markup: InlineKeyboardMarkup = None):
+        """ Edits the board message, through the query that clicked it if there
+        is one (there is none for AI moves).
+        """
+        with get_registry().timer(PHASE_SECONDS, phase='api'):
+            if self.outbox is None and query is not None:
+                query.edit_message_text(text=text, reply_markup=reply_markup)
+            else:
+                # Queued edits of the same board are coalesced into the latest one
+                sender = self._sender(bot)
+                sender.edit_message_text(chat_id=message.chat_id, message_id=message.message_id, text=text,
+                                         reply_markup=reply_markup)
+
+    def _new_reminder(self,
+                      bot: Bot,
+                      chat_id: Union[int, str]) -> Reminder:
+        return Reminder(self._sender(bot), chat_id, self.p_name[P1], self.p_name[P2], scheduler=self.scheduler,
+                        lock=self.lock)
+
+    def _ai_callback(self,
+                     bot: Bot,
+                     generation: int):
+        """ Returns the function the search pool calls with the AI's move. """
+        return lambda col: self._play_ai_move(bot, generation, col)
+
+    @_locked
+    def _play_ai_move(self,
+                      bot: Bot,
+                      generation: int,
+                      col: int):
+        """ Plays the AI's move once the search pool found it. """
+        message = self.game_message
+        replies = self._ai_move(bot, generation, col)
+        if replies:
+            self._send(bot, message.chat_id, replies)
+        # No handler follows, so tell the manager, which drops the game if this move ended it
+        if self.on_change is not None:
+            self.on_change(self)
+
+    @_locked
+    def _resume(self,
+                bot: Bot):
+        """ Restarts the reminder, or the AI's turn, of a restored game. """
+        chat_id = self.game_message.chat_id
+        self.reminder = self._new_reminder(bot, chat_id)
+        self._send(bot, chat_id, self._next_turn(bot))
 
     # Helpers
 
+    def _board_reply(self,
+                     text: str,
+                     reply_markup: InlineKeyboardMarkup = None) -> Reply:
+        """ Reply editing the game's board as it is now. """
+        return Reply(EDIT_BOARD, text, reply_markup, self.game_message)
+
+    def _record_result(self,
+                       winner: int,
+                       outcome: int):
+        """ Queues the finished game in the stats store, if there is one.
+        `winner` is P1, P2 or None for a tie.
+        """
+        if self.stats is not None:
+            # The reminder's chat, as an async game's board may still be on its way
+            self.stats.add(self.reminder.chat_id, self.p_id, self.p_name, winner, outcome, self.game.moves,
+                           self.started_at)
+
+    def _cancel_ai_move(self):
+        """ Drops the result of any AI search still running. """
+        self.ai_generation += 1
+        if self.ai_request is not None:
+            self.ai_request.cancel()
+            self.ai_request = None
+
     def _next_player(self):
         if self.p_cur == P1:
             self.p_cur = P2
         elif self.p_cur == P2:
             self.p_cur = P1
 
-    def _handle_move(self,
-                     query: CallbackQuery,
-                     col: int):
+    def _sender(self, bot: Bot):
+        """ Returns what outgoing messages should be sent through: the
+        outbound queue if there is one, otherwise the bot itself.
+        """
+        return bot if self.outbox is None else self.outbox
 
-        res = self.game.place_chip(self.p_cur + 1, col)
-        emoji_board = _board_to_emojis(self.game.board)
 
-        if res == -1:
-            text = 'You can\'t place a chip there! Try again.\n{}'.format(emoji_board)
-            query.edit_message_text(text=text, reply_markup=self.inline_markup)
-            self.reminder.new_turn(self.p_cur)
-        elif res == 0:
-            self._next_player()
-            text = '{}\'s turn!\n{}'.format(self.p_name[self.p_cur], emoji_board)
-            query.edit_message_text(text=text, reply_markup=self.inline_markup)
-            self.reminder.new_turn(self.p_cur)
-        elif res == 1:
-            text = '{} wins!\n{}'.format(self.p_name[self.p_cur], emoji_board)
-            query.edit_message_text(text=text)
-            self._reset_game()
-        else:
-            text = 'Well... it\'s a tie... good job... I guess.\n{}'.format(emoji_board)
-            query.edit_message_text(text=text)
-            self._reset_game()
+def _hint_text(analysis, player, name, opponent_name):
+    """ Advice for `player` (P1 or P2), who is about to move, from the
+    result of Connect4.analyze.
+    """
+    legal, wins, unsafe = analysis
+
+    def columns(cols):
+        return ', '.join(str(col) for col in cols)
+
+    if wins[player]:
+        return '{}, you can win in column {}!'.format(name, columns(wins[player]))
+    if wins[1 - player]:
+        return '{}, block column {} or {} wins!'.format(name, columns(wins[1 - player]), opponent_name)
+    safe = [col for col in legal if col not in unsafe]
+    if not safe:
+        return '{}, every column lets {} win next turn, good luck!'.format(name, opponent_name)
+    text = '{}, safe columns: {}.'.format(name, columns(safe))
+    if unsafe:
+        text += ' Avoid {}, {} could win on top of it.'.format(columns(unsafe), opponent_name)
+    return text
 
 
 def _board_to_emojis(board):
-    # Column Headers
-    headers = emojize(":keycap_1: :keycap_2: :keycap_3: :keycap_4: :keycap_5: :keycap_6: :keycap_7:",
-                      use_aliases=True)
-
-    p1_chip = emoji_map[P1]
-    p2_chip = emoji_map[P2]
-    p1_last_chip = emoji_map[P1_LAST]
-    p2_last_chip = emoji_map[P2_LAST]
-    p1_win_chip = emoji_map[P1_WIN]
-    p2_win_chip = emoji_map[P2_WIN]
-    blank = emoji_map[BLANK]
-
-    res = headers + '\n'
-
-    for row in board:
-        r = ''
-        for entry in row:
-            if entry == Connect4.BLANK:
-                r += blank + ' '
-            elif entry == Connect4.P1:
-                r += p1_chip + ' '
-            elif entry == Connect4.P2:
-                r += p2_chip + ' '
-            elif entry == Connect4.P1_LAST:
-                r += p1_last_chip + ' '
-            elif entry == Connect4.P2_LAST:
-                r += p2_last_chip + ' '
-            elif entry == Connect4.P1_WIN:
-                r += p1_win_chip + ' '
-            elif entry == Connect4.P2_WIN:
-                r += p2_win_chip + ' '
-        r = r[:-1]  # Remove trailing space
-        res += r + '\n'
-
-    res += headers
-
-    return res
+    return get_renderer(len(board[0])).render(board)
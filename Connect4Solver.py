@@ -0,0 +1,350 @@
+import random
+import threading
+import time
+
+# Difficulty -> (maximum search depth in plies, time budget per move in seconds)
+DIFFICULTIES = {'easy': (2, 0.25),
+                'medium': (6, 1.0),
+                'hard': (64, 3.0)}
+DEFAULT_DIFFICULTY = 'medium'
+# Difficulties which play opening book moves where the book has one
+BOOK_DIFFICULTIES = ('medium', 'hard')
+
+WIN_SCORE = 1 << 20
+# Scores beyond this are wins (or losses) found by the search, not heuristics
+WIN_BOUND = WIN_SCORE - 4096
+
+EXACT, LOWER, UPPER = range(3)
+
+
+class _Timeout(Exception):
+    pass
+
+
+class Connect4Solver(object):
+    """ Negamax search with alpha-beta pruning for Connect4 positions of one
+    board shape.
+
+    Positions are bitboards in the BitboardConnect4 layout: each column takes
+    (rows + 1) bits, bottom row first. Moves are tried center column first,
+    after the best move remembered in a Zobrist-hashed transposition table of
+    bounded size. Searches deepen iteratively until the depth or time budget
+    runs out.
+
+    A solver keeps per-search state, so use one solver per thread
+    (see get_solver).
+    """
+
+    def __init__(self, rows=6, cols=7, in_a_row=4, tt_bits=18, seed=0x5EED):
+        """
+        Parameters
+        ----------
+        rows : int
+            Number of rows of the board.
+        cols : int
+            Number of columns of the board.
+        in_a_row : int
+            Number of chips a player needs in-a-row to win.
+        tt_bits : int
+            The transposition table holds 2 ** tt_bits entries.
+        seed : int
+            Seed for the Zobrist keys.
+        """
+        self.rows = rows
+        self.cols = cols
+        self.in_a_row = in_a_row
+        self.height = rows + 1
+        self.spaces = rows * cols
+        self.shifts = (self.height + 1, self.height, self.height - 1, 1)
+
+        rand = random.Random(seed)
+        size = self.height * cols
+        self.zobrist = ([rand.getrandbits(64) for _ in range(size)],
+                        [rand.getrandbits(64) for _ in range(size)])
+        self.zobrist_turn = rand.getrandbits(64)
+
+        # Center columns first
+        center = (cols - 1) / 2
+        self.order = sorted(range(cols), key=lambda col: abs(col - center))
+        self.windows = self._windows()
+        self.center_mask = 0
+        for col in range(cols):
+            if abs(col - center) < 1:
+                self.center_mask |= ((1 << rows) - 1) << (col * self.height)
+        # Heuristic value of a window holding k chips of one player only
+        self.weights = [0] + [4 ** k for k in range(1, in_a_row)] + [WIN_SCORE]
+
+        self.tt_mask = (1 << tt_bits) - 1
+        self.table = [None] * (1 << tt_bits)
+        self.generation = 0
+
+        # Per-search state
+        self.nodes = 0
+        self.deadline = None
+
+    def _windows(self):
+        """ Masks of every line of `in_a_row` cells on the board. """
+        windows = []
+        n = self.in_a_row
+        for col in range(self.cols):
+            for row in range(self.rows):
+                for d_col, d_row in ((1, 0), (0, 1), (1, 1), (1, -1)):
+                    end_col = col + d_col * (n - 1)
+                    end_row = row + d_row * (n - 1)
+                    if 0 <= end_col < self.cols and 0 <= end_row < self.rows:
+                        mask = 0
+                        for i in range(n):
+                            mask |= 1 << ((col + d_col * i) * self.height + row + d_row * i)
+                        windows.append(mask)
+        return windows
+
+    def _is_win(self, bits):
+        """ True if `bits` holds `in_a_row` chips in a row in any direction. """
+        n = self.in_a_row
+        for shift in self.shifts:
+            runs = bits
+            k = 1
+            while 2 * k <= n:
+                runs &= runs >> (shift * k)
+                k *= 2
+            if k < n:
+                runs &= runs >> (shift * (n - k))
+            if runs:
+                return True
+        return False
+
+    def _evaluate(self, me, opp):
+        score = 0
+        weights = self.weights
+        for window in self.windows:
+            mine = window & me
+            theirs = window & opp
+            if not theirs:
+                if mine:
+                    score += weights[bin(mine).count('1')]
+            elif not mine:
+                score -= weights[bin(theirs).count('1')]
+        score += 3 * (bin(me & self.center_mask).count('1') - bin(opp & self.center_mask).count('1'))
+        return max(-WIN_BOUND, min(WIN_BOUND, score))
+
+    def _zobrist_key(self, bits, side):
+        key = 0
+        for player in (0, 1):
+            board = bits[player]
+            while board:
+                low = board & -board
+                key ^= self.zobrist[player][low.bit_length() - 1]
+                board ^= low
+        if side:
+            key ^= self.zobrist_turn
+        return key
+
+    def best_move(self, p1_bits, p2_bits, heights, player, max_depth=None, time_limit=None):
+        """ Searches for the best column for `player` to play.
+
+        Parameters
+        ----------
+        p1_bits, p2_bits : int
+            Bitboards of each player's chips.
+        heights : list
+            Number of chips in each column.
+        player : int
+            Player to move.
+                1 = Player 1
+                2 = Player 2
+        max_depth : int
+            Maximum search depth in plies, unlimited if None.
+        time_limit : float
+            Seconds the search may take, unlimited if None.
+
+        Returns
+        -------
+        int
+            1-Indexed column to play, or 0 if the board is full.
+        """
+        heights = list(heights)
+        bits = [p1_bits, p2_bits]
+        side = player - 1
+        moves = sum(heights)
+        if max_depth is None:
+            max_depth = self.spaces
+        max_depth = min(max_depth, self.spaces - moves)
+        legal = [col for col in self.order if heights[col] < self.rows]
+        if not legal:
+            return 0
+
+        self.generation += 1
+        self.nodes = 0
+        self.deadline = None if time_limit is None else time.monotonic() + time_limit
+        key = self._zobrist_key(bits, side)
+
+        best = legal[0]
+        for depth in range(1, max_depth + 1):
+            try:
+                score, move = self._root(bits, heights, side, key, moves, depth)
+            except _Timeout:
+                break
+            best = move
+            # A forced win or loss won't change with more depth
+            if abs(score) > WIN_BOUND:
+                break
+        self.deadline = None
+        return best + 1
+
+    def _root(self, bits, heights, side, key, moves, depth):
+        alpha, beta = -WIN_SCORE, WIN_SCORE
+        best_score, best_move = -WIN_SCORE - 1, None
+        for col in self._ordered_moves(heights, key):
+            score = self._child_score(bits, heights, side, key, moves, col, depth, alpha, beta)
+            if score > best_score:
+                best_score, best_move = score, col
+            alpha = max(alpha, score)
+        self._store(key, depth, EXACT, best_score, best_move)
+        return best_score, best_move
+
+    def _ordered_moves(self, heights, key):
+        moves = [col for col in self.order if heights[col] < self.rows]
+        entry = self.table[key & self.tt_mask]
+        if entry is not None and entry[0] == key and entry[4] in moves:
+            moves.remove(entry[4])
+            moves.insert(0, entry[4])
+        return moves
+
+    def _child_score(self, bits, heights, side, key, moves, col, depth, alpha, beta):
+        """ Plays `col`, scores the position for `side` and takes the move back. """
+        bit = col * self.height + heights[col]
+        bits[side] |= 1 << bit
+        heights[col] += 1
+        try:
+            if self._is_win(bits[side]):
+                score = WIN_SCORE - 1
+            elif moves + 1 == self.spaces:
+                score = 0
+            else:
+                child_key = key ^ self.zobrist[side][bit] ^ self.zobrist_turn
+                score = -self._negamax(bits, heights, 1 - side, child_key, moves + 1, depth - 1, -beta, -alpha)
+                # Prefer quicker wins and slower losses
+                if score > WIN_BOUND:
+                    score -= 1
+                elif score < -WIN_BOUND:
+                    score += 1
+        finally:
+            bits[side] &= ~(1 << bit)
+            heights[col] -= 1
+        return score
+
+    def _negamax(self, bits, heights, side, key, moves, depth, alpha, beta):
+        self.nodes += 1
+        if self.deadline is not None and not self.nodes & 1023 and time.monotonic() > self.deadline:
+            raise _Timeout()
+
+        if depth == 0:
+            return self._evaluate(bits[side], bits[1 - side])
+
+        alpha_orig = alpha
+        entry = self.table[key & self.tt_mask]
+        if entry is not None and entry[0] == key and entry[1] >= depth:
+            value, flag = entry[3], entry[2]
+            if flag == EXACT:
+                return value
+            elif flag == LOWER:
+                alpha = max(alpha, value)
+            else:
+                beta = min(beta, value)
+            if alpha >= beta:
+                return value
+
+        best_score, best_move = -WIN_SCORE - 1, None
+        for col in self._ordered_moves(heights, key):
+            score = self._child_score(bits, heights, side, key, moves, col, depth, alpha, beta)
+            if score > best_score:
+                best_score, best_move = score, col
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        break
+
+        if best_score <= alpha_orig:
+            flag = UPPER
+        elif best_score >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        self._store(key, depth, flag, best_score, best_move)
+        return best_score
+
+    def _store(self, key, depth, flag, value, move):
+        """ Stores a search result, replacing the slot's entry if it comes from
+        an older search or was searched less deeply.
+        """
+        slot = key & self.tt_mask
+        entry = self.table[slot]
+        if entry is None or entry[5] != self.generation or depth >= entry[1]:
+            self.table[slot] = (key, depth, flag, value, move, self.generation)
+
+
+def position_from_game(game):
+    """ Returns (p1_bits, p2_bits, heights) of a Connect4 or BitboardConnect4
+    game in the bitboard layout used by Connect4Solver.
+    """
+    if hasattr(game, '_bits'):
+        return game._bits[0], game._bits[1], list(game.heights)
+    height = game.rows + 1
+    p1_states = (game.P1, game.P1_LAST, game.P1_WIN)
+    bits = [0, 0]
+    heights = [0] * game.cols
+    for row_index, row in enumerate(game.board):
+        h = game.rows - 1 - row_index
+        for col, state in enumerate(row):
+            if state != game.BLANK:
+                bits[0 if state in p1_states else 1] |= 1 << (col * height + h)
+                heights[col] = max(heights[col], h + 1)
+    return bits[0], bits[1], heights
+
+
+_local = threading.local()
+
+
+def get_solver(rows, cols, in_a_row) -> Connect4Solver:
+    """ Returns this thread's solver for the board shape. """
+    solvers = getattr(_local, 'solvers', None)
+    if solvers is None:
+        solvers = _local.solvers = {}
+    key = (rows, cols, in_a_row)
+    solver = solvers.get(key)
+    if solver is None:
+        solver = solvers[key] = Connect4Solver(rows, cols, in_a_row)
+    return solver
+
+
+def pack_position(game, player):
+    """ Compact, picklable form of the position for sending to a search
+    process: (rows, cols, in_a_row, p1_bits, p2_bits, heights, player).
+    """
+    p1_bits, p2_bits, heights = position_from_game(game)
+    return game.rows, game.cols, game.in_a_row, p1_bits, p2_bits, bytes(heights), player
+
+
+def search_packed(position, max_depth, time_limit, deadline=None):
+    """ Searches a packed position. Meant to run in a search process, where
+    the solver and its transposition table persist between requests.
+
+    Parameters
+    ----------
+    deadline : float
+        time.time() by which the answer is needed. Requests which waited in
+        the queue past it are skipped, others get at most the time left.
+
+    Returns
+    -------
+    int
+        1-Indexed column to play, or None if the deadline had passed.
+    """
+    if deadline is not None:
+        time_left = deadline - time.time()
+        if time_left <= 0:
+            return None
+        time_limit = time_left if time_limit is None else min(time_limit, time_left)
+    rows, cols, in_a_row, p1_bits, p2_bits, heights, player = position
+    solver = get_solver(rows, cols, in_a_row)
+    return solver.best_move(p1_bits, p2_bits, list(heights), player, max_depth, time_limit)
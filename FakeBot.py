@@ -0,0 +1,195 @@
+import asyncio
+import itertools
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+
+class FakeBot(object):
+    """ Local stand-in for telegram.Bot which records every call instead of
+    talking to Telegram, optionally sleeping `latency` seconds per call to
+    simulate the network round trip, and failing a share of the messages sent
+    or edited with a flood-wait (429) as Telegram does when pushed too hard.
+
+    Calls are recorded as (method, kwargs) tuples in `calls`. Calls failed
+    with a flood-wait are counted in `flood_errors` instead.
+    """
+    # Read by telegram.ext.Dispatcher and CommandHandler
+    id = 1
+    username = 'Connect4Bot'
+    defaults = None
+
+    def __init__(self, latency=0.0, flood_rate=0.0, retry_after=1.0, seed=None):
+        """
+        Parameters
+        ----------
+        latency : float or callable
+            Seconds each call takes, or a function returning them per call.
+        flood_rate : float
+            Share of send_message and edit_message_text calls raising
+            telegram.error.RetryAfter after their latency.
+        retry_after : float
+            Seconds the flood-waits ask the caller to wait.
+        seed : int
+            Seed of the flood-waits, for repeatable runs.
+        """
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.flood_errors = 0
+        self.calls = []
+        self.lock = threading.Lock()
+        self.message_ids = itertools.count(1)
+
+    def _delay(self) -> float:
+        return self.latency() if callable(self.latency) else self.latency
+
+    def _flood(self):
+        """ Raises a flood-wait for a `flood_rate` share of the calls. """
+        if self.flood_rate and self.random.random() < self.flood_rate:
+            from telegram.error import RetryAfter
+
+            with self.lock:
+                self.flood_errors += 1
+            raise RetryAfter(self.retry_after)
+
+    def _record(self, method, kwargs):
+        with self.lock:
+            self.calls.append((method, kwargs))
+
+    def _message(self, chat_id):
+        return SimpleNamespace(chat_id=chat_id, message_id=next(self.message_ids))
+
+    def send_message(self, chat_id, text, **kwargs):
+        delay = self._delay()
+        if delay:
+            time.sleep(delay)
+        self._flood()
+        self._record('send_message', dict(kwargs, chat_id=chat_id, text=text))
+        return self._message(chat_id)
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, inline_message_id=None, **kwargs):
+        delay = self._delay()
+        if delay:
+            time.sleep(delay)
+        self._flood()
+        self._record('edit_message_text', dict(kwargs, text=text, chat_id=chat_id, message_id=message_id,
+                                               inline_message_id=inline_message_id))
+        return True
+
+    def answer_callback_query(self, callback_query_id, **kwargs):
+        delay = self._delay()
+        if delay:
+            time.sleep(delay)
+        self._record('answer_callback_query', dict(kwargs, callback_query_id=callback_query_id))
+        return True
+
+    def answer_inline_query(self, inline_query_id, results, **kwargs):
+        delay = self._delay()
+        if delay:
+            time.sleep(delay)
+        self._record('answer_inline_query', dict(kwargs, inline_query_id=inline_query_id, results=results))
+        return True
+
+
+class AsyncFakeBot(FakeBot):
+    """ Coroutine version of FakeBot, matching the async telegram.Bot API. """
+
+    async def send_message(self, chat_id, text, **kwargs):
+        delay = self._delay()
+        if delay:
+            await asyncio.sleep(delay)
+        self._flood()
+        self._record('send_message', dict(kwargs, chat_id=chat_id, text=text))
+        return self._message(chat_id)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, inline_message_id=None, **kwargs):
+        delay = self._delay()
+        if delay:
+            await asyncio.sleep(delay)
+        self._flood()
+        self._record('edit_message_text', dict(kwargs, text=text, chat_id=chat_id, message_id=message_id,
+                                               inline_message_id=inline_message_id))
+        return True
+
+    async def answer_callback_query(self, callback_query_id, **kwargs):
+        delay = self._delay()
+        if delay:
+            await asyncio.sleep(delay)
+        self._record('answer_callback_query', dict(kwargs, callback_query_id=callback_query_id))
+        return True
+
+
+# Fake updates, carrying just what the handlers read
+
+_query_ids = itertools.count(1)
+
+
+def fake_context(bot, args=None):
+    return SimpleNamespace(bot=bot, args=list(args or []))
+
+
+def command_update(chat_id, user_id, first_name='Player', last_name=None):
+    """ Update for a command message sent by the given user. """
+    user = SimpleNamespace(id=user_id, first_name=first_name, last_name=last_name)
+    message = SimpleNamespace(chat_id=chat_id, from_user=user, reply_to_message=None)
+    return SimpleNamespace(message=message, callback_query=None, effective_user=user)
+
+
+class _FakeCallbackQuery(object):
+
+    def __init__(self, bot, chat_id, message_id, user, data, inline_message_id=None):
+        self.bot = bot
+        self.id = str(next(_query_ids))
+        self.data = data
+        self.from_user = user
+        # Queries from a message sent through inline mode have no message
+        self.message = None if inline_message_id is not None else SimpleNamespace(chat_id=chat_id,
+                                                                                   message_id=message_id)
+        self.inline_message_id = inline_message_id
+
+    def answer(self, **kwargs):
+        return self.bot.answer_callback_query(self.id, **kwargs)
+
+    def edit_message_text(self, text, **kwargs):
+        if self.inline_message_id is not None:
+            return self.bot.edit_message_text(text, inline_message_id=self.inline_message_id, **kwargs)
+        return self.bot.edit_message_text(text, chat_id=self.message.chat_id,
+                                          message_id=self.message.message_id, **kwargs)
+
+
+class _FakeInlineQuery(object):
+
+    def __init__(self, bot, user, query):
+        self.bot = bot
+        self.id = str(next(_query_ids))
+        self.from_user = user
+        self.query = query
+
+    def answer(self, results, **kwargs):
+        return self.bot.answer_inline_query(self.id, results, **kwargs)
+
+
+def callback_update(bot, chat_id, message_id, user_id, data, first_name='Player'):
+    """ Update for an inline keyboard button press on the given message. Its
+    answer/edit calls go to `bot`, and are coroutines if `bot` is async.
+    """
+    user = SimpleNamespace(id=user_id, first_name=first_name, last_name=None)
+    query = _FakeCallbackQuery(bot, chat_id, message_id, user, data)
+    return SimpleNamespace(message=None, callback_query=query, effective_user=user)
+
+
+def inline_callback_update(bot, inline_message_id, user_id, data, first_name='Player'):
+    """ Update for a button press on a message sent through inline mode. """
+    user = SimpleNamespace(id=user_id, first_name=first_name, last_name=None)
+    query = _FakeCallbackQuery(bot, None, None, user, data, inline_message_id)
+    return SimpleNamespace(message=None, callback_query=query, effective_user=user)
+
+
+def inline_query_update(bot, user_id, query='', first_name='Player'):
+    """ Update for an inline query typed by the given user. """
+    user = SimpleNamespace(id=user_id, first_name=first_name, last_name=None)
+    return SimpleNamespace(message=None, callback_query=None, inline_query=_FakeInlineQuery(bot, user, query),
+                           effective_user=user)
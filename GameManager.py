@@ -0,0 +1,427 @@
+from __future__ import annotations
+
+import logging as lg
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+import time_util as t
+from Connect4 import Connect4
+from Connect4Bot import Connect4Bot, PHASE_SECONDS
+from GameStore import encode_game, decode_game
+from InlineConnect4Bot import InlineConnect4Bot, JOIN_DATA, invite_result
+from Metrics import get_registry
+from Reminder import get_default_scheduler
+from StatsStore import ALL_CHATS
+
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import CallbackContext
+
+
+TOO_MANY_GAMES_TEXT = 'Too many games are in progress right now. Please try again later.'
+
+
+class GameManager(object):
+    """ Hosts any number of concurrent Connect4Bot games in one bot process.
+
+    Games are created lazily the first time a chat uses a setup command and
+    are keyed by (chat_id, message_id) of their board message once the game
+    has started, so inline keyboard callbacks are routed to the game whose
+    board was clicked. Commands are routed to the chat's current game.
+
+    Games posted through inline mode are created when someone joins them and
+    are keyed by their inline_message_id instead of a chat. They are held,
+    counted and evicted alongside the chats' games, but aren't stored.
+    """
+    session_class = Connect4Bot
+    inline_session_class = InlineConnect4Bot
+
+    def __init__(self, game_factory=Connect4, max_games=1000, idle_sec=3600, sweep_sec=60, scheduler=None,
+                 outbox=None, store=None, stats=None):
+        """
+        Parameters
+        ----------
+        game_factory : callable
+            Returns a new Connect4 engine for each game.
+        max_games : int
+            Maximum number of live games; new games are refused beyond this.
+        idle_sec : int
+            Games without any activity for this long are evicted.
+        sweep_sec : int
+            Minimum time between two idle-eviction sweeps.
+        scheduler : ReminderScheduler
+            Scheduler shared by the reminders of every game. Defaults to the
+            process-wide scheduler.
+        outbox : OutboundQueue
+            Queue every game sends its messages through, if any.
+        store : GameStore
+            Store that started games are saved to, if any.
+        stats : StatsStore
+            Store that finished games are recorded in, if any, and that
+            /stats and /leaderboard read from.
+        """
+        self.game_factory = game_factory
+        self.scheduler = scheduler if scheduler is not None else get_default_scheduler()
+        self.outbox = outbox
+        self.store = store
+        self.stats = stats
+        # Bot used by restored games until their next update, see restore
+        self.bot = None
+        # chat_id -> (message_id, scheduled reminder) of stored games not loaded yet
+        self.stored = {}
+        self.max_games = max_games
+        self.idle_ms = idle_sec * 1000
+        self.sweep_ms = sweep_sec * 1000
+        # Reentrant, as restoring a game may play an AI move which updates the indexes
+        self.lock = threading.RLock()
+        # chat_id -> current game of that chat, or inline_message_id -> game of
+        # that inline message, least recently used first
+        self.chat_games = OrderedDict()
+        # chat_id -> time of last activity
+        self.last_active = {}
+        # (chat_id, message_id) -> game, for games whose board has been posted
+        self.games = {}
+        # chat_id -> (chat_id, message_id) key of the chat's game in self.games
+        self.board_keys = {}
+        self.last_sweep = t.current_milli_time()
+        get_registry().gauge('connect4_live_games', self.__len__, help='Games held in memory')
+        get_registry().gauge('connect4_stored_games', lambda: len(self.stored), help='Stored games not loaded yet')
+
+    def __len__(self):
+        return len(self.chat_games)
+
+    # /start_game
+    def start_game(self,
+                   update: Update,
+                   context: CallbackContext):
+        self._command(update, context, Connect4Bot.start_game, create=True)
+
+    # /p1
+    def p1(self,
+           update: Update,
+           context: CallbackContext):
+        self._command(update, context, Connect4Bot.p1, create=True)
+
+    # /p2
+    def p2(self,
+           update: Update,
+           context: CallbackContext):
+        self._command(update, context, Connect4Bot.p2, create=True)
+
+    # /vs_bot
+    def vs_bot(self,
+               update: Update,
+               context: CallbackContext):
+        self._command(update, context, Connect4Bot.vs_bot, create=True)
+
+    # /quit
+    def quit(self,
+             update: Update,
+             context: CallbackContext):
+        self._command(update, context, Connect4Bot.quit, create=False)
+
+    # /hint
+    def hint(self,
+             update: Update,
+             context: CallbackContext):
+        self._command(update, context, Connect4Bot.hint, create=False)
+
+    # /undo
+    def undo(self,
+             update: Update,
+             context: CallbackContext):
+        self._command(update, context, Connect4Bot.undo, create=False)
+
+    # /replay
+    def replay(self,
+               update: Update,
+               context: CallbackContext):
+        self._command(update, context, Connect4Bot.replay, create=False)
+
+    # /stats
+    def stats_command(self,
+                      update: Update,
+                      context: CallbackContext):
+        message = update.message
+        self._sender(context.bot).send_message(chat_id=message.chat_id, text=self._stats_text(message))
+
+    # /leaderboard
+    def leaderboard(self,
+                    update: Update,
+                    context: CallbackContext):
+        chat_id = update.message.chat_id
+        self._sender(context.bot).send_message(chat_id=chat_id, text=self._leaderboard_text(chat_id))
+
+    # Inline mode
+
+    def inline_query(self,
+                     update: Update,
+                     context: CallbackContext):
+        """ Offers the user an invite to a game, to post in any chat. """
+        result = invite_result(update)
+        # Each user's invite carries their own id
+        update.inline_query.answer([] if result is None else [result], is_personal=True)
+
+    # Player Actions
+
+    def place_chip(self,
+                   update: Update,
+                   context: CallbackContext):
+        query = update.callback_query
+        if query.inline_message_id is not None:
+            self._place_chip_inline(update, context)
+            return
+        chat_id = query.message.chat_id
+        session = self._lookup_board(chat_id, query.message.message_id)
+
+        if session is None:
+            # Board of a finished or evicted game
+            query.answer()
+            return
+
+        self._handle(session, Connect4Bot.place_chip, update, context, chat_id)
+
+    # Helpers
+
+    def _place_chip_inline(self,
+                           update: Update,
+                           context: CallbackContext):
+        query = update.callback_query
+        key = query.inline_message_id
+        self._sweep()
+        with self.lock:
+            session = self.chat_games.get(key)
+            if session is not None:
+                self._touch(key)
+            elif query.data.startswith(JOIN_DATA + ':') and len(self.chat_games) < self.max_games:
+                session = self.inline_session_class(self.game_factory(), self.scheduler, self.outbox, self.stats)
+                self._add(key, session)
+                lg.info('Created game for inline_message_id=%s (%d live)', key, len(self.chat_games))
+
+        if session is None:
+            # Invite refused for lack of room, or board of a finished or evicted game
+            query.answer(text=TOO_MANY_GAMES_TEXT if query.data.startswith(JOIN_DATA + ':') else
+                         'This game is over.')
+            return
+
+        self._handle(session, self.inline_session_class.place_chip, update, context, key)
+
+    def _command(self,
+                 update: Update,
+                 context: CallbackContext,
+                 handler,
+                 create: bool):
+        chat_id = update.message.chat_id
+        session = self._lookup(chat_id, create)
+
+        if session is None:
+            if create:
+                context.bot.send_message(chat_id=chat_id, text=TOO_MANY_GAMES_TEXT)
+                return
+            # Nothing to act on, let a fresh game give its usual answer
+            session = self._new_session()
+
+        self._handle(session, handler, update, context, chat_id)
+
+    def _handle(self, session, handler, update, context, chat_id):
+        """ Runs the handler and updates the indexes while holding the game's
+        lock, so neither sees the game halfway through another update.
+        """
+        with get_registry().timer(PHASE_SECONDS, phase='lock'):
+            session.lock.acquire()
+        try:
+            handler(session, update, context)
+            self._update_registry(chat_id, session)
+        finally:
+            session.lock.release()
+
+    def _stats_text(self, message) -> str:
+        """ Reply to /stats: the user's record, or their head-to-head with the
+        author of the message replied to.
+        """
+        user = message.from_user
+        if self.stats is None:
+            return 'Stats are not being recorded.'
+        if message.reply_to_message is not None and message.reply_to_message.from_user is not None:
+            other = message.reply_to_message.from_user
+            wins, losses, ties = self.stats.head_to_head(user.id, other.id)
+            return '{} vs {}: {} wins, {} losses, {} ties'.format(user.first_name, other.first_name, wins, losses,
+                                                                  ties)
+        here = self.stats.record(message.chat_id, user.id)
+        overall = self.stats.record(ALL_CHATS, user.id)
+        if overall is None:
+            return '{} has not finished a game yet.'.format(user.first_name)
+        return '{}\nHere: {}\nOverall: {}'.format(user.first_name, _record_text(here), _record_text(overall))
+
+    def _leaderboard_text(self, chat_id) -> str:
+        """ Reply to /leaderboard: the chat's players, best first. """
+        if self.stats is None:
+            return 'Stats are not being recorded.'
+        records = self.stats.leaderboard(chat_id)
+        if not records:
+            return 'Nobody has finished a game in this chat yet.'
+        lines = ['{}. {}: {}'.format(rank, record.name, _record_text(record)) for rank, record in enumerate(records, 1)]
+        return '~~~~ Leaderboard ~~~~\n' + '\n'.join(lines)
+
+    def _sender(self, bot):
+        """ Sends through the outbound queue if there is one, like the games do. """
+        return bot if self.outbox is None else self.outbox
+
+    def _new_session(self):
+        return self.session_class(self.game_factory(), self.scheduler, self.outbox, self.stats)
+
+    def _lookup(self, chat_id, create):
+        """ Returns the chat's current game, creating it if `create` is set and
+        there is room. Returns None if there is no game to act on.
+        """
+        self._sweep()
+        with self.lock:
+            session = self.chat_games.get(chat_id)
+            if session is None and chat_id in self.stored:
+                session = self._restore(chat_id)
+            if session is not None:
+                self._touch(chat_id)
+            elif create and len(self.chat_games) < self.max_games:
+                session = self._new_session()
+                self._add(chat_id, session)
+                lg.info('Created game for chat_id=%d (%d live)', chat_id, len(self.chat_games))
+            elif create:
+                lg.warning('Refused game for chat_id=%d, %d games live', chat_id, self.max_games)
+        return session
+
+    def _lookup_board(self, chat_id, message_id):
+        """ Returns the game whose board is the given message, if any. """
+        with self.lock:
+            session = self.games.get((chat_id, message_id))
+            if session is None and self.stored.get(chat_id, (None,))[0] == message_id:
+                session = self._restore(chat_id)
+            if session is not None:
+                self._touch(chat_id)
+        return session
+
+    def _add(self, chat_id, session):
+        """ Adds a game as the chat's current game. Caller holds the lock. """
+        self.chat_games[chat_id] = session
+        self._touch(chat_id)
+        # AI moves change the game outside of any handler
+        session.on_change = lambda changed: self._update_registry(chat_id, changed)
+
+    # Persistence
+
+    def restore(self, bot):
+        """ Indexes the games saved in the store. Each game is only loaded on
+        its next update, or when its reminder is due.
+
+        Parameters
+        ----------
+        bot : telegram.Bot
+            Bot used by restored games for reminders and AI moves.
+        """
+        self.bot = bot
+        index = self.store.load_index()
+        with self.lock:
+            for chat_id, message_id, remind_at in index:
+                call = None
+                if remind_at is not None:
+                    call = self.scheduler.schedule_at(remind_at, lambda chat_id=chat_id: self._remind_stored(chat_id))
+                self.stored[chat_id] = (message_id, call)
+        lg.info('Indexed %d stored games', len(index))
+
+    def _restore(self, chat_id):
+        """ Loads a stored game. Caller holds the lock. Returns None if there
+        is nothing left to play, the game being gone or over.
+        """
+        message_id, call = self.stored.pop(chat_id)
+        if call is not None:
+            self.scheduler.cancel(call)
+        row = self.store.load(chat_id)
+        if row is None:
+            return None
+        session = decode_game(row[1], self._new_session(), chat_id, row[0])
+        self._add(chat_id, session)
+        key = (chat_id, row[0])
+        self.games[key] = session
+        self.board_keys[chat_id] = key
+        session._resume(self.bot)
+        if not session.setupHasStarted:
+            # The AI's move on resuming ended the game, no handler will drop it
+            self._remove(chat_id)
+            lg.info('Restored game for chat_id=%d ended on resuming', chat_id)
+            return None
+        lg.info('Restored game for chat_id=%d', chat_id)
+        return session
+
+    def _remind_stored(self, chat_id):
+        with self.lock:
+            session = self._restore(chat_id) if chat_id in self.stored else None
+        if session is None:
+            return
+        with session.lock:
+            reminder = session.reminder
+            # Resuming scheduled the turn's reminder afresh, send the overdue one in its place
+            if reminder is None or reminder.call is None:
+                return
+            reminder.cancel()
+        reminder.remind()
+
+    def _save(self, chat_id, session):
+        """ Saves a started game to the store. Caller holds the lock. """
+        reminder = session.reminder
+        remind_at = reminder.call.deadline if reminder is not None and reminder.call is not None else None
+        self.store.save(chat_id, session.game_message.message_id, remind_at, encode_game(session))
+
+    def _touch(self, chat_id):
+        """ Marks the chat's game as recently used. Caller holds the lock. """
+        self.last_active[chat_id] = t.current_milli_time()
+        self.chat_games.move_to_end(chat_id)
+
+    def _update_registry(self, chat_id, session):
+        """ Keys a started game by its board message and drops finished games. """
+        with self.lock:
+            if self.chat_games.get(chat_id) is not session:
+                return
+            if not session.setupHasStarted:
+                self._remove(chat_id)
+            elif session.game_message is not None:
+                if chat_id not in self.board_keys:
+                    key = (chat_id, session.game_message.message_id)
+                    self.games[key] = session
+                    self.board_keys[chat_id] = key
+                if self.store is not None:
+                    self._save(chat_id, session)
+
+    def _remove(self, chat_id):
+        """ Removes the chat's game from every index. Caller holds the lock. """
+        del self.chat_games[chat_id]
+        del self.last_active[chat_id]
+        key = self.board_keys.pop(chat_id, None)
+        if key is not None:
+            del self.games[key]
+            if self.store is not None:
+                self.store.delete(chat_id)
+
+    def _sweep(self):
+        """ Evicts games that have been idle for longer than idle_sec. """
+        now = t.current_milli_time()
+        evicted = []
+        with self.lock:
+            if now - self.last_sweep < self.sweep_ms and len(self.chat_games) < self.max_games:
+                return
+            self.last_sweep = now
+            # Least recently used first, so stop at the first active game
+            for chat_id, session in list(self.chat_games.items()):
+                if now - self.last_active[chat_id] < self.idle_ms:
+                    break
+                self._remove(chat_id)
+                evicted.append((chat_id, session))
+
+        for chat_id, session in evicted:
+            lg.info('Evicting idle game for chat_id=%s', chat_id)
+            session._reset_game()
+
+
+def _record_text(record):
+    if record is None:
+        return 'no games yet'
+    return '{} wins, {} losses ({} quits), {} ties'.format(record.wins, record.losses, record.quits, record.ties)
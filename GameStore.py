@@ -0,0 +1,200 @@
+import logging as lg
+import sqlite3
+import struct
+import threading
+from collections import namedtuple
+
+import time_util as t
+from Connect4 import history_to_moves
+from Connect4Solver import DIFFICULTIES
+
+logger = lg.getLogger(__name__)
+
+RECORD_VERSION = 3
+# version, player 1 id, player 2 id, current player, AI difficulty (0 = none),
+# when the game started in time_util.current_milli_time terms (-1 = unknown)
+_record_header = struct.Struct('<BqqBBq')
+# rows, cols, in_a_row, followed by the move history
+_game_header = struct.Struct('<BBB')
+_name_length = struct.Struct('<H')
+_difficulties = list(DIFFICULTIES)
+
+# Stands in for the board's telegram.Message in restored games
+MessageRef = namedtuple('MessageRef', ['chat_id', 'message_id'])
+
+
+def encode_game(session) -> bytes:
+    """ Compact binary record of a started Connect4Bot game: its players, when
+    it started, the board shape and one byte per move played.
+    """
+    difficulty = 0 if session.ai_difficulty is None else _difficulties.index(session.ai_difficulty) + 1
+    started_at = -1 if session.started_at is None else session.started_at
+    parts = [_record_header.pack(RECORD_VERSION, session.p_id[0], session.p_id[1], session.p_cur, difficulty,
+                                 started_at)]
+    for name in session.p_name:
+        name = name.encode('utf-8')
+        parts.append(_name_length.pack(len(name)))
+        parts.append(name)
+    game = session.game
+    parts.append(_game_header.pack(game.rows, game.cols, game.in_a_row))
+    parts.append(bytes(game.history))
+    return b''.join(parts)
+
+
+def decode_game(record: bytes, session, chat_id, message_id):
+    """ Restores a record made by encode_game into a fresh Connect4Bot. The
+    caller is responsible for restarting its reminder or AI turn.
+    """
+    version, p1_id, p2_id, p_cur, difficulty, started_at = _record_header.unpack_from(record)
+    if version != RECORD_VERSION:
+        raise ValueError('Unknown game record version {}'.format(version))
+    offset = _record_header.size
+    names = []
+    for _ in range(2):
+        (length,) = _name_length.unpack_from(record, offset)
+        offset += _name_length.size
+        names.append(record[offset:offset + length].decode('utf-8'))
+        offset += length
+
+    # Replayed on the session's own engine
+    session.game = type(session.game)(*_game_header.unpack_from(record, offset))
+    session.game.replay(history_to_moves(record[offset + _game_header.size:]))
+    session.setupHasStarted = True
+    session.gameHasStarted = True
+    session.p_cur = p_cur
+    session.p_set = [True, True]
+    session.p_id = [p1_id, p2_id]
+    session.p_name = names
+    session.ai_difficulty = None if difficulty == 0 else _difficulties[difficulty - 1]
+    session.game_message = MessageRef(chat_id, message_id)
+    session.started_at = None if started_at < 0 else started_at
+    return session
+
+
+class GameStore(object):
+    """ SQLite store of the games in progress, so they survive a restart.
+
+    Writes are made behind the handlers' backs: save and delete only record
+    the latest state of each chat, and a writer thread flushes them in one
+    transaction every `flush_sec`. Every `compact_sec` it also drops games
+    untouched for `expire_sec` and compacts the database file.
+    """
+
+    def __init__(self, path='connect4_games.db', flush_sec=0.5, compact_sec=3600, expire_sec=7 * 24 * 3600):
+        """
+        Parameters
+        ----------
+        path : str
+            SQLite database file.
+        flush_sec : float
+            Seconds between two flushes of pending writes.
+        compact_sec : float
+            Seconds between two compactions.
+        expire_sec : float
+            Games without any move for this long are deleted on compaction.
+        """
+        self.flush_sec = flush_sec
+        self.compact_ms = compact_sec * 1000
+        self.expire_ms = expire_sec * 1000
+        self.db_lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db_lock:
+            # auto_vacuum only takes effect on a new database
+            self.db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            self.db.execute('PRAGMA journal_mode = WAL')
+            self.db.execute('PRAGMA synchronous = NORMAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS games ('
+                            'chat_id INTEGER PRIMARY KEY, '
+                            'message_id INTEGER NOT NULL, '
+                            'remind_at INTEGER, '
+                            'updated_at INTEGER NOT NULL, '
+                            'record BLOB NOT NULL)')
+            self.db.commit()
+
+        self.cond = threading.Condition()
+        # chat_id -> row to write, or None to delete the chat's game
+        self.pending = {}
+        self.closed = False
+        self.last_compact = t.current_milli_time()
+        self.thread = threading.Thread(target=self._run, name='game-store', daemon=True)
+        self.thread.start()
+
+    def save(self, chat_id, message_id, remind_at, record):
+        with self.cond:
+            self.pending[chat_id] = (chat_id, message_id, remind_at, t.current_milli_time(), record)
+
+    def delete(self, chat_id):
+        with self.cond:
+            self.pending[chat_id] = None
+
+    def load_index(self):
+        """ Returns (chat_id, message_id, remind_at) of every stored game,
+        without reading the game records themselves.
+        """
+        with self.db_lock:
+            return self.db.execute('SELECT chat_id, message_id, remind_at FROM games').fetchall()
+
+    def load(self, chat_id):
+        """ Returns (message_id, record) of the chat's stored game, or None. """
+        with self.cond:
+            if chat_id in self.pending:
+                row = self.pending[chat_id]
+                return None if row is None else (row[1], row[4])
+        with self.db_lock:
+            return self.db.execute('SELECT message_id, record FROM games WHERE chat_id = ?', (chat_id,)).fetchone()
+
+    def flush(self):
+        with self.cond:
+            pending = self.pending
+            self.pending = {}
+        if not pending:
+            return
+        rows = [row for row in pending.values() if row is not None]
+        deleted = [(chat_id,) for chat_id, row in pending.items() if row is None]
+        try:
+            with self.db_lock:
+                with self.db:
+                    self.db.executemany('INSERT OR REPLACE INTO games VALUES (?, ?, ?, ?, ?)', rows)
+                    self.db.executemany('DELETE FROM games WHERE chat_id = ?', deleted)
+        except sqlite3.Error:
+            # Kept for the next flush, unless the chat's game was saved or deleted again since
+            with self.cond:
+                for chat_id, row in pending.items():
+                    self.pending.setdefault(chat_id, row)
+            raise
+        logger.debug('Flushed %d games, deleted %d', len(rows), len(deleted))
+
+    def compact(self):
+        now = t.current_milli_time()
+        with self.db_lock:
+            with self.db:
+                expired = self.db.execute('DELETE FROM games WHERE updated_at < ?', (now - self.expire_ms,)).rowcount
+            self.db.execute('PRAGMA incremental_vacuum')
+            self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.last_compact = now
+        logger.info('Compacted game store, %d expired games deleted', expired)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+        try:
+            self.flush()
+        finally:
+            with self.db_lock:
+                self.db.close()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if not self.closed:
+                    self.cond.wait(self.flush_sec)
+                if self.closed:
+                    return
+            try:
+                self.flush()
+                if t.current_milli_time() - self.last_compact >= self.compact_ms:
+                    self.compact()
+            except sqlite3.Error:
+                logger.exception('Game store write failed, retrying with the next flush')
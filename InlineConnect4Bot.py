@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import logging as lg
+from typing import TYPE_CHECKING
+
+import time_util as t
+from BoardRenderer import CHIP_GLYPHS
+from Connect4 import Connect4
+from Connect4Bot import (Connect4Bot, HANDLER_SECONDS, P1, P2, PHASE_SECONDS, _board_to_emojis, _locked,
+                         parse_shape)
+from Metrics import get_registry, timed
+from StatsStore import ALL_CHATS
+
+if TYPE_CHECKING:
+    from telegram import InlineKeyboardMarkup, Update, Bot, CallbackQuery
+    from telegram.ext import CallbackContext
+
+# Callback data of the Join button: JOIN_DATA:<creator id>:<rows>x<cols>x<in a row>:<creator name>
+JOIN_DATA = 'join'
+# Telegram's limit on the bytes of callback data
+MAX_CALLBACK_DATA = 64
+
+
+def invite_result(update: Update):
+    """ Returns the inline query result inviting anyone in the chat to a game
+    with the user asking, on the board the query's options ask for, or None
+    if they aren't valid (yet, the user may still be typing).
+    """
+    from telegram import (InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle,
+                          InputTextMessageContent)
+
+    user = update.inline_query.from_user
+    try:
+        shape = parse_shape(update.inline_query.query.split())
+    except ValueError:
+        return None
+    board = _shape_text(shape)
+    # Everything the game needs is in the button, as nothing is told where the invite is posted
+    data = '{}:{}:{}x{}x{}:'.format(JOIN_DATA, user.id, *shape).encode('utf-8')
+    data += user.first_name.encode('utf-8')[:MAX_CALLBACK_DATA - len(data)]
+    join = InlineKeyboardButton('Join', callback_data=data.decode('utf-8', 'ignore'))
+    text = ('~~~~ Connect 4 ~~~~\n' +
+            '{} {} wants to play ({})!\n'.format(user.first_name, CHIP_GLYPHS[Connect4.P1], board) +
+            'Tap Join to be Player 2.')
+    return InlineQueryResultArticle(
+        id='connect4:{}x{}x{}'.format(*shape), title='Play Connect 4', description=board,
+        input_message_content=InputTextMessageContent(text),
+        reply_markup=InlineKeyboardMarkup([[join]]))
+
+
+def _shape_text(shape) -> str:
+    rows, cols, in_a_row = shape
+    return '{}x{} board, {} in a row to win'.format(rows, cols, in_a_row)
+
+
+class InlineConnect4Bot(Connect4Bot):
+    """ Connect4Bot for a game posted through inline mode, in any chat.
+
+    The game is one message, sent by the player who made the inline query and
+    known to the bot only by its inline_message_id. Joining, every move and
+    the end of the game are edits of that message, so a game costs one edit
+    per move and one to start. There is no chat to send anything else to, so
+    inline games have no reminders and no AI opponent.
+    """
+    __slots__ = ('inline_message_id',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Message of the game, set when the game is created
+        self.inline_message_id = None
+
+    @_locked
+    def place_chip(self,
+                   update: Update,
+                   context: CallbackContext):
+        query = update.callback_query
+        if query.data.startswith(JOIN_DATA + ':'):
+            self._join(query, context.bot)
+        elif self.gameHasStarted and query.from_user.id != self.p_id[self.p_cur]:
+            # A notification costs less than editing the board to say so
+            text = 'It\'s not your turn!' if query.from_user.id in self.p_id else 'You\'re not playing this game!'
+            query.answer(text=text)
+        else:
+            super().place_chip(update, context)
+
+    # Helpers
+
+    @timed(HANDLER_SECONDS, handler='join')
+    def _join(self,
+              query: CallbackQuery,
+              bot: Bot):
+        """ Starts the game once someone other than its creator taps Join. """
+        _, creator_id, shape, creator_name = query.data.split(':', 3)
+        user = query.from_user
+        if self.gameHasStarted:
+            query.answer(text='This game already has two players!')
+            return
+        if user.id == int(creator_id):
+            query.answer(text='Waiting for someone to join...')
+            return
+        query.answer()
+
+        shape = tuple(int(value) for value in shape.split('x'))
+        if shape != (self.game.rows, self.game.cols, self.game.in_a_row):
+            self.game = type(self.game)(*shape)
+        self.inline_message_id = query.inline_message_id
+        self.setupHasStarted = True
+        self.gameHasStarted = True
+        self.started_at = t.current_milli_time()
+        self.p_set = [True, True]
+        self.p_id = [int(creator_id), user.id]
+        self.p_name = [creator_name, user.first_name]
+        lg.info('Starting inline game! Inline_message_id=%s', self.inline_message_id)
+        get_registry().counter('connect4_inline_games_total', help='Games started from an inline message').inc()
+
+        text = '{} {} vs {} {}\n{}\'s turn!\n{}'.format(self.p_name[P1], CHIP_GLYPHS[Connect4.P1],
+                                                        self.p_name[P2], CHIP_GLYPHS[Connect4.P2],
+                                                        self.p_name[P1], _board_to_emojis(self.game.board))
+        self._edit_board(None, bot, None, text, self.inline_markup)
+
+    def _edit_board(self,
+                    query: CallbackQuery,
+                    bot: Bot,
+                    message,
+                    text: str,
+                    reply_markup: InlineKeyboardMarkup = None):
+        """ Edits the game's inline message. """
+        with get_registry().timer(PHASE_SECONDS, phase='api'):
+            self._sender(bot).edit_message_text(inline_message_id=self.inline_message_id, text=text,
+                                                reply_markup=reply_markup)
+
+    def _next_turn(self,
+                   bot: Bot) -> list:
+        """ Nothing to start, both players are human and there is no chat to
+        remind them in.
+        """
+        return []
+
+    def _record_result(self,
+                       winner: int,
+                       outcome: int):
+        """ Records the game under ALL_CHATS only, as it was played outside of
+        any chat the bot knows of.
+        """
+        if self.stats is not None:
+            self.stats.add(ALL_CHATS, self.p_id, self.p_name, winner, outcome, self.game.moves, self.started_at)
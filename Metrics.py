@@ -0,0 +1,324 @@
+import bisect
+import functools
+import logging as lg
+import threading
+import time
+
+logger = lg.getLogger(__name__)
+
+# Upper bounds, in seconds, of the timer histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# inspect.CO_COROUTINE, without importing inspect for it
+_CO_COROUTINE = 0x80
+
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in labels) + '}'
+
+
+class Counter(object):
+    __slots__ = ('lock', 'value')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class Gauge(object):
+    """ Value which is set directly, or read from `func` on every export. """
+    __slots__ = ('value', 'func')
+
+    def __init__(self, func=None):
+        self.value = 0
+        self.func = func
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value if self.func is None else self.func()
+
+
+class Timer(object):
+    """ Histogram of durations in seconds. Use as a context manager, or call
+    observe with a duration measured elsewhere.
+    """
+    __slots__ = ('lock', 'buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def time(self):
+        return _Timing(self)
+
+
+class _Timing(object):
+    __slots__ = ('timer', 'start')
+
+    def __init__(self, timer):
+        self.timer = timer
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.observe(time.perf_counter() - self.start)
+
+
+class MetricsRegistry(object):
+    """ Named counters, gauges and timers, optionally labelled, rendered in the
+    Prometheus text format for exporters.
+    """
+    enabled = True
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (kind, name) -> {labels: metric}
+        self.metrics = {}
+        self.help = {}
+        self.gauge('process_threads', threading.active_count, help='Live threads in this process')
+
+    def _get(self, kind, factory, name, help, labels):
+        key = tuple(sorted(labels.items()))
+        family = self.metrics.get((kind, name))
+        metric = None if family is None else family.get(key)
+        if metric is None:
+            with self.lock:
+                family = self.metrics.setdefault((kind, name), {})
+                metric = family.get(key)
+                if metric is None:
+                    metric = family[key] = factory()
+                if help is not None:
+                    self.help[name] = help
+        return metric
+
+    def counter(self, name, help=None, **labels) -> Counter:
+        return self._get('counter', Counter, name, help, labels)
+
+    def gauge(self, name, func=None, help=None, **labels) -> Gauge:
+        """ Returns the gauge, reading its value from `func` if given. """
+        gauge = self._get('gauge', Gauge, name, help, labels)
+        if func is not None:
+            gauge.func = func
+        return gauge
+
+    def timer(self, name, help=None, **labels) -> '_Timing':
+        """ Context manager timing its block into the named timer. """
+        return _Timing(self._get('histogram', Timer, name, help, labels))
+
+    def render(self) -> str:
+        """ Every metric in the Prometheus text exposition format. """
+        lines = []
+        with self.lock:
+            families = sorted((name, kind, dict(family)) for (kind, name), family in self.metrics.items())
+        for name, kind, family in families:
+            if name in self.help:
+                lines.append('# HELP {} {}'.format(name, self.help[name]))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, metric in sorted(family.items()):
+                if kind == 'counter':
+                    lines.append('{}{} {}'.format(name, _label_text(labels), metric.value))
+                elif kind == 'gauge':
+                    try:
+                        value = metric.get()
+                    except Exception:
+                        logger.exception('Reading gauge %s failed', name)
+                        continue
+                    lines.append('{}{} {}'.format(name, _label_text(labels), value))
+                else:
+                    with metric.lock:
+                        counts = list(metric.counts)
+                        count, total = metric.count, metric.sum
+                    cumulative = 0
+                    for bound, bucket_count in zip(metric.buckets + ('+Inf',), counts):
+                        cumulative += bucket_count
+                        lines.append('{}_bucket{} {}'.format(name, _label_text(labels + (('le', bound),)), cumulative))
+                    lines.append('{}_sum{} {}'.format(name, _label_text(labels), total))
+                    lines.append('{}_count{} {}'.format(name, _label_text(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+class _NullMetric(object):
+    """ Stands in for every metric while metrics are disabled. """
+    __slots__ = ()
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def get(self):
+        return 0
+
+    def observe(self, seconds):
+        pass
+
+    def time(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_null_metric = _NullMetric()
+
+
+class NullRegistry(object):
+    """ Registry which records nothing, the default until metrics are enabled. """
+    enabled = False
+
+    def counter(self, name, help=None, **labels):
+        return _null_metric
+
+    def gauge(self, name, func=None, help=None, **labels):
+        return _null_metric
+
+    def timer(self, name, help=None, **labels):
+        return _null_metric
+
+    def render(self) -> str:
+        return ''
+
+
+_registry = NullRegistry()
+
+
+def get_registry():
+    """ Returns the registry metrics are recorded in, a NullRegistry unless
+    enable_metrics has been called.
+    """
+    return _registry
+
+
+def enable_metrics() -> MetricsRegistry:
+    """ Starts recording metrics, process wide. Metrics registered by objects
+    created before this call (such as gauges) are not carried over, so call it
+    first thing.
+    """
+    global _registry
+    if not _registry.enabled:
+        _registry = MetricsRegistry()
+    return _registry
+
+
+def timed(name, **labels):
+    """ Decorator timing every call of the function, or of the coroutine
+    function until its coroutine finishes, into the named timer.
+    """
+    def decorator(func):
+        if getattr(func, '__code__', None) is not None and func.__code__.co_flags & _CO_COROUTINE:
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                registry = _registry
+                if not registry.enabled:
+                    return await func(*args, **kwargs)
+                with registry.timer(name, **labels):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            registry = _registry
+            if not registry.enabled:
+                return func(*args, **kwargs)
+            with registry.timer(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class PrometheusExporter(object):
+    """ Serves the registry in the Prometheus text format at /metrics. """
+
+    def __init__(self, registry, host='127.0.0.1', port=9108):
+        """
+        Parameters
+        ----------
+        registry : MetricsRegistry
+            Registry to export.
+        host : str
+            Address to listen on, local only by default.
+        port : int
+            Port to listen on.
+        """
+        # Imported here, most processes never export over HTTP
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        self.registry = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split('?')[0] != '/metrics':
+                    handler.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                handler.send_response(200)
+                handler.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                logger.debug(format, *args)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics-http', daemon=True)
+        self.thread.start()
+        logger.info('Serving metrics on http://%s:%d/metrics', *self.server.server_address[:2])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class LogExporter(object):
+    """ Logs the registry every `interval_sec`. """
+
+    def __init__(self, registry, interval_sec=60, level=lg.INFO):
+        self.registry = registry
+        self.interval_sec = interval_sec
+        self.level = level
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='metrics-log', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def dump(self):
+        lines = [line for line in self.registry.render().splitlines() if not line.startswith('#')]
+        logger.log(self.level, 'Metrics:\n%s', '\n'.join(lines))
+
+    def _run(self):
+        while not self.stopped.wait(self.interval_sec):
+            self.dump()
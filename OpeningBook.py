@@ -0,0 +1,214 @@
+""" Precomputed AI moves for the first plies of a game.
+
+Build a book offline, from the repository root:
+
+    $ python -m OpeningBook --plies 8 --depth 12 --out connect4_book.bin
+"""
+import bisect
+import logging as lg
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+
+logger = lg.getLogger(__name__)
+
+MAGIC = b'C4BK'
+BOOK_VERSION = 1
+DEFAULT_BOOK_PATH = 'connect4_book.bin'
+# magic, version, rows, cols, in_a_row, plies, search depth, entry count
+_header = struct.Struct('<4sBBBBBBxxI')
+
+
+def position_key(p1_bits, p2_bits, heights, height) -> int:
+    """ Unique key of a position in the BitboardConnect4 layout: player 1's
+    chips plus every occupied cell plus the bottom cell of each column. The
+    lowest empty cell of each column is its only set bit above player 1's
+    chips, which makes the key unique.
+    """
+    bottom = 0
+    for col in range(len(heights)):
+        bottom |= 1 << (col * height)
+    return p1_bits + (p1_bits | p2_bits) + bottom
+
+
+def mirror_bits(bits, cols, height) -> int:
+    """ Reflects a bitboard (or a position key) left to right. """
+    col_mask = (1 << height) - 1
+    mirrored = 0
+    for col in range(cols):
+        mirrored |= ((bits >> (col * height)) & col_mask) << ((cols - 1 - col) * height)
+    return mirrored
+
+
+class OpeningBook(object):
+    """ Memory mapped table of the best move in every position of the first
+    `plies` plies of one board shape.
+
+    Entries are sorted keys (see position_key) followed by the 0-indexed
+    column to play in each. A position and its mirror image share the entry
+    of whichever has the smaller key, halving the book. Being a read-only
+    mapping, the book is shared between every process that loads it.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.rows, self.cols, self.in_a_row, self.plies, self.depth,
+         count) = _header.unpack_from(self.mm)
+        if magic != MAGIC or version != BOOK_VERSION:
+            raise ValueError('{} is not a version {} opening book'.format(path, BOOK_VERSION))
+        self.height = self.rows + 1
+        offset = _header.size
+        if sys.byteorder == 'little':
+            self.keys = memoryview(self.mm)[offset:offset + 8 * count].cast('Q')
+        else:
+            # Keys are stored little-endian, so they can't be used in place here
+            self.keys = array('Q', self.mm[offset:offset + 8 * count])
+            self.keys.byteswap()
+        offset += 8 * count
+        self.moves = memoryview(self.mm)[offset:offset + count]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, p1_bits, p2_bits, heights):
+        """ Returns the 1-indexed column to play, or None if the position
+        isn't in the book.
+        """
+        if sum(heights) > self.plies:
+            return None
+        key = position_key(p1_bits, p2_bits, heights, self.height)
+        mirrored = mirror_bits(key, self.cols, self.height)
+        canonical = min(key, mirrored)
+        index = bisect.bisect_left(self.keys, canonical)
+        if index == len(self.keys) or self.keys[index] != canonical:
+            return None
+        col = self.moves[index]
+        return (col if canonical == key else self.cols - 1 - col) + 1
+
+
+_books = {}
+_books_lock = threading.Lock()
+
+
+def get_book(rows, cols, in_a_row, path=DEFAULT_BOOK_PATH):
+    """ Returns the book at `path` if it covers the board shape, loading it
+    on first use, or None.
+    """
+    with _books_lock:
+        if path not in _books:
+            book = None
+            if os.path.exists(path):
+                try:
+                    book = OpeningBook(path)
+                    logger.info('Loaded opening book of %d positions from %s', len(book), path)
+                except (OSError, ValueError, struct.error):
+                    logger.exception('Could not load opening book %s', path)
+            _books[path] = book
+        book = _books[path]
+    if book is None or (book.rows, book.cols, book.in_a_row) != (rows, cols, in_a_row):
+        return None
+    return book
+
+
+def book_move(rows, cols, in_a_row, p1_bits, p2_bits, heights):
+    """ Returns the book's 1-indexed column for the position, or None. """
+    book = get_book(rows, cols, in_a_row)
+    return None if book is None else book.lookup(p1_bits, p2_bits, heights)
+
+
+# Building
+
+def _positions(rows, cols, in_a_row, plies):
+    """ Yields (p1_bits, p2_bits, heights) of every position reachable in at
+    most `plies` plies where the game is still going, one per mirror pair.
+    """
+    from Connect4Solver import Connect4Solver
+
+    solver = Connect4Solver(rows, cols, in_a_row, tt_bits=1)
+    height = rows + 1
+    level = {position_key(0, 0, [0] * cols, height): (0, 0, (0,) * cols)}
+    for ply in range(plies + 1):
+        yield from level.values()
+        if ply == plies:
+            break
+        side = ply % 2
+        children = {}
+        for p1_bits, p2_bits, heights in level.values():
+            for col in range(cols):
+                if heights[col] == rows:
+                    continue
+                bits = [p1_bits, p2_bits]
+                bits[side] |= 1 << (col * height + heights[col])
+                if solver._is_win(bits[side]) or ply + 1 == rows * cols:
+                    continue
+                child_heights = heights[:col] + (heights[col] + 1,) + heights[col + 1:]
+                key = position_key(bits[0], bits[1], child_heights, height)
+                mirrored = mirror_bits(key, cols, height)
+                if mirrored < key:
+                    key = mirrored
+                    bits = [mirror_bits(b, cols, height) for b in bits]
+                    child_heights = child_heights[::-1]
+                children.setdefault(key, (bits[0], bits[1], child_heights))
+        level = children
+
+
+def _search(args):
+    from Connect4Solver import search_packed
+
+    position, depth, time_limit = args
+    return search_packed(position, depth, time_limit)
+
+
+def build(path, rows=6, cols=7, in_a_row=4, plies=8, depth=12, time_limit=None, processes=None):
+    """ Searches every position of the first `plies` plies `depth` plies deep
+    and writes the resulting book to `path`.
+    """
+    height = rows + 1
+    if height * cols > 64:
+        raise ValueError('Positions of a {}x{} board do not fit the book\'s 64 bit keys'.format(rows, cols))
+    positions = list(_positions(rows, cols, in_a_row, plies))
+    logger.info('Searching %d positions', len(positions))
+    jobs = [((rows, cols, in_a_row, p1_bits, p2_bits, bytes(heights), 1 + sum(heights) % 2), depth, time_limit)
+            for p1_bits, p2_bits, heights in positions]
+    from concurrent.futures import ProcessPoolExecutor
+
+    start = time.time()
+    with ProcessPoolExecutor(processes) as pool:
+        moves = list(pool.map(_search, jobs, chunksize=16))
+    logger.info('Searched in %.0fs', time.time() - start)
+
+    entries = sorted((position_key(p1_bits, p2_bits, heights, height), col - 1)
+                     for (p1_bits, p2_bits, heights), col in zip(positions, moves))
+    with open(path, 'wb') as f:
+        f.write(_header.pack(MAGIC, BOOK_VERSION, rows, cols, in_a_row, plies, depth, len(entries)))
+        f.write(struct.pack('<{}Q'.format(len(entries)), *(key for key, _ in entries)))
+        f.write(bytes(col for _, col in entries))
+    return len(entries)
+
+
+def main():
+    import argparse
+
+    lg.basicConfig(format='%(asctime)s - %(levelname)7s - %(message)s', level=lg.INFO)
+    parser = argparse.ArgumentParser(description='Builds an opening book for the Connect4 AI.')
+    parser.add_argument('--out', default=DEFAULT_BOOK_PATH, help='book file to write')
+    parser.add_argument('--rows', type=int, default=6)
+    parser.add_argument('--cols', type=int, default=7)
+    parser.add_argument('--in-a-row', type=int, default=4)
+    parser.add_argument('--plies', type=int, default=8, help='plies from the start the book covers')
+    parser.add_argument('--depth', type=int, default=12, help='search depth of every position')
+    parser.add_argument('--time-limit', type=float, help='seconds per position, unlimited by default')
+    parser.add_argument('--processes', type=int, help='search processes, one per core by default')
+    args = parser.parse_args()
+    count = build(args.out, args.rows, args.cols, args.in_a_row, args.plies, args.depth, args.time_limit,
+                  args.processes)
+    logger.info('Wrote %d positions to %s', count, args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+import heapq
+import itertools
+import logging as lg
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from Metrics import get_registry
+
+logger = lg.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """ Allows `rate` calls per second on average, with bursts of up to
+    `capacity` calls.
+    """
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        # Set when Telegram asks us to back off (HTTP 429)
+        self.blocked_until = now
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now) -> float:
+        """ Seconds until a call may be made. """
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_idle(self, now) -> bool:
+        """ True once the bucket is full again, so it can be discarded. """
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+
+class _Job(object):
+
+    def __init__(self, method, kwargs, key=None):
+        self.method = method
+        self.kwargs = kwargs
+        # Queued and rate limited as the chat's, or as the inline message's
+        # for edits of an inline message, which is in no chat the bot knows
+        self.chat_id = kwargs['chat_id'] if kwargs.get('chat_id') is not None else kwargs['inline_message_id']
+        # (chat_id, message_id), or inline_message_id, of a coalescable edit
+        self.key = key
+        self.futures = [Future()]
+        self.attempts = 0
+
+
+class OutboundQueue(object):
+    """ Sends Telegram messages from a few background threads while staying
+    under the per-chat and global flood limits.
+
+    Calls are queued per chat and released through a token bucket for each
+    chat plus one global bucket. Each thread sends one call at a time and a
+    chat has at most one call in flight, so different chats are sent to in
+    parallel while each chat's calls are sent in order. Edits of a message which are still waiting
+    to be sent are coalesced, so only the latest text is sent. Requests
+    failing with a flood-wait (429) or a network error are retried with
+    backoff. Requests Telegram rejects (BadRequest, Unauthorized) fail right
+    away.
+
+    send_message and edit_message_text mirror telegram.Bot, but return a
+    concurrent.futures.Future of the result instead of blocking.
+    """
+
+    def __init__(self, bot, global_rate=30, chat_rate=1, chat_burst=3, max_retries=5, backoff_sec=0.5, workers=4):
+        """
+        Parameters
+        ----------
+        bot : telegram.Bot
+            Bot used to make the calls.
+        global_rate : float
+            Calls per second across all chats.
+        chat_rate : float
+            Calls per second within one chat.
+        chat_burst : int
+            Calls one chat may make back to back before being rate limited.
+        max_retries : int
+            Retries for a call failing with a network error or timing out.
+        backoff_sec : float
+            Delay before the first retry, doubled on every further retry.
+        workers : int
+            Threads making calls, i.e. the most calls in flight at once.
+        """
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.backoff_sec = backoff_sec
+        self.cond = threading.Condition()
+        now = time.monotonic()
+        self.global_bucket = TokenBucket(global_rate, global_rate, now)
+        self.chat_buckets = {}
+        # chat_id -> deque of jobs waiting to be sent
+        self.pending = {}
+        # (chat_id, message_id), or inline_message_id -> queued edit of that message
+        self.edits = {}
+        # Chats with a call in flight, which aren't scheduled until it is done
+        self.busy = set()
+        # (time, seq, chat_id) for every chat with pending jobs
+        self.ready = []
+        self.seq = itertools.count()
+        self.sent = 0
+        self.coalesced = 0
+        self.threads = [threading.Thread(target=self._run, name='outbound-queue-{}'.format(i), daemon=True)
+                        for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+        get_registry().gauge('telegram_outbound_queued', self.__len__, help='Calls waiting in the outbound queue')
+
+    def __len__(self):
+        with self.cond:
+            return sum(len(jobs) for jobs in self.pending.values())
+
+    def send_message(self, chat_id, text, **kwargs) -> Future:
+        kwargs.update(chat_id=chat_id, text=text)
+        return self._put(_Job('send_message', kwargs))
+
+    def edit_message_text(self, text=None, chat_id=None, message_id=None, inline_message_id=None,
+                          **kwargs) -> Future:
+        kwargs.update(text=text, chat_id=chat_id, message_id=message_id)
+        if inline_message_id is None:
+            key = (chat_id, message_id)
+        else:
+            kwargs.update(inline_message_id=inline_message_id)
+            key = inline_message_id
+        with self.cond:
+            job = self.edits.get(key)
+            if job is not None:
+                # Replace the queued text, keeping the job's place in line
+                job.kwargs = kwargs
+                future = Future()
+                job.futures.append(future)
+                self.coalesced += 1
+                return future
+        return self._put(_Job('edit_message_text', kwargs, key))
+
+    # Helpers
+
+    def _put(self, job):
+        chat_id = job.chat_id
+        with self.cond:
+            if job.key is not None:
+                self.edits[job.key] = job
+            jobs = self.pending.get(chat_id)
+            if jobs is None:
+                jobs = self.pending[chat_id] = deque()
+                if chat_id not in self.busy:
+                    self._schedule(chat_id, time.monotonic())
+            jobs.append(job)
+        return job.futures[0]
+
+    def _schedule(self, chat_id, when):
+        """ Queues the chat to be looked at again at `when`. Caller holds the lock. """
+        heapq.heappush(self.ready, (when, next(self.seq), chat_id))
+        if self.ready[0][2] == chat_id:
+            self.cond.notify()
+
+    def _bucket(self, chat_id, now):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+        return bucket
+
+    def _next_job(self):
+        """ Blocks until a job may be sent and removes it from its queue. """
+        with self.cond:
+            while True:
+                if not self.ready:
+                    self.cond.wait()
+                    continue
+                now = time.monotonic()
+                when, _, chat_id = self.ready[0]
+                wait = max(when - now, self.global_bucket.delay(now))
+                if wait > 0:
+                    self.cond.wait(wait)
+                    continue
+
+                heapq.heappop(self.ready)
+                bucket = self._bucket(chat_id, now)
+                wait = bucket.delay(now)
+                if wait > 0:
+                    self._schedule(chat_id, now + wait)
+                    continue
+
+                jobs = self.pending[chat_id]
+                job = jobs.popleft()
+                if job.key is not None and self.edits.get(job.key) is job:
+                    del self.edits[job.key]
+                if not jobs:
+                    del self.pending[chat_id]
+                # The chat is scheduled again once this job is done
+                self.busy.add(chat_id)
+                if self.ready:
+                    # Another thread may be free to send to the next chat
+                    self.cond.notify()
+                bucket.take(now)
+                self.global_bucket.take(now)
+                self.sent += 1
+                if self.sent % 1000 == 0:
+                    self._prune_buckets(now)
+                return job
+
+    def _prune_buckets(self, now):
+        """ Drops the buckets of chats which are idle again. Caller holds the lock. """
+        for chat_id in [chat_id for chat_id, bucket in self.chat_buckets.items()
+                        if chat_id not in self.pending and chat_id not in self.busy and bucket.is_idle(now)]:
+            del self.chat_buckets[chat_id]
+
+    def _done(self, chat_id):
+        """ Lets the chat's next job be sent, once its job in flight is done. """
+        with self.cond:
+            self.busy.discard(chat_id)
+            if chat_id in self.pending:
+                self._schedule(chat_id, time.monotonic())
+
+    def _retry(self, job, delay):
+        """ Puts the job back at the front of its chat's queue, blocking the
+        chat for `delay`. Caller holds the chat busy.
+        """
+        chat_id = job.chat_id
+        with self.cond:
+            if job.key is not None:
+                newer = self.edits.get(job.key)
+                if newer is not None:
+                    # A newer edit of the message is queued, so this one is stale
+                    newer.futures.extend(job.futures)
+                    return
+                self.edits[job.key] = job
+            now = time.monotonic()
+            bucket = self._bucket(chat_id, now)
+            bucket.blocked_until = max(bucket.blocked_until, now + delay)
+            jobs = self.pending.get(chat_id)
+            if jobs is None:
+                jobs = self.pending[chat_id] = deque()
+            jobs.appendleft(job)
+
+    def _run(self):
+        # Imported here so that importing this module doesn't load telegram
+        from telegram.error import BadRequest, NetworkError
+
+        while True:
+            job = self._next_job()
+            metrics = get_registry()
+            try:
+                with metrics.timer('telegram_api_seconds', help='Telegram API call durations', method=job.method):
+                    result = getattr(self.bot, job.method)(**job.kwargs)
+            except Exception as e:
+                metrics.counter('telegram_api_errors_total', help='Failed Telegram API calls', method=job.method).inc()
+                retry_after = getattr(e, 'retry_after', None)
+                if retry_after is not None:
+                    if hasattr(retry_after, 'total_seconds'):
+                        retry_after = retry_after.total_seconds()
+                    logger.warning('Flood limit hit, retrying %s in %ss', job.method, retry_after)
+                    self._retry(job, float(retry_after))
+                # BadRequest is a NetworkError too, but sending it again would fail the same way
+                elif (isinstance(e, NetworkError) and not isinstance(e, BadRequest) and
+                        job.attempts < self.max_retries):
+                    delay = self.backoff_sec * 2 ** job.attempts
+                    job.attempts += 1
+                    logger.warning('%s failed (%s), retry %d in %.1fs', job.method, e, job.attempts, delay)
+                    self._retry(job, delay)
+                else:
+                    logger.error('%s failed: %s', job.method, e)
+                    for future in job.futures:
+                        future.set_exception(e)
+            else:
+                for future in job.futures:
+                    future.set_result(result)
+            self._done(job.chat_id)
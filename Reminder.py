@@ -1,9 +1,12 @@
-
-import time
+import heapq
+import itertools
+import threading
 import time_util as t
 import random as r
 import logging as lg
 
+from Metrics import get_registry
+
 P1, P2 = range(2)
 
 msg_formats = [
@@ -17,34 +20,217 @@ msg_formats = [
 ]
 
 
+class ScheduledCall(object):
+    """ Handle for a callback scheduled with a ReminderScheduler. """
+    __slots__ = ('deadline', 'callback', 'cancelled')
+
+    def __init__(self, deadline, callback):
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class ReminderScheduler(object):
+    """ Runs scheduled callbacks for every game from a single daemon thread.
+
+    Pending calls live in a heap ordered by deadline, so the thread sleeps
+    until the earliest deadline instead of polling, and scheduling costs
+    O(log n). Cancelled calls are dropped lazily when they reach the top of
+    the heap, and the heap is compacted once most of it is cancelled.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.heap = []
+        self.seq = itertools.count()
+        self.cancelled = 0
+        self.thread = None
+
+    def __len__(self):
+        with self.cond:
+            return len(self.heap) - self.cancelled
+
+    def schedule(self, delay_ms, callback):
+        """ Calls `callback()` from the scheduler thread after `delay_ms`.
+
+        Returns
+        -------
+        ScheduledCall
+            Handle which can be passed to `cancel`.
+        """
+        return self.schedule_at(t.current_milli_time() + delay_ms, callback)
+
+    def schedule_at(self, deadline_ms, callback):
+        """ Calls `callback()` from the scheduler thread at `deadline_ms`, in
+        time_util.current_milli_time terms.
+        """
+        call = ScheduledCall(deadline_ms, callback)
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='reminder-scheduler', daemon=True)
+                self.thread.start()
+            heapq.heappush(self.heap, (deadline_ms, next(self.seq), call))
+            # Only wake the thread if it is now sleeping past the new deadline
+            if self.heap[0][2] is call:
+                self.cond.notify()
+        return call
+
+    def cancel(self, call):
+        """ Cancels a scheduled call. Cancelling twice is harmless. """
+        with self.cond:
+            if call.cancelled:
+                return
+            call.cancel()
+            self.cancelled += 1
+            if self.cancelled > 64 and self.cancelled * 2 > len(self.heap):
+                self.heap = [entry for entry in self.heap if not entry[2].cancelled]
+                heapq.heapify(self.heap)
+                self.cancelled = 0
+
+    def _run(self):
+        lg.debug('reminder scheduler - starting')
+        while True:
+            with self.cond:
+                while True:
+                    while self.heap and self.heap[0][2].cancelled:
+                        heapq.heappop(self.heap)
+                        self.cancelled -= 1
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+                    delay_ms = self.heap[0][0] - t.current_milli_time()
+                    if delay_ms <= 0:
+                        break
+                    self.cond.wait(delay_ms / 1000)
+                call = heapq.heappop(self.heap)[2]
+                # Popped calls can no longer be cancelled through the heap
+                call.cancelled = True
+
+            try:
+                call.callback()
+            except Exception:
+                lg.exception('reminder scheduler - callback failed')
+
+
+_default_scheduler = None
+_default_scheduler_lock = threading.Lock()
+
+
+def get_default_scheduler():
+    """ Returns the process-wide scheduler shared by all games. """
+    global _default_scheduler
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = ReminderScheduler()
+        return _default_scheduler
+
+
 class Reminder(object):
+    """ Reminds the current player of their turn after `wait_sec` without a move.
+
+    Turns are started and cancelled from handler threads while reminders fire
+    on the scheduler thread, so both hold `lock`: the game's own lock when
+    given one, so reminders are serialized with the game's moves.
+    """
+    __slots__ = ('bot', 'chat_id', 'names', 'cur_player', 'wait_ms', 'scheduler', 'last_move', 'call', 'lock',
+                 'turn')
 
-    def __init__(self, bot, chat_id, p1_name, p2_name, wait_sec=300, pause_sec=20):
+    def __init__(self, bot, chat_id, p1_name, p2_name, wait_sec=300, scheduler=None, lock=None):
         self.bot = bot
         self.chat_id = chat_id
         self.names = {P1: p1_name, P2: p2_name}
         self.cur_player = P1
         self.wait_ms = wait_sec * 1000
-        self.pause_sec = pause_sec
+        self.scheduler = scheduler if scheduler is not None else self._default_scheduler()
         self.last_move = t.current_milli_time()
-        self.active = False
-        self.alive = True
-
-    def reminder_thread(self):
-        lg.debug('reminder_thread - starting')
-        while self.alive:
-            if self.active and ((t.current_milli_time() - self.last_move) > self.wait_ms):
-                cur_player_name = self.names[self.cur_player]
-                lg.info('reminder_thread - Sending reminder to: Name=%s, Chat_id=%d', cur_player_name, self.chat_id)
-                rand_int = r.randrange(len(msg_formats))
-                text = msg_formats[rand_int].format(cur_player_name)
-                self.bot.send_message(chat_id=self.chat_id, text=text)
-                self.active = False
-            else:
-                lg.debug('reminder_thread - Sleeping %d s', self.pause_sec)
-                time.sleep(self.pause_sec)
+        self.call = None
+        self.lock = lock if lock is not None else threading.RLock()
+        # Bumped on every new turn or cancel, so late-firing reminders can tell they are stale
+        self.turn = 0
+
+    @staticmethod
+    def _default_scheduler():
+        return get_default_scheduler()
+
+    def remind(self):
+        with self.lock:
+            cur_player_name = self.names[self.cur_player]
+        lg.info('reminder - Sending reminder to: Name=%s, Chat_id=%d', cur_player_name, self.chat_id)
+        rand_int = r.randrange(len(msg_formats))
+        text = msg_formats[rand_int].format(cur_player_name)
+        self.bot.send_message(chat_id=self.chat_id, text=text)
+        get_registry().counter('connect4_reminders_total', help='Turn reminders sent').inc()
+
+    def new_turn(self, player):
+        with self.lock:
+            self.last_move = t.current_milli_time()
+            self.cur_player = player
+            self.turn += 1
+            if self.call is not None:
+                self.scheduler.cancel(self.call)
+            turn = self.turn
+            self.call = self.scheduler.schedule(self.wait_ms, lambda: self._due(turn))
+
+    def cancel(self):
+        with self.lock:
+            self.turn += 1
+            if self.call is not None:
+                self.scheduler.cancel(self.call)
+                self.call = None
+
+    def _due(self, turn):
+        """ Sends the reminder of `turn`, unless a move was made since it fired. """
+        with self.lock:
+            if turn != self.turn:
+                return
+            self.call = None
+        self.remind()
+
+
+class AsyncReminder(Reminder):
+    """ Reminder for async bots, scheduled on the running event loop instead of
+    a ReminderScheduler thread.
+    """
+    __slots__ = ('task',)
+
+    def __init__(self, bot, chat_id, p1_name, p2_name, wait_sec=300):
+        # Everything runs on the event loop, so the lock goes unused
+        super().__init__(bot, chat_id, p1_name, p2_name, wait_sec)
+        self.task = None
+
+    @staticmethod
+    def _default_scheduler():
+        """ None, reminders are scheduled on the event loop instead. """
+        return None
+
+    async def remind(self):
+        cur_player_name = self.names[self.cur_player]
+        lg.info('reminder - Sending reminder to: Name=%s, Chat_id=%d', cur_player_name, self.chat_id)
+        rand_int = r.randrange(len(msg_formats))
+        text = msg_formats[rand_int].format(cur_player_name)
+        await self.bot.send_message(chat_id=self.chat_id, text=text)
+        get_registry().counter('connect4_reminders_total', help='Turn reminders sent').inc()
+
+    def _fire(self):
+        import asyncio
+
+        self.call = None
+        self.task = asyncio.get_running_loop().create_task(self.remind())
 
     def new_turn(self, player):
+        # Imported here so that threaded bots don't load asyncio
+        import asyncio
+
         self.last_move = t.current_milli_time()
         self.cur_player = player
-        self.active = True
+        if self.call is not None:
+            self.call.cancel()
+        self.call = asyncio.get_running_loop().call_later(self.wait_ms / 1000, self._fire)
+
+    def cancel(self):
+        if self.call is not None:
+            self.call.cancel()
+            self.call = None
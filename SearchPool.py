@@ -0,0 +1,122 @@
+import logging as lg
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from Connect4Solver import search_packed
+
+logger = lg.getLogger(__name__)
+
+
+class SearchRequest(object):
+    """ Handle for a search submitted to a SearchPool. """
+
+    def __init__(self, future):
+        self.future = future
+        self.cancelled = False
+
+    def cancel(self):
+        """ Drops the request: it is removed from the queue if it has not
+        started, and its callback is never called either way. A search
+        already running finishes by its deadline and is discarded.
+        """
+        self.cancelled = True
+        self.future.cancel()
+
+
+class SearchPool(object):
+    """ Runs AI searches in worker processes, so that CPU-bound search never
+    holds the GIL of the process serving updates.
+
+    Positions are sent in the packed form of Connect4Solver.pack_position.
+    At most `max_pending` searches are queued or running at once, every
+    request carries a deadline, and callbacks run on a small thread pool
+    rather than the executor's result thread.
+    """
+
+    def __init__(self, processes=None, max_pending=64, deadline_sec=10):
+        """
+        Parameters
+        ----------
+        processes : int
+            Number of search processes, defaults to the number of CPUs.
+        max_pending : int
+            Maximum number of searches queued or running.
+        deadline_sec : float
+            Seconds a request may take, including time spent in the queue.
+        """
+        self.processes = processes or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.deadline_sec = deadline_sec
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.executor = None
+        self.callbacks = ThreadPoolExecutor(max_workers=2, thread_name_prefix='search-callbacks')
+
+    def submit(self, position, max_depth, time_limit, callback):
+        """ Queues a search of a packed position.
+
+        `callback(col)` is called with the 1-indexed column found, or None if
+        the search missed its deadline or failed.
+
+        Returns
+        -------
+        SearchRequest
+            Handle for cancelling the request, or None if the pool is full.
+        """
+        with self.lock:
+            if self.pending >= self.max_pending:
+                return None
+            self.pending += 1
+            if self.executor is None:
+                # Imported on first use, multiprocessing is slow to import
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+
+                # Spawn, as forking a process running threads is unsafe
+                self.executor = ProcessPoolExecutor(max_workers=self.processes,
+                                                    mp_context=multiprocessing.get_context('spawn'))
+
+        deadline = time.time() + self.deadline_sec
+        future = self.executor.submit(search_packed, position, max_depth, time_limit, deadline)
+        request = SearchRequest(future)
+        future.add_done_callback(lambda f: self._done(request, callback))
+        return request
+
+    def _done(self, request, callback):
+        with self.lock:
+            self.pending -= 1
+        if request.cancelled:
+            return
+        try:
+            col = request.future.result()
+        except Exception:
+            logger.exception('AI search failed')
+            col = None
+        self.callbacks.submit(callback, col)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        self.callbacks.shutdown(wait=False)
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_default_pool(processes=None):
+    """ Returns the process-wide search pool shared by all games.
+
+    Parameters
+    ----------
+    processes : int
+        Number of search processes, used only by the call that creates the
+        pool. Defaults to the number of CPUs.
+    """
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = SearchPool(processes)
+        return _default_pool
@@ -0,0 +1,220 @@
+import bisect
+import hashlib
+import logging as lg
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from multiprocessing.connection import wait
+
+from telegram import Update
+
+from WebhookServer import ChatQueues, chat_key
+
+logger = lg.getLogger(__name__)
+
+
+def _hash(key) -> int:
+    return int.from_bytes(hashlib.blake2b(repr(key).encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class HashRing(object):
+    """ Consistent hash of chat keys onto shards. Changing the number of
+    shards only moves the chats of the shards added or removed.
+    """
+
+    def __init__(self, shards, replicas=64):
+        """
+        Parameters
+        ----------
+        shards : int
+            Number of shards.
+        replicas : int
+            Points each shard has on the ring, more spread chats more evenly.
+        """
+        points = sorted((_hash(('shard', shard, i)), shard) for shard in range(shards) for i in range(replicas))
+        self.hashes = [h for h, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    def shard(self, key) -> int:
+        index = bisect.bisect(self.hashes, _hash(key))
+        return self.shards[index % len(self.shards)]
+
+
+class _Shard(object):
+
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.started = 0.0
+        self.restarts = 0
+        # Held while sending to, or restarting, the shard
+        self.lock = threading.Lock()
+
+
+class ShardRouter(object):
+    """ Spreads games over worker processes, so the bot can use every core.
+
+    Updates are routed by a consistent hash of their chat to one of `shards`
+    processes, which each run their own GameManager, reminders, outbound
+    queue and GameStore, and handle their updates in order within each chat.
+    Updates travel to the shards over pipes. Shards that die are restarted
+    and reload their games from their store.
+
+    Register `route` as the only handler of the front process's dispatcher.
+    """
+
+    def __init__(self, shards, bot_factory, allow_list, allow_list_path=None, store_path='connect4_games.shard{}.db',
+                 stats_path='connect4_stats.db', workers=8, send_timeout_sec=30):
+        """
+        Parameters
+        ----------
+        shards : int
+            Number of worker processes.
+        bot_factory : callable
+            Picklable callable returning the telegram.Bot each shard uses,
+            e.g. functools.partial(Bot, token).
+        allow_list : list
+            User ids allowed to play.
+        allow_list_path : str
+            File of more user ids allowed to play, see AllowListFilter.
+        store_path : str
+            GameStore file of each shard, formatted with the shard index.
+            Games of chats that move to another shard when the number of
+            shards changes are not carried over.
+        stats_path : str
+            StatsStore file, shared by every shard.
+        workers : int
+            Threads handling updates in each shard.
+        send_timeout_sec : float
+            How long an update waits for a dead shard to come back before it
+            is dropped.
+        """
+        self.ring = HashRing(shards)
+        self.shards = [_Shard(index) for index in range(shards)]
+        self.config = dict(bot_factory=bot_factory, allow_list=list(allow_list), allow_list_path=allow_list_path,
+                           store_path=store_path, stats_path=stats_path, workers=workers, shards=shards)
+        self.send_timeout_sec = send_timeout_sec
+        self.context = multiprocessing.get_context('spawn')
+        self.stopping = threading.Event()
+        self.supervisor = threading.Thread(target=self._supervise, name='shard-supervisor', daemon=True)
+
+    def start(self):
+        for shard in self.shards:
+            with shard.lock:
+                self._spawn(shard)
+        self.supervisor.start()
+
+    def route(self, update: Update, context=None):
+        """ Sends the update to the shard owning its chat. Usable as a handler callback. """
+        key = chat_key(update)
+        shard = self.shards[self.ring.shard(key)]
+        message = (key, update.to_dict())
+        deadline = time.monotonic() + self.send_timeout_sec
+        while True:
+            with shard.lock:
+                try:
+                    shard.conn.send(message)
+                    return
+                except (OSError, EOFError):
+                    pass
+            if self.stopping.is_set() or time.monotonic() > deadline:
+                logger.error('Dropping update %d, shard %d is down', update.update_id, shard.index)
+                return
+            # Wait for the supervisor to restart the shard
+            time.sleep(0.1)
+
+    def stop(self):
+        """ Asks every shard to finish its queued updates and exit. """
+        self.stopping.set()
+        for shard in self.shards:
+            with shard.lock:
+                try:
+                    shard.conn.send(None)
+                except (OSError, EOFError):
+                    pass
+        for shard in self.shards:
+            shard.process.join()
+        self.supervisor.join()
+
+    # Helpers
+
+    def _spawn(self, shard):
+        """ Starts the shard's process. Caller holds the shard's lock. """
+        receiver, sender = self.context.Pipe(duplex=False)
+        shard.process = self.context.Process(target=_run_shard, args=(shard.index, receiver, self.config),
+                                             name='connect4-shard-{}'.format(shard.index), daemon=True)
+        shard.process.start()
+        receiver.close()
+        shard.conn = sender
+        shard.started = time.monotonic()
+        logger.info('Started shard %d (pid %d)', shard.index, shard.process.pid)
+
+    def _supervise(self):
+        while not self.stopping.is_set():
+            sentinels = {shard.process.sentinel: shard for shard in self.shards}
+            for sentinel in wait(list(sentinels), timeout=1):
+                shard = sentinels[sentinel]
+                if self.stopping.is_set():
+                    return
+                shard.process.join()
+                logger.error('Shard %d exited with code %s, restarting', shard.index, shard.process.exitcode)
+                # Back off from shards that keep dying right after starting
+                if time.monotonic() - shard.started < 5:
+                    shard.restarts += 1
+                    time.sleep(min(30, 0.5 * 2 ** shard.restarts))
+                else:
+                    shard.restarts = 0
+                with shard.lock:
+                    shard.conn.close()
+                    self._spawn(shard)
+
+
+def _run_shard(index, conn, config):
+    """ Main function of a shard process. """
+    # Ctrl-C goes to the whole process group, let the front process stop us
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    from telegram.ext import Dispatcher
+
+    from AllowListFilter import AllowListFilter
+    from Connect4 import Connect4
+    from GameManager import GameManager
+    from GameStore import GameStore
+    from OutboundQueue import OutboundQueue
+    from SearchPool import get_default_pool
+    from StatsStore import StatsStore
+    # Imported here, the script imports this module
+    from connect4_bot_script import add_handlers
+
+    bot = config['bot_factory']()
+    # Shards share Telegram's global flood limit
+    outbox = OutboundQueue(bot, global_rate=30 / config['shards'])
+    # And the CPUs, rather than each starting a search process per CPU
+    get_default_pool(processes=max(1, (os.cpu_count() or 1) // config['shards']))
+    store = GameStore(config['store_path'].format(index))
+    stats = StatsStore(config['stats_path'])
+    manager = GameManager(game_factory=Connect4, outbox=outbox, store=store, stats=stats)
+    manager.restore(bot)
+    dispatcher = Dispatcher(bot, queue.Queue(), workers=1)
+    add_handlers(dispatcher, manager, AllowListFilter(config['allow_list'], config['allow_list_path']), run_async=False)
+    queues = ChatQueues(dispatcher.process_update, config['workers'])
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            # The front process is gone
+            break
+        if message is None:
+            break
+        key, data = message
+        queues.put(key, Update.de_json(data, bot))
+
+    queues.shutdown()
+    store.close()
+    stats.close()
+    logger.info('Shard %d stopped', index)
@@ -0,0 +1,257 @@
+import logging as lg
+import sqlite3
+import threading
+from collections import namedtuple
+
+import time_util as t
+
+logger = lg.getLogger(__name__)
+
+# How a finished game ended
+WIN, TIE, QUIT = range(3)
+# Records of every chat together are kept under this chat id, which no
+# Telegram chat has
+ALL_CHATS = 0
+
+# A player's results. Quitting counts as a loss, and as a quit
+Record = namedtuple('Record', ['user_id', 'name', 'wins', 'losses', 'ties', 'quits'])
+
+
+class StatsStore(object):
+    """ SQLite store of finished games, with each player's record and every
+    head-to-head kept up to date alongside.
+
+    Finished games are queued by `add` and a writer thread inserts them in
+    one transaction every `flush_sec`, updating the summary tables in the
+    same transaction, so handlers never wait on the disk and reads never
+    have to aggregate the games themselves. Reads are cached for `cache_sec`
+    and dropped from the cache when a game changes them.
+
+    Several processes (see ShardRouter) may share one database file.
+    """
+
+    def __init__(self, path='connect4_stats.db', flush_sec=1.0, cache_sec=60):
+        """
+        Parameters
+        ----------
+        path : str
+            SQLite database file.
+        flush_sec : float
+            Seconds between two flushes of queued games.
+        cache_sec : float
+            Seconds a read is served from the cache.
+        """
+        self.flush_sec = flush_sec
+        self.cache_ms = cache_sec * 1000
+        self.db_lock = threading.Lock()
+        # Waits on other processes writing to the same file
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.db_lock:
+            self.db.execute('PRAGMA journal_mode = WAL')
+            self.db.execute('PRAGMA synchronous = NORMAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS matches ('
+                            'id INTEGER PRIMARY KEY, '
+                            'chat_id INTEGER NOT NULL, '
+                            'p1_id INTEGER NOT NULL, '
+                            'p2_id INTEGER NOT NULL, '
+                            'winner INTEGER, '
+                            'outcome INTEGER NOT NULL, '
+                            'moves TEXT NOT NULL, '
+                            'started_at INTEGER, '
+                            'ended_at INTEGER NOT NULL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS matches_chat ON matches (chat_id, ended_at)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS matches_p1 ON matches (p1_id, ended_at)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS matches_p2 ON matches (p2_id, ended_at)')
+            # Summaries, updated along with every insert into matches
+            self.db.execute('CREATE TABLE IF NOT EXISTS records ('
+                            'chat_id INTEGER NOT NULL, '
+                            'user_id INTEGER NOT NULL, '
+                            'name TEXT NOT NULL, '
+                            'wins INTEGER NOT NULL, '
+                            'losses INTEGER NOT NULL, '
+                            'ties INTEGER NOT NULL, '
+                            'quits INTEGER NOT NULL, '
+                            'PRIMARY KEY (chat_id, user_id)) WITHOUT ROWID')
+            self.db.execute('CREATE INDEX IF NOT EXISTS records_ranking ON records (chat_id, wins DESC, losses)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS pairs ('
+                            'low_id INTEGER NOT NULL, '
+                            'high_id INTEGER NOT NULL, '
+                            'low_wins INTEGER NOT NULL, '
+                            'high_wins INTEGER NOT NULL, '
+                            'ties INTEGER NOT NULL, '
+                            'PRIMARY KEY (low_id, high_id)) WITHOUT ROWID')
+            self.db.commit()
+
+        self.cond = threading.Condition()
+        self.pending = []
+        self.closed = False
+        self.cache_lock = threading.Lock()
+        # key -> (expiry time, value), see _cached
+        self.cache = {}
+        # Bumped by every flush, under cache_lock
+        self.version = 0
+        self.thread = threading.Thread(target=self._run, name='stats-store', daemon=True)
+        self.thread.start()
+
+    def add(self, chat_id, p_ids, p_names, winner, outcome, moves, started_at=None):
+        """ Queues a finished game.
+
+        Parameters
+        ----------
+        chat_id : int
+            Chat the game was played in, ALL_CHATS for one outside of any chat.
+        p_ids : list
+            User ids of Player 1 and Player 2.
+        p_names : list
+            Names of Player 1 and Player 2.
+        winner : int
+            0 if Player 1 won, 1 if Player 2 won, None for a tie.
+        outcome : int
+            WIN, TIE or QUIT (the loser quit).
+        moves : str
+            Move string of the game, see Connect4.moves.
+        started_at : int
+            Milliseconds since the epoch when the game started, if known.
+        """
+        row = (chat_id, p_ids[0], p_ids[1], None if winner is None else winner + 1, outcome, moves, started_at,
+               t.current_milli_time(), tuple(p_names))
+        with self.cond:
+            self.pending.append(row)
+
+    def record(self, chat_id, user_id):
+        """ Returns the user's Record in the chat, or in every chat if
+        `chat_id` is ALL_CHATS, or None if they haven't finished a game.
+        """
+        return self._cached(('record', chat_id, user_id),
+                            'SELECT user_id, name, wins, losses, ties, quits FROM records '
+                            'WHERE chat_id = ? AND user_id = ?', (chat_id, user_id), one=True)
+
+    def leaderboard(self, chat_id, limit=10):
+        """ Returns the Records of the chat's players with the most wins. """
+        return self._cached(('leaderboard', chat_id, limit),
+                            'SELECT user_id, name, wins, losses, ties, quits FROM records '
+                            'WHERE chat_id = ? ORDER BY wins DESC, losses LIMIT ?', (chat_id, limit))
+
+    def head_to_head(self, user_id, other_id):
+        """ Returns (wins of user_id, wins of other_id, ties) between them. """
+        low, high = sorted((user_id, other_id))
+        row = self._cached(('pair', low, high), 'SELECT low_wins, high_wins, ties FROM pairs '
+                                                'WHERE low_id = ? AND high_id = ?', (low, high), one=True, raw=True)
+        low_wins, high_wins, ties = row or (0, 0, 0)
+        return (low_wins, high_wins, ties) if user_id == low else (high_wins, low_wins, ties)
+
+    def flush(self):
+        with self.cond:
+            pending = self.pending
+            self.pending = []
+        if not pending:
+            return
+
+        # Summed up here, so each record and pair is written once per flush
+        records = {}
+        pairs = {}
+        for chat_id, p1_id, p2_id, winner, outcome, _, _, _, names in pending:
+            for side, (user_id, name) in enumerate(zip((p1_id, p2_id), names)):
+                # Games outside of any chat (inline mode) are only recorded under ALL_CHATS
+                for key in {(chat_id, user_id), (ALL_CHATS, user_id)}:
+                    _, wins, losses, ties, quits = records.get(key, (name, 0, 0, 0, 0))
+                    if winner is None:
+                        ties += 1
+                    elif winner == side + 1:
+                        wins += 1
+                    else:
+                        losses += 1
+                        if outcome == QUIT:
+                            quits += 1
+                    records[key] = (name, wins, losses, ties, quits)
+            low, high = sorted((p1_id, p2_id))
+            low_wins, high_wins, ties = pairs.get((low, high), (0, 0, 0))
+            if winner is None:
+                ties += 1
+            elif (p1_id, p2_id)[winner - 1] == low:
+                low_wins += 1
+            else:
+                high_wins += 1
+            pairs[(low, high)] = (low_wins, high_wins, ties)
+
+        try:
+            self._write(pending, records, pairs)
+        except sqlite3.Error:
+            # Kept for the next flush, ahead of the games queued since
+            with self.cond:
+                self.pending[:0] = pending
+            raise
+
+        chats = {chat_id for chat_id, _ in records}
+        with self.cache_lock:
+            # Reads that started before this flush mustn't cache what they read
+            self.version += 1
+            for key in [key for key in self.cache
+                        if (key[0] == 'record' and key[1:] in records) or
+                           (key[0] == 'leaderboard' and key[1] in chats) or
+                           (key[0] == 'pair' and key[1:] in pairs)]:
+                del self.cache[key]
+        logger.debug('Recorded %d games', len(pending))
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+        try:
+            self.flush()
+        finally:
+            with self.db_lock:
+                self.db.close()
+
+    # Helpers
+
+    def _write(self, pending, records, pairs):
+        """ Inserts the games and adds them up into the summaries, in one
+        transaction which is rolled back if any of it fails.
+        """
+        with self.db_lock:
+            with self.db:
+                self.db.executemany('INSERT INTO matches (chat_id, p1_id, p2_id, winner, outcome, moves, started_at, '
+                                    'ended_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [row[:8] for row in pending])
+                self.db.executemany('INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?) '
+                                    'ON CONFLICT (chat_id, user_id) DO UPDATE SET name = excluded.name, '
+                                    'wins = wins + excluded.wins, losses = losses + excluded.losses, '
+                                    'ties = ties + excluded.ties, quits = quits + excluded.quits',
+                                    [key + value for key, value in records.items()])
+                self.db.executemany('INSERT INTO pairs VALUES (?, ?, ?, ?, ?) '
+                                    'ON CONFLICT (low_id, high_id) DO UPDATE SET '
+                                    'low_wins = low_wins + excluded.low_wins, '
+                                    'high_wins = high_wins + excluded.high_wins, ties = ties + excluded.ties',
+                                    [key + value for key, value in pairs.items()])
+
+    def _cached(self, key, query, args, one=False, raw=False):
+        """ Runs the query, or returns its result from the cache. """
+        now = t.current_milli_time()
+        with self.cache_lock:
+            hit = self.cache.get(key)
+            if hit is not None and hit[0] > now:
+                return hit[1]
+            version = self.version
+        with self.db_lock:
+            rows = self.db.execute(query, args).fetchall()
+        if not raw:
+            rows = [Record(*row) for row in rows]
+        value = (rows[0] if rows else None) if one else rows
+        with self.cache_lock:
+            # Unless a flush may have changed the value since it was read
+            if self.version == version:
+                self.cache[key] = (now + self.cache_ms, value)
+        return value
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if not self.closed:
+                    self.cond.wait(self.flush_sec)
+                if self.closed:
+                    return
+            try:
+                self.flush()
+            except sqlite3.Error:
+                logger.exception('Stats store write failed, retrying with the next flush')
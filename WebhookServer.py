@@ -0,0 +1,248 @@
+import itertools
+import json
+import logging as lg
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Update
+
+from Metrics import get_registry
+
+logger = lg.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 makes bursts of connections wait on SYN retries
+    request_queue_size = 128
+
+
+class ChatQueues(object):
+    """ Runs updates on a pool of worker threads, in order within each chat
+    and in parallel across chats.
+
+    A chat with queued updates is drained by one worker at a time, which
+    keeps the chat's updates in order without tying up a worker per chat.
+    """
+
+    def __init__(self, process, workers=8):
+        """
+        Parameters
+        ----------
+        process : callable
+            Called with each update, usually Dispatcher.process_update.
+        workers : int
+            Threads calling `process`.
+        """
+        self.process = process
+        self.lock = threading.Lock()
+        # chat key -> deque of updates, for every chat with updates waiting or running
+        self.chats = {}
+        self.pending = 0
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix='chat-worker')
+
+    def put(self, key, update):
+        """ Queues the update behind the earlier ones with the same key, see chat_key. """
+        with self.lock:
+            self.pending += 1
+            queue = self.chats.get(key)
+            if queue is None:
+                queue = self.chats[key] = deque()
+                self.pool.submit(self._drain, key, queue)
+            queue.append(update)
+
+    def shutdown(self):
+        """ Waits for the queued updates to be handled. """
+        self.pool.shutdown(wait=True)
+
+    def _drain(self, key, queue):
+        """ Handles the chat's updates in order until its queue is empty. """
+        metrics = get_registry()
+        while True:
+            with self.lock:
+                if not queue:
+                    del self.chats[key]
+                    return
+                update = queue.popleft()
+            try:
+                with metrics.timer('update_dispatch_seconds', help='Time to handle one update'):
+                    self.process(update)
+            except Exception:
+                logger.exception('Handling update %d failed', update.update_id)
+            finally:
+                with self.lock:
+                    self.pending -= 1
+
+
+class WebhookServer(object):
+    """ Receives Telegram updates over a local HTTP webhook and dispatches
+    them on a pool of worker threads.
+
+    Request bodies are acknowledged as soon as they are queued. A parser
+    thread decodes them in batches and queues each update by chat (see
+    ChatQueues), so every game sees its updates in order while different
+    chats are handled in parallel. Once `max_pending` updates are waiting,
+    requests are refused with 503 and Telegram delivers them again later.
+
+    A body may hold one update, as Telegram sends them, or a JSON array of
+    updates, which is handy for replaying recorded updates.
+    """
+
+    def __init__(self, dispatcher, host='127.0.0.1', port=8443, path='/telegram', secret_token=None, workers=8,
+                 max_pending=1000, batch_size=100):
+        """
+        Parameters
+        ----------
+        dispatcher : telegram.ext.Dispatcher
+            Dispatcher whose handlers process the updates. Register them
+            without run_async, or updates of a chat may run out of order.
+        host : str
+            Address to listen on. Put a TLS terminating proxy in front of it.
+        port : int
+            Port to listen on.
+        path : str
+            URL path of the webhook.
+        secret_token : str
+            Secret Telegram must send along with each update, if any.
+        workers : int
+            Threads running handlers.
+        max_pending : int
+            Updates that may wait to be handled before requests are refused.
+        batch_size : int
+            Maximum request bodies parsed in one go.
+        """
+        self.dispatcher = dispatcher
+        self.path = path
+        self.secret_token = secret_token
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.cond = threading.Condition()
+        # Request bodies not parsed yet
+        self.bodies = deque()
+        self.closed = False
+        self.queues = ChatQueues(dispatcher.process_update, workers)
+        self.parser = threading.Thread(target=self._parse_loop, name='webhook-parser', daemon=True)
+        self.server = _HTTPServer((host, port), self._request_handler())
+        self.thread = None
+        get_registry().gauge('webhook_pending_updates', lambda: self.pending, help='Updates waiting to be handled')
+
+    @property
+    def address(self):
+        return self.server.server_address[:2]
+
+    @property
+    def pending(self):
+        """ Updates received but not handled yet, counting each unparsed body as one. """
+        return len(self.bodies) + self.queues.pending
+
+    def start(self):
+        self.parser.start()
+        self.thread = threading.Thread(target=self.server.serve_forever, name='webhook-http', daemon=True)
+        self.thread.start()
+        logger.info('Listening for updates on http://%s:%d%s', *self.address, self.path)
+
+    def stop(self):
+        """ Stops accepting updates and waits for the queued ones to be handled. """
+        self.server.shutdown()
+        self.server.server_close()
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.parser.join()
+        self.queues.shutdown()
+
+    def put(self, body: bytes) -> bool:
+        """ Queues a request body. Returns False if too many updates are waiting. """
+        with self.cond:
+            if self.closed or self.pending >= self.max_pending:
+                return False
+            self.bodies.append(body)
+            self.cond.notify()
+        return True
+
+    # Helpers
+
+    def _request_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(handler):
+                if handler.path != server.path:
+                    handler.send_error(404)
+                    return
+                if server.secret_token is not None and handler.headers.get(SECRET_HEADER) != server.secret_token:
+                    handler.send_error(403)
+                    return
+                body = handler.rfile.read(int(handler.headers.get('Content-Length', 0)))
+                if server.put(body):
+                    handler.send_response(200)
+                else:
+                    get_registry().counter('webhook_rejected_total', help='Requests refused as the queue was full').inc()
+                    handler.send_response(503)
+                    handler.send_header('Retry-After', '1')
+                handler.send_header('Content-Length', '0')
+                handler.end_headers()
+
+            def log_message(handler, format, *args):
+                logger.debug(format, *args)
+
+        return Handler
+
+    def _parse_loop(self):
+        while True:
+            with self.cond:
+                while not self.bodies and not self.closed:
+                    self.cond.wait()
+                if not self.bodies:
+                    return
+                batch = list(itertools.islice(self.bodies, self.batch_size))
+            self._parse(batch)
+
+    def _parse(self, bodies):
+        """ Decodes request bodies at the front of the queue and queues their
+        updates by chat.
+        """
+        bot = self.dispatcher.bot
+        updates = []
+        for body in bodies:
+            try:
+                data = json.loads(body)
+            except ValueError:
+                logger.warning('Dropping request that is not JSON')
+                data = []
+            for item in data if isinstance(data, list) else [data]:
+                try:
+                    update = Update.de_json(item, bot)
+                except Exception:
+                    logger.exception('Dropping malformed update')
+                    continue
+                if update is not None:
+                    updates.append(update)
+
+        for update in updates:
+            self.queues.put(chat_key(update), update)
+        with self.cond:
+            # Only dropped once queued, so they keep counting towards max_pending
+            for _ in bodies:
+                self.bodies.popleft()
+
+
+def chat_key(update):
+    """ Updates with the same key are handled in order: those of one chat, of
+    one inline message (clicks on a game posted through inline mode), or of
+    one user outside of any chat (inline queries).
+    """
+    chat = update.effective_chat
+    if chat is not None:
+        return chat.id
+    query = update.callback_query
+    if query is not None and query.inline_message_id is not None:
+        return 'inline', query.inline_message_id
+    user = update.effective_user
+    if user is not None:
+        return 'user', user.id
+    return 'update', update.update_id
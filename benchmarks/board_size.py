@@ -0,0 +1,60 @@
+""" Reports how the cost of a move changes with the size of the board, for
+both engines and for rendering the board a move is shown on.
+
+Run from the repository root:
+
+    $ python -m benchmarks.board_size --games 2000
+"""
+import argparse
+import json
+
+from benchmarks.engine import ENGINES, bench_render, random_games, _no_win_check, _replay
+
+# Boards /start_game offers, smallest first, and a larger one the engines
+# can play but the bot doesn't offer
+SHAPES = [(6, 7, 4), (6, 7, 5), (8, 9, 4), (8, 9, 5), (10, 12, 5), (12, 12, 5), (30, 30, 5)]
+
+
+def bench_shape(shape, games):
+    """ Nanoseconds per move of each engine, and of its win check alone. """
+    moves = sum(len(g) for g in games)
+    results = {'shape': '{}x{}/{}'.format(*shape), 'area': shape[0] * shape[1]}
+    for name, engine in ENGINES.items():
+        # Best of three, these are short runs
+        play_sec = min(_replay(engine, shape, games)[0] for _ in range(3))
+        no_check_sec = min(_replay(_no_win_check(engine), shape, games)[0] for _ in range(3))
+        results[name] = {'ns_per_move': play_sec / moves * 1e9,
+                         'win_check_ns_per_move': max(0.0, play_sec - no_check_sec) / moves * 1e9}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--games', type=int, default=2000, help='random games per board size')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    results = []
+    for shape in SHAPES:
+        games = random_games(*shape, args.games)
+        r = bench_shape(shape, games)
+        r['render_us'] = bench_render(shape, games[:200])['warm_us_per_render']
+        results.append(r)
+
+    smallest = results[0]
+    print('{:>9} {:>5}  {:>24}  {:>24}  {:>9}'.format('board', 'area', *ENGINES, 'render'))
+    for r in results:
+        cells = ['{:6.0f} ns/move ({:4.2f}x)'.format(r[name]['ns_per_move'],
+                                                    r[name]['ns_per_move'] / smallest[name]['ns_per_move'])
+                 for name in ENGINES]
+        print('{:>9} {:>5}  {:>24}  {:>24}  {:6.1f} us'.format(r['shape'], r['area'], *cells, r['render_us']))
+    print('Win checks (ns/move): ' + ', '.join(
+        '{} {}'.format(r['shape'], '/'.join('{:.0f}'.format(r[name]['win_check_ns_per_move']) for name in ENGINES))
+        for r in results))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+""" Self-play throughput benchmark for the Connect4 engines, the NumPy batch
+engine, the board renderer and the full simulated handler path.
+
+Run from the repository root:
+
+    $ python -m benchmarks.engine --games 100000 --json results.json
+    $ python -m benchmarks.engine --baseline results.json
+"""
+import argparse
+import cProfile
+import json
+import pstats
+import random
+import time
+import tracemalloc
+from collections import defaultdict
+
+from BitboardConnect4 import BitboardConnect4
+from BoardRenderer import BoardRenderer
+from Connect4 import Connect4
+
+ENGINES = {'Connect4': Connect4, 'BitboardConnect4': BitboardConnect4}
+SHAPES = [(6, 7, 4), (4, 5, 3), (8, 9, 5), (10, 12, 5)]
+
+
+def _no_win_check(engine):
+    """ Subclass of `engine` whose win check always fails, to time the rest of
+    place_chip on its own.
+    """
+    return type('NoWinCheck' + engine.__name__, (engine,), {'_check_for_win': lambda self, *args: 0})
+
+
+def random_games(rows, cols, in_a_row, count, seed=0):
+    """ Move lists (player, col) of `count` random games, recorded up front so
+    the random number generator isn't part of the timings.
+    """
+    rand = random.Random(seed)
+    games = []
+    for _ in range(count):
+        game = BitboardConnect4(rows, cols, in_a_row)
+        moves = []
+        player = 1
+        while True:
+            col = rand.randint(1, cols)
+            res = game.place_chip(player, col)
+            if res == game.BAD_MOVE:
+                continue
+            moves.append((player, col))
+            if res != game.GOOD_MOVE:
+                break
+            player = 3 - player
+        games.append(moves)
+    return games
+
+
+def scripted_games(rows, cols, in_a_row, count):
+    """ Move lists of deterministic games, filling columns left to right with
+    the starting column shifted from game to game.
+    """
+    games = []
+    for i in range(count):
+        game = BitboardConnect4(rows, cols, in_a_row)
+        moves = []
+        player = 1
+        col = i % cols
+        while True:
+            move = col + 1
+            col = move % cols
+            res = game.place_chip(player, move)
+            if res == game.BAD_MOVE:
+                continue
+            moves.append((player, move))
+            if res != game.GOOD_MOVE:
+                break
+            player = 3 - player
+        games.append(moves)
+    return games
+
+
+def _replay(engine, shape, games):
+    """ Seconds taken to play every game, and to reset the game after each. """
+    game = engine(*shape)
+    place_chip = game.place_chip
+    reset = game.reset
+    play_sec = reset_sec = 0.0
+    clock = time.perf_counter
+    for moves in games:
+        start = clock()
+        for player, col in moves:
+            place_chip(player, col)
+        middle = clock()
+        reset()
+        end = clock()
+        play_sec += middle - start
+        reset_sec += end - middle
+    return play_sec, reset_sec
+
+
+def _replay_rendered(engine, shape, games):
+    """ Seconds taken to play every game rendering the board after each move,
+    as the bot does.
+    """
+    game = engine(*shape)
+    renderer = BoardRenderer(shape[1])
+    place_chip = game.place_chip
+    clock = time.perf_counter
+    start = clock()
+    for moves in games:
+        for player, col in moves:
+            place_chip(player, col)
+            renderer.render(game.board)
+        game.reset()
+    return clock() - start
+
+
+def _allocations(engine, shape, games):
+    """ Peak bytes allocated while playing a game, and blocks left behind by
+    one, averaged over the games.
+    """
+    game = engine(*shape)
+    tracemalloc.start()
+    peak_total = 0
+    before = tracemalloc.take_snapshot()
+    for moves in games:
+        tracemalloc.reset_peak()
+        start = tracemalloc.get_traced_memory()[0]
+        for player, col in moves:
+            game.place_chip(player, col)
+        game.board
+        peak_total += tracemalloc.get_traced_memory()[1] - start
+        game.reset()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+    return peak_total / len(games), blocks / len(games)
+
+
+def bench_engine(engine_name, shape, mode, games):
+    engine = ENGINES[engine_name]
+    moves = sum(len(g) for g in games)
+    play_sec, reset_sec = _replay(engine, shape, games)
+    no_check_sec, _ = _replay(_no_win_check(engine), shape, games)
+    rendered_sec = _replay_rendered(engine, shape, games)
+    peak_bytes, blocks = _allocations(engine, shape, games[:1000])
+    return {'engine': engine_name,
+            'shape': '{}x{}/{}'.format(*shape),
+            'mode': mode,
+            'games': len(games),
+            'moves': moves,
+            'moves_per_sec': moves / play_sec,
+            'rendered_moves_per_sec': moves / rendered_sec,
+            'win_check_ns_per_move': max(0.0, play_sec - no_check_sec) / moves * 1e9,
+            'reset_ns': reset_sec / len(games) * 1e9,
+            'peak_bytes_per_game': peak_bytes,
+            'blocks_left_per_game': blocks}
+
+
+def bench_render(shape, games):
+    """ Time per render of every position reached in `games`, with the row
+    cache warmed by the first pass.
+    """
+    rows, cols, in_a_row = shape
+    boards = []
+    for moves in games:
+        game = Connect4(rows, cols, in_a_row)
+        for player, col in moves:
+            game.place_chip(player, col)
+            boards.append([list(row) for row in game.board])
+    renderer = BoardRenderer(cols)
+    results = {'shape': '{}x{}/{}'.format(*shape), 'renders': len(boards)}
+    for label in ('cold_us_per_render', 'warm_us_per_render'):
+        start = time.perf_counter()
+        for board in boards:
+            renderer.render(board)
+        results[label] = (time.perf_counter() - start) / len(boards) * 1e6
+    return results
+
+
+def _category(filename):
+    for name in ('BitboardConnect4', 'Connect4Bot', 'Connect4', 'BoardRenderer', 'GameManager',
+                 'Reminder', 'FakeBot'):
+        if filename.endswith(name + '.py'):
+            return name
+    return 'other'
+
+
+def bench_handlers(games):
+    """ Plays `games` through GameManager with a fake Bot and reports the time
+    per callback, split by the module the time was spent in.
+    """
+    from FakeBot import FakeBot, callback_update, command_update, fake_context
+    from GameManager import GameManager
+
+    bot = FakeBot()
+    context = fake_context(bot)
+    manager = GameManager(game_factory=Connect4, max_games=len(games) + 1)
+    callbacks = 0
+    profile = cProfile.Profile()
+    start = time.perf_counter()
+    profile.enable()
+    for chat_id, moves in enumerate(games, 1):
+        manager.start_game(command_update(chat_id, 1, 'Player1'), context)
+        manager.p1(command_update(chat_id, 1, 'Player1'), context)
+        manager.p2(command_update(chat_id, 2, 'Player2'), context)
+        message_id = manager.board_keys[chat_id][1]
+        for player, col in moves:
+            manager.place_chip(callback_update(bot, chat_id, message_id, player, str(col)), context)
+            callbacks += 1
+        bot.calls.clear()
+    profile.disable()
+    total = time.perf_counter() - start
+
+    split = defaultdict(float)
+    for (filename, _, _), (_, _, tottime, _, _) in pstats.Stats(profile).stats.items():
+        split[_category(filename)] += tottime
+    profiled = sum(split.values())
+    return {'games': len(games),
+            'callbacks': callbacks,
+            'us_per_callback': total / callbacks * 1e6,
+            'share_by_module': {name: sec / profiled for name, sec in sorted(split.items())}}
+
+
+def bench_batch(shape, games):
+    """ Moves per second of BatchConnect4 replaying `games` all at once, one
+    ply of every game per call. Games that already ended are sent column 0.
+    """
+    import numpy as np
+
+    from BatchConnect4 import BatchConnect4
+
+    plies = max(len(moves) for moves in games)
+    cols = np.zeros((plies, len(games)), dtype=np.intp)
+    for i, moves in enumerate(games):
+        cols[:len(moves), i] = [col for _, col in moves]
+    batch = BatchConnect4(len(games), *shape)
+    start = time.perf_counter()
+    for ply in range(plies):
+        batch.place_chips(1 + ply % 2, cols[ply])
+    elapsed = time.perf_counter() - start
+    moves = sum(len(moves) for moves in games)
+    return {'shape': '{}x{}/{}'.format(*shape),
+            'games': len(games),
+            'moves': moves,
+            'moves_per_sec': moves / elapsed}
+
+
+def _compare(results, baseline):
+    """ Prints how moves/sec moved against a previous run. """
+    old = {(r['engine'], r['shape'], r['mode']): r for r in baseline.get('engines', [])}
+    for r in results['engines']:
+        prev = old.get((r['engine'], r['shape'], r['mode']))
+        if prev is not None:
+            print('{engine:>17} {shape:>9} {mode:>8}: {ratio:6.2f}x moves/sec vs baseline'.format(
+                ratio=r['moves_per_sec'] / prev['moves_per_sec'], **r))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--games', type=int, default=5000, help='games per engine, shape and mode')
+    parser.add_argument('--handler-games', type=int, default=500, help='games played through the handlers')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare against results written by an earlier run')
+    args = parser.parse_args()
+
+    results = {'engines': [], 'render': [], 'batch': [], 'handlers': None}
+    for shape in SHAPES:
+        modes = {'random': random_games(*shape, args.games),
+                 'scripted': scripted_games(*shape, args.games)}
+        for mode, games in modes.items():
+            for engine_name in ENGINES:
+                r = bench_engine(engine_name, shape, mode, games)
+                results['engines'].append(r)
+                print('{engine:>17} {shape:>9} {mode:>8}: {moves_per_sec:10.0f} moves/s, '
+                      '{rendered_moves_per_sec:8.0f} rendered, win check {win_check_ns_per_move:6.0f} ns/move, '
+                      'reset {reset_ns:6.0f} ns, peak {peak_bytes_per_game:6.0f} B/game'.format(**r))
+        r = bench_render(shape, modes['random'][:1000])
+        results['render'].append(r)
+        print('{:>17} {shape:>9}: {cold_us_per_render:6.1f} us/render cold, '
+              '{warm_us_per_render:6.1f} us/render warm'.format('render', **r))
+
+    for shape in SHAPES:
+        try:
+            r = bench_batch(shape, random_games(*shape, args.games))
+        except ImportError as e:
+            print('Skipping batch benchmark: {}'.format(e))
+            break
+        except ValueError:
+            # Board too big for the batch engine's 64 bit boards
+            continue
+        results['batch'].append(r)
+        print('{:>17} {shape:>9}   random: {moves_per_sec:10.0f} moves/s'.format('BatchConnect4', **r))
+
+    try:
+        r = bench_handlers(random_games(6, 7, 4, args.handler_games, seed=1))
+    except ImportError as e:
+        print('Skipping handler benchmark: {}'.format(e))
+    else:
+        results['handlers'] = r
+        print('{:>17}: {us_per_callback:6.1f} us/callback'.format('handlers', **r))
+        for name, share in r['share_by_module'].items():
+            print('{:>17}   {:5.1%} in {}'.format('', share, name))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            _compare(results, json.load(f))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+""" Reports how long importing each of the bot's modules takes in a fresh
+interpreter, and which heavy dependencies the import pulls in.
+
+Run from the repository root:
+
+    $ python -m benchmarks.import_time --runs 5
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+MODULES = ['Connect4', 'BitboardConnect4', 'BoardRenderer', 'Connect4Bot', 'GameManager',
+           'connect4_bot_script']
+# Dependencies only some code paths need, which should be loaded late if at all
+HEAVY = ['telegram', 'emoji', 'asyncio', 'multiprocessing', 'http.server', 'argparse', 'numpy']
+
+_PROBE = ('import sys, time\n'
+          'start = time.perf_counter()\n'
+          'import {module}\n'
+          'elapsed = time.perf_counter() - start\n'
+          'print(elapsed, *[name for name in {heavy!r} if name in sys.modules])\n')
+
+
+def import_time(module, runs):
+    """ Median seconds to import `module` in a new interpreter, and the heavy
+    dependencies it loaded.
+    """
+    times = []
+    loaded = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', _PROBE.format(module=module, heavy=HEAVY)],
+                             check=True, capture_output=True, text=True).stdout.split()
+        times.append(float(out[0]))
+        loaded = out[1:]
+    return statistics.median(times), loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per module')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    results = {}
+    for module in MODULES:
+        try:
+            seconds, loaded = import_time(module, args.runs)
+        except subprocess.CalledProcessError as e:
+            print('Skipping {}: {}'.format(module, e.stderr.strip().splitlines()[-1]))
+            continue
+        results[module] = {'ms': seconds * 1000, 'loaded': loaded}
+        print('{:>20}: {:7.1f} ms  loads {}'.format(module, seconds * 1000, ', '.join(loaded) or 'nothing heavy'))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,308 @@
+""" Load tests the bot's handlers without Telegram: updates are parsed and
+dispatched through the handlers connect4_bot_script registers, with the
+game, outbound queue and stores wired as in its main(), over a fake Bot
+that simulates API latency and flood-waits (429).
+
+Each chat is played by one simulated user at a time, who sends its next
+update once the last one was handled, and `--concurrency` chats are played
+at once. Every level of concurrency is run on a fresh bot, so the level at
+which throughput stops growing and latency climbs is where the dispatcher
+saturates.
+
+Play synthetic games (setup, moves, misclicks, quits):
+
+    $ python -m benchmarks.load --chats 200 --concurrency 4,16,64 --latency 0.05 --flood-rate 0.01
+
+or replay recorded updates (a JSON array, or one update per line):
+
+    $ python -m benchmarks.load --updates updates.json --concurrency 8,32
+"""
+import argparse
+import json
+import logging as lg
+import os
+import queue
+import random
+import statistics
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from benchmarks.webhook_replay import callback_json, command_json, load_updates, _chat_id
+
+# Allowed users of chat c are 2c + 1 and 2c + 2, strangers are offset by this
+STRANGER_OFFSET = 10 ** 9
+
+
+def _user_ids(update):
+    """ Ids of the users sending a recorded update, for the allow list. """
+    for field in ('message', 'callback_query'):
+        if field in update and 'from' in update[field]:
+            yield update[field]['from']['id']
+
+
+def synthetic_chat(chat_id, board_message_id, rand, misclick_rate, quit_rate):
+    """ Yields the update JSON of one game in the chat, with the moves picked
+    at random as the game goes. `board_message_id()` returns the message id of
+    the chat's board once it is posted.
+    """
+    from BitboardConnect4 import BitboardConnect4
+
+    users = (2 * chat_id + 1, 2 * chat_id + 2)
+    yield command_json(chat_id, users[0], 'start_game')
+    yield command_json(chat_id, users[0], 'p1')
+    yield command_json(chat_id, users[1], 'p2')
+    message_id = board_message_id()
+    if message_id is None:
+        return
+    game = BitboardConnect4()
+    quit_at = rand.randrange(game.spaces) if rand.random() < quit_rate else None
+    player = 0
+    while True:
+        if game.move_count == quit_at:
+            yield command_json(chat_id, users[rand.randrange(2)], 'quit')
+            return
+        col = rand.randint(1, game.cols)
+        if rand.random() < misclick_rate:
+            # Out of turn, or from someone who isn't on the allow list
+            user_id = users[1 - player] if rand.random() < 0.5 else STRANGER_OFFSET + chat_id
+            yield callback_json(chat_id, message_id, user_id, str(col))
+            continue
+        yield callback_json(chat_id, message_id, users[player], str(col))
+        # A full column only gets a notification, the player picks again
+        res = game.place_chip(player + 1, col)
+        if res == game.BAD_MOVE:
+            continue
+        if res != game.GOOD_MOVE:
+            return
+        player = 1 - player
+
+
+def recorded_chat(updates, board_message_id):
+    """ Yields the recorded updates of one chat, with board clicks pointed at
+    the board the fake Bot posted instead of the recorded one.
+    """
+    for update in updates:
+        query = update.get('callback_query')
+        if query is not None and 'message' in query:
+            message_id = board_message_id()
+            if message_id is not None:
+                query = dict(query, message=dict(query['message'], message_id=message_id))
+                update = dict(update, callback_query=query)
+        yield update
+
+
+def _percentile(values, share):
+    return values[min(len(values) - 1, int(len(values) * share))] if values else None
+
+
+def run(scripts, allow_list, concurrency, workers, latency, flood_rate, retry_after, global_rate, chat_rate,
+        seed=0):
+    """ Plays every chat script, `concurrency` chats at once, through a fresh
+    bot with `workers` dispatcher workers.
+
+    Parameters
+    ----------
+    scripts : dict
+        chat_id -> function taking a board_message_id function and returning
+        an iterable of the chat's update JSON, see synthetic_chat.
+
+    Returns
+    -------
+    dict
+        Updates handled, throughput, handler latency percentiles (from the
+        update being queued to its handler returning), thread counts and
+        Telegram API calls.
+    """
+    from telegram import Update
+    from telegram.ext import Dispatcher
+
+    from AllowListFilter import AllowListFilter
+    from Connect4 import Connect4
+    from FakeBot import FakeBot
+    from GameManager import GameManager
+    from GameStore import GameStore
+    from OutboundQueue import OutboundQueue
+    from StatsStore import StatsStore
+    from connect4_bot_script import add_handlers
+
+    done = {}
+    latencies = []
+    lock = threading.Lock()
+
+    def handled(update):
+        event, queued_at = done.pop(update.update_id)
+        with lock:
+            latencies.append(time.perf_counter() - queued_at)
+        event.set()
+
+    class TimedDispatcher(Dispatcher):
+        """ Dispatcher telling `handled` when the handler of an update returns,
+        or when it has none to run on a worker.
+        """
+
+        def run_async(self, func, *args, update=None, **kwargs):
+            def timed(*a, **kw):
+                try:
+                    return func(*a, **kw)
+                finally:
+                    handled(update)
+            self.handed_off = True
+            return super().run_async(timed, *args, update=update, **kwargs)
+
+        def process_update(self, update):
+            self.handed_off = False
+            super().process_update(update)
+            if not self.handed_off:
+                handled(update)
+
+    # Threads left behind by earlier runs, such as their outbound queues
+    baseline_threads = threading.active_count()
+    bot = FakeBot(latency=latency, flood_rate=flood_rate, retry_after=retry_after, seed=seed)
+    dispatcher = TimedDispatcher(bot, queue.Queue(), workers=workers)
+    with tempfile.TemporaryDirectory() as tmp:
+        outbox = OutboundQueue(bot, global_rate=global_rate, chat_rate=chat_rate)
+        store = GameStore(os.path.join(tmp, 'games.db'))
+        stats = StatsStore(os.path.join(tmp, 'stats.db'))
+        manager = GameManager(game_factory=Connect4, max_games=len(scripts) + 1, outbox=outbox,
+                              store=store, stats=stats)
+        add_handlers(dispatcher, manager, AllowListFilter(allow_list))
+        dispatcher_thread = threading.Thread(target=dispatcher.start, name='dispatcher')
+        dispatcher_thread.start()
+
+        def send(data):
+            update = Update.de_json(data, bot)
+            event = threading.Event()
+            done[update.update_id] = (event, time.perf_counter())
+            dispatcher.update_queue.put(update)
+            event.wait()
+
+        work = queue.Queue()
+        for chat_id, script in scripts.items():
+            work.put((chat_id, script))
+
+        def client():
+            while True:
+                try:
+                    chat_id, script = work.get_nowait()
+                except queue.Empty:
+                    return
+
+                def board_message_id():
+                    key = manager.board_keys.get(chat_id)
+                    return None if key is None else key[1]
+                for data in script(board_message_id):
+                    send(data)
+
+        peak_threads = [threading.active_count()]
+        running = threading.Event()
+        running.set()
+
+        def sample_threads():
+            while running.is_set():
+                peak_threads[0] = max(peak_threads[0], threading.active_count())
+                time.sleep(0.01)
+
+        sampler = threading.Thread(target=sample_threads, name='thread-sampler')
+        sampler.start()
+        clients = [threading.Thread(target=client, name='client-{}'.format(i)) for i in range(concurrency)]
+        start = time.perf_counter()
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        running.clear()
+        sampler.join()
+        # The sampler and client threads aren't part of the bot
+        peak_threads = peak_threads[0] - baseline_threads - 1 - concurrency
+
+        # Messages still waiting for the flood limits once every update was handled
+        while len(outbox):
+            time.sleep(0.01)
+        drain_sec = time.perf_counter() - start - elapsed
+
+        dispatcher.stop()
+        dispatcher_thread.join()
+        store.close()
+        stats.close()
+
+    latencies.sort()
+    calls = {}
+    for method, _ in bot.calls:
+        calls[method] = calls.get(method, 0) + 1
+    return {'concurrency': concurrency,
+            'workers': workers,
+            'updates': len(latencies),
+            'seconds': elapsed,
+            'updates_per_sec': len(latencies) / elapsed,
+            'p50_ms': statistics.median(latencies) * 1000 if latencies else None,
+            'p99_ms': _percentile(latencies, 0.99) * 1000 if latencies else None,
+            'max_ms': latencies[-1] * 1000 if latencies else None,
+            'peak_bot_threads': peak_threads,
+            'outbox_drain_sec': drain_sec,
+            'edits_coalesced': outbox.coalesced,
+            'api_calls': calls,
+            'flood_errors': bot.flood_errors}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--updates', help='recorded updates to replay instead of synthetic games')
+    parser.add_argument('--chats', type=int, default=100, help='synthetic chats, one game each')
+    parser.add_argument('--misclick-rate', type=float, default=0.1,
+                        help='share of clicks out of turn or from strangers')
+    parser.add_argument('--quit-rate', type=float, default=0.1, help='share of games quit before the end')
+    parser.add_argument('--concurrency', default='1,4,16,64', help='comma separated chats played at once')
+    parser.add_argument('--workers', type=int, default=8, help='dispatcher worker threads')
+    parser.add_argument('--latency', type=float, default=0.05, help='simulated Telegram API latency')
+    parser.add_argument('--flood-rate', type=float, default=0.0, help='share of messages failing with 429')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='seconds each 429 asks to wait')
+    parser.add_argument('--global-rate', type=float, default=30, help='outbound messages per second')
+    parser.add_argument('--chat-rate', type=float, default=1, help='outbound messages per second per chat')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    # Importing the script configures logging, keep the games (and expected flood-waits) quiet
+    import connect4_bot_script  # noqa: F401
+    lg.getLogger().setLevel(lg.ERROR)
+
+    if args.updates:
+        by_chat = OrderedDict()
+        for update in load_updates(args.updates):
+            by_chat.setdefault(_chat_id(update), []).append(update)
+        allow_list = {user_id for updates in by_chat.values() for update in updates
+                      for user_id in _user_ids(update)}
+
+        def make_scripts():
+            return {chat_id: lambda board, updates=updates: recorded_chat(updates, board)
+                    for chat_id, updates in by_chat.items()}
+    else:
+        allow_list = range(1, 2 * args.chats + 3)
+
+        def make_scripts():
+            return {chat_id: lambda board, chat_id=chat_id: synthetic_chat(
+                        chat_id, board, random.Random(args.seed * 1000003 + chat_id), args.misclick_rate,
+                        args.quit_rate)
+                    for chat_id in range(1, args.chats + 1)}
+
+    results = []
+    for concurrency in [int(level) for level in args.concurrency.split(',')]:
+        r = run(make_scripts(), allow_list, concurrency, args.workers, args.latency, args.flood_rate,
+                args.retry_after, args.global_rate, args.chat_rate, seed=args.seed)
+        results.append(r)
+        print('concurrency {concurrency:>4}: {updates:6d} updates in {seconds:6.1f}s, {updates_per_sec:7.1f}/s, '
+              'p50 {p50_ms:7.1f} ms, p99 {p99_ms:7.1f} ms, max {max_ms:7.1f} ms, '
+              '{peak_bot_threads} threads'.format(**r))
+        calls = ', '.join('{} {}'.format(method, count) for method, count in sorted(r['api_calls'].items()))
+        print('                  API calls: {}; {} flood-waits, {} edits coalesced, outbox drained {:.1f}s '
+              'later'.format(calls, r['flood_errors'], r['edits_coalesced'], r['outbox_drain_sec']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+""" Reports the memory held per live game, to size hosts for a number of
+concurrent games.
+
+Run from the repository root:
+
+    $ python -m benchmarks.memory --games 10000
+"""
+import argparse
+import gc
+import json
+import random
+import tracemalloc
+
+from BitboardConnect4 import BitboardConnect4
+from Connect4 import Connect4
+
+
+def _play(game, moves, rand):
+    """ Plays `moves` random legal moves, stopping early if the game ends. """
+    player = 1
+    for _ in range(moves):
+        res = game.place_chip(player, rand.randint(1, game.cols))
+        if res == game.BAD_MOVE:
+            continue
+        if res != game.GOOD_MOVE:
+            break
+        player = 3 - player
+
+
+def _bytes_per_item(make, count):
+    """ Bytes allocated per item when `count` items made by `make` are alive. """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    items = [make(i) for i in range(count)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    total = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    # The list holding the items is not part of a game
+    total -= len(items) * 8
+    del items
+    return total / count
+
+
+def engine_memory(engine, count, moves, seed=0):
+    rand = random.Random(seed)
+
+    def make(_):
+        game = engine()
+        _play(game, moves, rand)
+        return game
+    # Warm up per-shape tables so they aren't charged to the first games
+    make(0)
+    return _bytes_per_item(make, count)
+
+
+def session_memory(count, moves, seed=0):
+    """ Bytes per started Connect4Bot game, engine and reminder included. """
+    from Connect4Bot import Connect4Bot
+    from FakeBot import FakeBot, command_update, fake_context
+    from Reminder import ReminderScheduler
+
+    rand = random.Random(seed)
+    bot = FakeBot()
+    context = fake_context(bot)
+    scheduler = ReminderScheduler()
+
+    def make(i):
+        session = Connect4Bot(BitboardConnect4(), scheduler)
+        session.p1(command_update(i, 1, 'Player1'), context)
+        session.p2(command_update(i, 2, 'Player2'), context)
+        _play(session.game, moves, rand)
+        return session
+    make(0)
+    bot.calls.clear()
+    per_game = _bytes_per_item(make, count)
+    # Calls recorded by the fake bot are not part of a game
+    bot.calls.clear()
+    return per_game
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--games', type=int, default=10000, help='live games to allocate')
+    parser.add_argument('--moves', type=int, default=20, help='random moves played in each game')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    results = {'games': args.games, 'moves': args.moves,
+               'Connect4': engine_memory(Connect4, args.games, args.moves),
+               'BitboardConnect4': engine_memory(BitboardConnect4, args.games, args.moves)}
+    try:
+        results['Connect4Bot session'] = session_memory(args.games, args.moves)
+    except ImportError as e:
+        print('Skipping Connect4Bot sessions: {}'.format(e))
+
+    for name, value in results.items():
+        if isinstance(value, float):
+            print('{:>22}: {:8.0f} bytes/game'.format(name, value))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+""" Fires concurrent inline keyboard callbacks at the same games through
+GameManager, as a threaded dispatcher would, and checks that moves within a
+game stay serialized.
+
+Run from the repository root:
+
+    $ python -m benchmarks.stress --games 200 --clickers 4 --workers 16
+    $ python -m benchmarks.stress --unlocked   # shows what goes wrong without the game locks
+"""
+import argparse
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from BitboardConnect4 import BitboardConnect4
+from Connect4Bot import Connect4Bot
+from FakeBot import FakeBot, callback_update, command_update, fake_context
+from GameManager import GameManager
+
+
+class CheckedConnect4(BitboardConnect4):
+    """ Engine counting moves which overlap another move of the same game, or
+    are made for the player whose turn it isn't.
+    """
+    overlaps = 0
+    out_of_turn = 0
+    counts_lock = threading.Lock()
+
+    def __init__(self, *args):
+        self.busy = False
+        super().__init__(*args)
+
+    def place_chip(self, player, col):
+        if self.busy:
+            with self.counts_lock:
+                CheckedConnect4.overlaps += 1
+        self.busy = True
+        try:
+            expected = 1 + self.move_count % 2
+            # Widen the window for interleaving moves
+            time.sleep(0)
+            res = super().place_chip(player, col)
+            if res != self.BAD_MOVE and player != expected:
+                with self.counts_lock:
+                    CheckedConnect4.out_of_turn += 1
+            return res
+        finally:
+            self.busy = False
+
+
+class _NoLock(object):
+    """ Lock which doesn't lock, for --unlocked runs. """
+
+    def acquire(self):
+        return True
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class _UnlockedBot(Connect4Bot):
+    __slots__ = ()
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.lock = _NoLock()
+
+
+def _clicker(manager, bot, chat_id, user_id, cols, max_clicks, errors):
+    context = fake_context(bot)
+    rand = random.Random(chat_id * 31 + user_id)
+    key = manager.board_keys.get(chat_id)
+    clicks = 0
+    while clicks < max_clicks and key is not None and manager.board_keys.get(chat_id) == key:
+        try:
+            manager.place_chip(callback_update(bot, chat_id, key[1], user_id, str(rand.randint(1, cols))), context)
+        except Exception as e:
+            errors.append(e)
+        clicks += 1
+    return clicks
+
+
+def run(games, clickers, workers, latency, unlocked, max_clicks):
+    bot = FakeBot(latency=lambda: random.random() * latency)
+    manager = GameManager(game_factory=CheckedConnect4, max_games=games + 1)
+    if unlocked:
+        manager.session_class = _UnlockedBot
+    context = fake_context(bot)
+    for chat_id in range(1, games + 1):
+        manager.start_game(command_update(chat_id, 1, 'Player1'), context)
+        manager.p1(command_update(chat_id, 1, 'Player1'), context)
+        manager.p2(command_update(chat_id, 2, 'Player2'), context)
+
+    errors = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(workers) as pool:
+        futures = [pool.submit(_clicker, manager, bot, chat_id, 1 + i % 2, 7, max_clicks, errors)
+                   for chat_id in range(1, games + 1) for i in range(clickers)]
+        callbacks = sum(f.result() for f in futures)
+    elapsed = time.perf_counter() - start
+    return {'callbacks': callbacks,
+            'callbacks_per_sec': callbacks / elapsed,
+            'overlapping_moves': CheckedConnect4.overlaps,
+            'out_of_turn_moves': CheckedConnect4.out_of_turn,
+            'errors': len(errors),
+            'first_error': repr(errors[0]) if errors else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--games', type=int, default=200, help='games played at the same time')
+    parser.add_argument('--clickers', type=int, default=4, help='threads clicking on each game')
+    parser.add_argument('--workers', type=int, default=16, help='dispatcher worker threads')
+    parser.add_argument('--latency', type=float, default=0.002, help='maximum simulated Telegram API latency')
+    parser.add_argument('--max-clicks', type=int, default=200, help='clicks per clicker before giving up')
+    parser.add_argument('--unlocked', action='store_true', help='replace the game locks with no-ops')
+    args = parser.parse_args()
+
+    results = run(args.games, args.clickers, args.workers, args.latency, args.unlocked, args.max_clicks)
+    for name, value in results.items():
+        print('{:>20}: {}'.format(name, value))
+    if not args.unlocked and (results['overlapping_moves'] or results['out_of_turn_moves'] or results['errors']):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+""" Posts Telegram update JSON to a webhook, as Telegram would, and reports
+how quickly the updates are acknowledged.
+
+Replay recorded updates (a JSON array, or one update per line) against a
+running bot:
+
+    $ python -m benchmarks.webhook_replay --url http://127.0.0.1:8443/telegram --updates updates.json
+
+or play synthetic games against a local WebhookServer backed by a fake Bot:
+
+    $ python -m benchmarks.webhook_replay --local --games 500 --clients 16
+"""
+import argparse
+import itertools
+import json
+import logging as lg
+import queue
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+def _user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': 'Player{}'.format(user_id)}
+
+
+def command_json(chat_id, user_id, command):
+    text = '/' + command
+    return {'update_id': next(_update_ids),
+            'message': {'message_id': next(_message_ids), 'date': int(time.time()),
+                        'chat': {'id': chat_id, 'type': 'group', 'title': 'Chat {}'.format(chat_id)},
+                        'from': _user(user_id), 'text': text,
+                        'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]}}
+
+
+def callback_json(chat_id, message_id, user_id, data):
+    return {'update_id': next(_update_ids),
+            'callback_query': {'id': str(next(_update_ids)), 'from': _user(user_id),
+                               'chat_instance': str(chat_id), 'data': data,
+                               'message': {'message_id': message_id, 'date': int(time.time()),
+                                           'chat': {'id': chat_id, 'type': 'group'},
+                                           'text': 'board'}}}
+
+
+def load_updates(path):
+    with open(path) as f:
+        text = f.read()
+    if text.lstrip().startswith('['):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def _chat_id(update):
+    for field in ('message', 'edited_message', 'channel_post'):
+        if field in update:
+            return update[field]['chat']['id']
+    query = update.get('callback_query')
+    if query is not None and 'message' in query:
+        return query['message']['chat']['id']
+    return None
+
+
+def post(url, updates, clients, batch, secret_token=None):
+    """ Posts the updates with `clients` concurrent connections. Updates of
+    one chat are posted in order by a single client, as Telegram does.
+
+    Returns
+    -------
+    dict
+        Request count, refused (503) requests and acknowledgement latencies.
+    """
+    by_chat = OrderedDict()
+    for update in updates:
+        by_chat.setdefault(_chat_id(update), []).append(update)
+    work = queue.Queue()
+    for chat_updates in by_chat.values():
+        work.put(chat_updates)
+
+    latencies = []
+    refused = [0]
+    lock = threading.Lock()
+    headers = {'Content-Type': 'application/json'}
+    if secret_token is not None:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = secret_token
+
+    def client():
+        while True:
+            try:
+                chat_updates = work.get_nowait()
+            except queue.Empty:
+                return
+            for i in range(0, len(chat_updates), batch):
+                chunk = chat_updates[i:i + batch]
+                body = json.dumps(chunk if batch > 1 else chunk[0]).encode('utf-8')
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        urllib.request.urlopen(urllib.request.Request(url, body, headers)).read()
+                    except urllib.error.HTTPError as e:
+                        if e.code != 503:
+                            raise
+                        with lock:
+                            refused[0] += 1
+                        # Telegram retries later too
+                        time.sleep(0.05)
+                        continue
+                    with lock:
+                        latencies.append(time.perf_counter() - start)
+                    break
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    return {'requests': len(latencies),
+            'refused': refused[0],
+            'ack_p50_ms': statistics.median(latencies) * 1000 if latencies else None,
+            'ack_p99_ms': latencies[int(len(latencies) * 0.99)] * 1000 if latencies else None}
+
+
+def run_local(games, clients, batch, workers, max_pending, latency):
+    """ Plays `games` games against a local WebhookServer over a fake Bot:
+    setup commands first, then every game's moves once its board is posted.
+    """
+    from telegram.ext import Dispatcher
+
+    from AllowListFilter import AllowListFilter
+    from BitboardConnect4 import BitboardConnect4
+    from FakeBot import FakeBot
+    from GameManager import GameManager
+    from WebhookServer import WebhookServer
+    from connect4_bot_script import add_handlers
+
+    # Importing the script configures logging, keep the games quiet
+    lg.getLogger().setLevel(lg.WARNING)
+    bot = FakeBot(latency=latency)
+    # Handlers run on the server's workers, the dispatcher needs none of its own
+    dispatcher = Dispatcher(bot, queue.Queue(), workers=1)
+    manager = GameManager(game_factory=BitboardConnect4, max_games=games + 1)
+    add_handlers(dispatcher, manager, AllowListFilter([1, 2]), run_async=False)
+    server = WebhookServer(dispatcher, port=0, workers=workers, max_pending=max_pending)
+    server.start()
+    url = 'http://{}:{}{}'.format(*server.address, server.path)
+
+    def wait_idle():
+        while server.pending:
+            time.sleep(0.01)
+
+    chats = range(1, games + 1)
+    start = time.perf_counter()
+    setup = [command_json(chat_id, user_id, command) for chat_id in chats
+             for user_id, command in ((1, 'start_game'), (1, 'p1'), (2, 'p2'))]
+    results = post(url, setup, clients, batch)
+    wait_idle()
+    moves = [callback_json(chat_id, manager.board_keys[chat_id][1], 1 + i % 2, str(col)) for chat_id in chats
+             for i, col in enumerate((1, 2, 1, 2, 1, 2, 1))]
+    move_results = post(url, moves, clients, batch)
+    wait_idle()
+    elapsed = time.perf_counter() - start
+    server.stop()
+
+    results['requests'] += move_results['requests']
+    results['refused'] += move_results['refused']
+    results['ack_p50_ms'] = move_results['ack_p50_ms']
+    results['ack_p99_ms'] = move_results['ack_p99_ms']
+    results['updates'] = len(setup) + len(moves)
+    results['updates_per_sec'] = results['updates'] / elapsed
+    results['games_won'] = sum(1 for method, kwargs in bot.calls
+                               if method == 'edit_message_text' and ' wins!' in kwargs['text'])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', help='webhook to post to')
+    parser.add_argument('--updates', help='recorded updates to post')
+    parser.add_argument('--secret', help='webhook secret token')
+    parser.add_argument('--local', action='store_true', help='play synthetic games against a local server')
+    parser.add_argument('--games', type=int, default=200, help='synthetic games to play')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent HTTP clients')
+    parser.add_argument('--batch', type=int, default=1, help='updates per request')
+    parser.add_argument('--workers', type=int, default=8, help='local server worker threads')
+    parser.add_argument('--max-pending', type=int, default=1000, help='local server queue size')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated Telegram API latency')
+    args = parser.parse_args()
+
+    if args.local:
+        results = run_local(args.games, args.clients, args.batch, args.workers, args.max_pending, args.latency)
+    elif args.url and args.updates:
+        results = post(args.url, load_updates(args.updates), args.clients, args.batch, args.secret)
+    else:
+        parser.error('use --local, or --url with --updates')
+    for name, value in results.items():
+        print('{:>16}: {}'.format(name, value))
+
+
+if __name__ == '__main__':
+    main()
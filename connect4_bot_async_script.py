@@ -0,0 +1,71 @@
+import logging as lg
+
+from telegram import Update
+from telegram.ext import (Application, ApplicationHandlerStop, CommandHandler, CallbackQueryHandler, ContextTypes,
+                          filters)
+
+import my_env as env
+from AsyncConnect4Bot import AsyncGameManager
+from Connect4 import Connect4
+from Metrics import get_registry
+from StatsStore import StatsStore
+
+# Basic logging
+lg.basicConfig(
+    format='%(asctime)s - %(name)20s - %(levelname)7s - %(message)s', level=lg.INFO
+)
+logger = lg.getLogger(__name__)
+
+allowed_users = frozenset(env.user_allow_list)
+
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Log the error before we do anything else, so we can see it even if something breaks.
+    logger.error(msg="Exception while handling an update:", exc_info=context.error)
+
+
+async def check_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # CallbackQueryHandler takes no filters, so board clicks of users not on the
+    # allow list are stopped here, before the handlers of later groups
+    if update.effective_user is None or update.effective_user.id not in allowed_users:
+        get_registry().counter('connect4_rejected_updates_total', help='Updates from users not on the allow list').inc()
+        raise ApplicationHandlerStop()
+
+
+def main():
+    # Initialize bot (telegram, asyncio based API). Updates of different chats
+    # are handled concurrently, so a slow chat doesn't hold up the others.
+    application = Application.builder().token(env.connect4_token).concurrent_updates(True).build()
+    # Initialize store of finished games, for /stats and /leaderboard
+    stats = StatsStore()
+    # Initialize Connect4 game manager
+    my_bot = AsyncGameManager(game_factory=Connect4, stats=stats)
+    # Initialize allow list filter
+    my_filter = filters.User(user_id=allowed_users)
+
+    # Register commands with the Telegram Bot
+    application.add_handler(CommandHandler('start_game', my_bot.start_game, filters=my_filter))
+    application.add_handler(CommandHandler('p1', my_bot.p1, filters=my_filter))
+    application.add_handler(CommandHandler('p2', my_bot.p2, filters=my_filter))
+    application.add_handler(CommandHandler('vs_bot', my_bot.vs_bot, filters=my_filter))
+    application.add_handler(CommandHandler('quit', my_bot.quit, filters=my_filter))
+    application.add_handler(CommandHandler('hint', my_bot.hint, filters=my_filter))
+    application.add_handler(CommandHandler('undo', my_bot.undo, filters=my_filter))
+    application.add_handler(CommandHandler('replay', my_bot.replay, filters=my_filter))
+    application.add_handler(CommandHandler('stats', my_bot.stats_command, filters=my_filter))
+    application.add_handler(CommandHandler('leaderboard', my_bot.leaderboard, filters=my_filter))
+
+    # Register player actions, behind the allow list
+    application.add_handler(CallbackQueryHandler(check_callback), group=-1)
+    application.add_handler(CallbackQueryHandler(my_bot.place_chip))
+
+    # Log errors
+    application.add_error_handler(error_handler)
+
+    # Start the Bot, blocking until you press Ctrl-C
+    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    stats.close()
+
+
+if __name__ == '__main__':
+    main()
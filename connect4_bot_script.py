@@ -1,12 +1,21 @@
+import functools
 import logging as lg
+import signal
+import threading
 
-from telegram import Update
-from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, CallbackContext
+from telegram import Bot, Update
+from telegram.ext import (Updater, CommandHandler, CallbackQueryHandler, CallbackContext, Dispatcher,
+                          InlineQueryHandler, TypeHandler)
 
-import my_env as env
 from AllowListFilter import AllowListFilter
 from Connect4 import Connect4
-from Connect4Bot import Connect4Bot
+from GameManager import GameManager
+from GameStore import GameStore
+from Metrics import enable_metrics, LogExporter, PrometheusExporter
+from OutboundQueue import OutboundQueue
+from ShardRouter import ShardRouter
+from StatsStore import StatsStore
+from WebhookServer import WebhookServer
 
 # Basic logging
 lg.basicConfig(
@@ -21,39 +30,121 @@ def error_handler(update: Update, context: CallbackContext) -> None:
 
 
 def main():
+    # Imported here so add_handlers can be used without the bot's credentials
+    import my_env as env
+
+    # Record metrics if an exporter is configured, before anything registers gauges
+    metrics_port = getattr(env, 'metrics_port', None)
+    metrics_log_sec = getattr(env, 'metrics_log_sec', None)
+    if metrics_port or metrics_log_sec:
+        registry = enable_metrics()
+        if metrics_port:
+            PrometheusExporter(registry, port=metrics_port).start()
+        if metrics_log_sec:
+            LogExporter(registry, interval_sec=metrics_log_sec).start()
+
     # Initialize bot (telegram)
-    updater = Updater(token=env.connect4_token, use_context=True)
+    updater = Updater(token=env.connect4_token, use_context=True, workers=getattr(env, 'workers', 8))
     dispatcher = updater.dispatcher
-    # Initialize Connect4 wrapper
-    game = Connect4()
-    my_bot = Connect4Bot(game)
-    # Initialize allow list filter
-    my_filter = AllowListFilter(env.user_allow_list)
-
+    webhook_url = getattr(env, 'webhook_url', None)
+    shards = getattr(env, 'shards', 1)
+    # File of more allowed user ids, reloaded when it changes
+    allow_list_path = getattr(env, 'user_allow_list_path', None)
+
+    if shards > 1:
+        # Games live in shard processes, this one only routes updates to them
+        router = ShardRouter(shards, functools.partial(Bot, env.connect4_token), env.user_allow_list,
+                             allow_list_path=allow_list_path, workers=getattr(env, 'workers', 8))
+        router.start()
+        dispatcher.add_handler(TypeHandler(Update, router.route))
+        dispatcher.add_error_handler(error_handler)
+    else:
+        router = None
+        # Initialize rate limited queue for outgoing messages
+        outbox = OutboundQueue(updater.bot)
+        # Initialize store of games in progress, and reload the stored ones lazily
+        store = GameStore()
+        # Initialize store of finished games, for /stats and /leaderboard
+        stats = StatsStore()
+        # Initialize Connect4 game manager
+        my_bot = GameManager(game_factory=Connect4, outbox=outbox, store=store, stats=stats)
+        my_bot.restore(updater.bot)
+        # Initialize allow list filter
+        my_filter = AllowListFilter(env.user_allow_list, allow_list_path)
+        # The webhook server runs handlers on its own workers, in order within each chat
+        add_handlers(dispatcher, my_bot, my_filter, run_async=webhook_url is None)
+
+    if webhook_url is None:
+        # Start the Bot
+        updater.start_polling()
+        # Block until you press Ctrl-C
+        updater.idle()
+    else:
+        secret_token = getattr(env, 'webhook_secret', None)
+        server = WebhookServer(dispatcher, port=getattr(env, 'webhook_port', 8443), secret_token=secret_token,
+                               workers=getattr(env, 'workers', 8))
+        server.start()
+        updater.bot.set_webhook(url=webhook_url, secret_token=secret_token)
+        # Block until you press Ctrl-C. Not with updater.idle, which exits the
+        # process on a signal when the Updater itself isn't running
+        stop = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+            signal.signal(signum, lambda signum, frame: stop.set())
+        stop.wait()
+        logger.info('Stopping the webhook server')
+        server.stop()
+
+    # Write out the latest state of every game
+    if router is not None:
+        router.stop()
+    else:
+        store.close()
+        stats.close()
+
+
+def add_handlers(dispatcher: Dispatcher,
+                 my_bot: GameManager,
+                 my_filter: AllowListFilter,
+                 run_async: bool = True):
+    """ Registers the bot's commands and player actions with the dispatcher.
+    Handlers run on the dispatcher's worker threads when `run_async` is set;
+    each game serializes its own updates.
+    """
     # Register commands with the Telegram Bot
-    start_game_handler = CommandHandler('start_game', my_bot.start_game, filters=my_filter)
-    p1_handler = CommandHandler('p1', my_bot.p1, filters=my_filter)
-    p2_handler = CommandHandler('p2', my_bot.p2, filters=my_filter)
-    quit_handler = CommandHandler('quit', my_bot.quit, filters=my_filter)
+    start_game_handler = CommandHandler('start_game', my_bot.start_game, filters=my_filter, run_async=run_async)
+    p1_handler = CommandHandler('p1', my_bot.p1, filters=my_filter, run_async=run_async)
+    p2_handler = CommandHandler('p2', my_bot.p2, filters=my_filter, run_async=run_async)
+    vs_bot_handler = CommandHandler('vs_bot', my_bot.vs_bot, filters=my_filter, run_async=run_async)
+    quit_handler = CommandHandler('quit', my_bot.quit, filters=my_filter, run_async=run_async)
+    hint_handler = CommandHandler('hint', my_bot.hint, filters=my_filter, run_async=run_async)
+    undo_handler = CommandHandler('undo', my_bot.undo, filters=my_filter, run_async=run_async)
+    replay_handler = CommandHandler('replay', my_bot.replay, filters=my_filter, run_async=run_async)
+    stats_handler = CommandHandler('stats', my_bot.stats_command, filters=my_filter, run_async=run_async)
+    leaderboard_handler = CommandHandler('leaderboard', my_bot.leaderboard, filters=my_filter, run_async=run_async)
 
     dispatcher.add_handler(start_game_handler)
     dispatcher.add_handler(p1_handler)
     dispatcher.add_handler(p2_handler)
+    dispatcher.add_handler(vs_bot_handler)
     dispatcher.add_handler(quit_handler)
-
-    # Register player actions
-    place_chip_handler = CallbackQueryHandler(my_bot.place_chip)
+    dispatcher.add_handler(hint_handler)
+    dispatcher.add_handler(undo_handler)
+    dispatcher.add_handler(replay_handler)
+    dispatcher.add_handler(stats_handler)
+    dispatcher.add_handler(leaderboard_handler)
+
+    # Register player actions and inline mode, behind the allow list. Runs
+    # synchronously so that it can stop the update before the handlers of group 0
+    dispatcher.add_handler(CallbackQueryHandler(my_filter.check_callback), group=-1)
+    dispatcher.add_handler(InlineQueryHandler(my_filter.check_callback), group=-1)
+    place_chip_handler = CallbackQueryHandler(my_bot.place_chip, run_async=run_async)
+    inline_query_handler = InlineQueryHandler(my_bot.inline_query, run_async=run_async)
     dispatcher.add_handler(place_chip_handler)
+    dispatcher.add_handler(inline_query_handler)
 
     # Log errors
     dispatcher.add_error_handler(error_handler)
 
-    # Start the Bot
-    updater.start_polling()
-
-    # Block until you press Ctrl-C
-    updater.idle()
-
 
 if __name__ == '__main__':
     main()
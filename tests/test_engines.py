@@ -0,0 +1,66 @@
+""" Randomized equivalence test of BitboardConnect4 against Connect4.
+
+Run from the repository root:
+
+    $ python -m pytest tests
+    $ python -m unittest discover tests
+"""
+import random
+import unittest
+
+from BitboardConnect4 import BitboardConnect4
+from Connect4 import Connect4
+
+SHAPES = [(6, 7), (4, 5), (1, 1), (1, 7), (7, 1), (2, 3), (8, 9)]
+GAMES = 10
+
+
+class EngineEquivalenceTest(unittest.TestCase):
+
+    def test_random_games(self):
+        rng = random.Random(1234)
+        for rows, cols in SHAPES:
+            for in_a_row in range(1, max(rows, cols) + 2):
+                with self.subTest(rows=rows, cols=cols, in_a_row=in_a_row):
+                    for _ in range(GAMES):
+                        self._play(rng, rows, cols, in_a_row)
+
+    def _play(self, rng, rows, cols, in_a_row):
+        """ Plays the same random moves, including moves into full or missing
+        columns and take-backs, on both engines, comparing them after each.
+        """
+        expected = Connect4(rows, cols, in_a_row)
+        actual = BitboardConnect4(rows, cols, in_a_row)
+        for _ in range(3 * rows * cols):
+            player = Connect4.P1 + len(actual.history) % 2
+            if actual.history and rng.random() < 0.2:
+                self.assertEqual(actual.undo(), expected.undo())
+            else:
+                col = rng.randint(0, cols + 1)
+                result = actual.place_chip(player, col)
+                self.assertEqual(result, expected.place_chip(player, col), actual.moves)
+                if result == Connect4.WIN_MOVE:
+                    # Only the boards are compared once the game is won, then
+                    # the winning move is taken back to play on
+                    self._assert_same(actual, expected, None)
+                    self.assertTrue(actual.undo())
+                    self.assertTrue(expected.undo())
+                elif result == Connect4.TIE_MOVE:
+                    self._assert_same(actual, expected, None)
+                    continue
+            self._assert_same(actual, expected, Connect4.P1 + len(actual.history) % 2)
+
+    def _assert_same(self, actual, expected, player):
+        """ Compares the engines, and their analysis for the player about to
+        move unless `player` is None.
+        """
+        self.assertEqual(actual.moves, expected.moves)
+        self.assertEqual(actual.move_count, expected.move_count)
+        self.assertEqual(actual.last_move, expected.last_move, actual.moves)
+        self.assertEqual([list(row) for row in actual.board], [list(row) for row in expected.board], actual.moves)
+        if player is not None:
+            self.assertEqual(actual.analyze(player), expected.analyze(player), actual.moves)
+
+
+if __name__ == '__main__':
+    unittest.main()